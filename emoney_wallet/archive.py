@@ -0,0 +1,216 @@
+import os
+import sys
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import MetaData, and_, create_engine, delete, func, insert, select
+from sqlalchemy.orm import Session
+from models import ArchivedMonth, Transaction, TransactionMonthSummary
+from pagination import history_page as hot_history_page, decode_cursor, encode_cursor
+from config import ARCHIVE_AFTER_DAYS, ARCHIVE_DIR, ARCHIVE_BATCH_SIZE, ARCHIVE_MAX_ATTACHED
+
+# 交易封存：超過 ARCHIVE_AFTER_DAYS 天的完整月份由 transactions 搬到 ARCHIVE_DIR/transactions_YYYY_MM.db
+# （欄位、索引與 id 都相同），並在 transaction_month_summaries 留下每位使用者當月的收支彙總。
+# 搬移順序：先寫入封存檔並核對筆數，再於同一個 transaction 內寫彙總、刪熱資料、記錄 archived_months；
+# 中途失敗重跑時封存檔以 INSERT OR IGNORE 補齊，不會重複。封存完成後檔案設為唯讀。
+# 讀取時在讀取連線上依需要 ATTACH（同一條連線保留最近使用的 ARCHIVE_MAX_ATTACHED 個），
+# /records 與 /merchant/records 在熱資料不足一頁且 start_date 早於封存邊界時接著讀封存月份，
+# 匯出則在熱資料之後依月份由新到舊接著串流封存檔。
+# 已封存的 charge 不能再以 refund/by-transaction 退款，ARCHIVE_AFTER_DAYS 應大於退款期限。
+#
+#   python archive.py run
+
+_tables = {}
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _window(table, month: date):
+    start = datetime.combine(month, time.min)
+    end = datetime.combine(next_month(month), time.min)
+    return and_(table.c.timestamp >= start, table.c.timestamp < end)
+
+
+def _schema(month: date) -> str:
+    return f"archive_{month:%Y_%m}"
+
+
+def _path(month: date) -> str:
+    return os.path.abspath(os.path.join(ARCHIVE_DIR, f"transactions_{month:%Y_%m}.db"))
+
+
+# ATTACH 之後的 transactions 表（schema 為 archive_YYYY_MM）
+def archive_table(month: date):
+    table = _tables.get(month)
+    if table is None:
+        table = _tables[month] = Transaction.__table__.to_metadata(MetaData(), schema=_schema(month))
+    return table
+
+
+def attach(db: Session, month: date):
+    conn = db.connection()
+    # connection.info 跟著底層 DBAPI 連線，歸還連線池後下次取用仍在
+    attached = conn.info.setdefault("attached_archives", [])
+    if month in attached:
+        attached.remove(month)
+    else:
+        if len(attached) >= ARCHIVE_MAX_ATTACHED:
+            conn.exec_driver_sql(f"DETACH DATABASE {_schema(attached.pop(0))}")
+        conn.exec_driver_sql(f"ATTACH DATABASE ? AS {_schema(month)}", (_path(month),))
+    attached.append(month)
+    return archive_table(month)
+
+
+# 封存邊界：此時間以前的交易都已不在 transactions；尚未封存過時為 None
+def boundary(db: Session):
+    latest = db.execute(select(func.max(ArchivedMonth.month))).scalar()
+    return datetime.combine(next_month(latest), time.min) if latest else None
+
+
+# start_date 所在月份以後的封存月份，由新到舊；before 為游標時間時只取該月份（含）以前
+def months_since(db: Session, start_date: str, before: datetime = None) -> list:
+    query = select(ArchivedMonth.month).where(ArchivedMonth.month >= month_start(datetime.strptime(start_date, "%Y-%m-%d")))
+    if before is not None:
+        query = query.where(ArchivedMonth.month <= month_start(before))
+    return db.execute(query.order_by(ArchivedMonth.month.desc())).scalars().all()
+
+
+# 交易紀錄分頁（需指定 columns）：熱資料不足一頁、且 start_date 早於封存邊界時，依月份由新到舊接著讀封存檔。
+# 封存資料一定比熱資料舊，依序接上即維持 (timestamp, id) 倒序，游標格式不變
+def history_page(db: Session, user_id: int, limit: int, after: str = None, filters=(), columns=None, start_date: str = None):
+    rows, next_cursor = hot_history_page(db, user_id, limit, after, filters, columns)
+    if next_cursor is not None or not start_date:
+        return rows, next_cursor
+
+    months = months_since(db, start_date, decode_cursor(after)[0] if after else None)
+
+    rows = list(rows)
+    for month in months:
+        remaining = limit - len(rows)
+        if remaining == 0:
+            return rows, encode_cursor(rows[-1])
+        page, next_cursor = hot_history_page(db, user_id, remaining, after, filters, columns, source=attach(db, month))
+        rows.extend(page)
+        if next_cursor is not None:
+            return rows, next_cursor
+    return rows, None
+
+
+# 封存期間內 until（含）以前的淨額：完整月份取彙總，until 所在月份若已封存再讀該月封存檔
+def balance_until(db: Session, user_id: int, until: datetime) -> float:
+    month = month_start(until)
+    incoming, outgoing = db.execute(
+        select(
+            func.coalesce(func.sum(TransactionMonthSummary.incoming), 0.0),
+            func.coalesce(func.sum(TransactionMonthSummary.outgoing), 0.0),
+        ).where(TransactionMonthSummary.user_id == user_id, TransactionMonthSummary.month < month)
+    ).one()
+    total = incoming - outgoing
+
+    if db.get(ArchivedMonth, month) is not None:
+        table = attach(db, month)
+        total += db.execute(
+            select(func.coalesce(func.sum(table.c.amount), 0.0))
+            .where(table.c.to_user_id == user_id, table.c.timestamp <= until)
+        ).scalar_one()
+        total -= db.execute(
+            select(func.coalesce(func.sum(table.c.amount), 0.0))
+            .where(table.c.from_user_id == user_id, table.c.type != "deposit", table.c.timestamp <= until)
+        ).scalar_one()
+    return total
+
+
+def _summaries(db: Session, month: date) -> list:
+    window = _window(Transaction.__table__, month)
+    totals = {}
+    for column, field, extra in (
+        (Transaction.to_user_id, "incoming", ()),
+        (Transaction.from_user_id, "outgoing", (Transaction.type != "deposit",)),
+    ):
+        rows = db.execute(
+            select(column, func.sum(Transaction.amount), func.count()).where(window, *extra).group_by(column)
+        ).all()
+        for user_id, amount, count in rows:
+            summary = totals.setdefault(user_id, {
+                "user_id": user_id, "month": month,
+                "incoming": 0.0, "outgoing": 0.0, "incoming_count": 0, "outgoing_count": 0,
+            })
+            summary[field] = amount or 0.0
+            summary[f"{field}_count"] = count
+    return list(totals.values())
+
+
+# 搬移一個月份，回傳筆數
+def archive_month(db: Session, month: date) -> int:
+    hot = Transaction.__table__
+    window = _window(hot, month)
+    expected = db.execute(select(func.count()).select_from(hot).where(window)).scalar_one()
+    if not expected:
+        return 0
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = _path(month)
+    if os.path.exists(path):
+        # 上次中斷留下的檔案，補齊後再設回唯讀
+        os.chmod(path, 0o644)
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        metadata = MetaData()
+        table = hot.to_metadata(metadata)
+        metadata.create_all(engine)
+        result = db.execute(
+            select(hot).where(window).order_by(hot.c.id).execution_options(yield_per=ARCHIVE_BATCH_SIZE)
+        )
+        with engine.begin() as conn:
+            for rows in result.partitions():
+                conn.execute(table.insert().prefix_with("OR IGNORE"), [row._asdict() for row in rows])
+            archived = conn.execute(select(func.count()).select_from(table)).scalar_one()
+    finally:
+        engine.dispose()
+    if archived != expected:
+        raise RuntimeError(f"archive {path} has {archived} rows for {month:%Y-%m}, expected {expected}")
+
+    try:
+        db.execute(delete(TransactionMonthSummary).where(TransactionMonthSummary.month == month))
+        summaries = _summaries(db, month)
+        if summaries:
+            db.execute(insert(TransactionMonthSummary), summaries)
+        db.execute(delete(Transaction).where(window).execution_options(synchronize_session=False))
+        db.merge(ArchivedMonth(month=month, filename=os.path.basename(path), row_count=expected))
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    os.chmod(path, 0o444)
+    return expected
+
+
+# 封存所有早於 (now − ARCHIVE_AFTER_DAYS) 所在月份的完整月份，回傳 [(月份, 筆數)]
+def run(db: Session, now: datetime = None, after_days: int = ARCHIVE_AFTER_DAYS) -> list:
+    cutoff = month_start((now or datetime.utcnow()) - timedelta(days=after_days))
+    oldest = db.execute(select(func.min(Transaction.timestamp))).scalar()
+    done = []
+    month = month_start(oldest) if oldest else cutoff
+    while month < cutoff:
+        moved = archive_month(db, month)
+        if moved:
+            done.append((month, moved))
+        month = next_month(month)
+    return done
+
+
+if __name__ == "__main__":
+    from db import SessionLocal
+
+    if sys.argv[1:] != ["run"]:
+        sys.exit("usage: python archive.py run")
+    session = SessionLocal()
+    try:
+        for month, moved in run(session):
+            print(f"archived {moved} transactions from {month:%Y-%m}")
+    finally:
+        session.close()
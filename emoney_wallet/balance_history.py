@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, func, select, union
+from sqlalchemy.orm import Session
+from db import SessionLocal
+from models import BalanceCheckpoint, Transaction
+from config import BALANCE_CHECKPOINT_EVERY, BALANCE_CHECKPOINT_LAG
+import archive
+
+# 歷史餘額：balance_checkpoints 記錄每個錢包在 as_of 時間點（含）以前所有交易的淨額。
+# 查詢某時間點的餘額 = 該時間點以前最近的 checkpoint + 之後到該時間點的交易，
+# 後者走 ix_transactions_from_ts / ix_transactions_to_ts，只掃一小段。
+# 背景工作每輪找出有新交易的使用者，距離上一個 checkpoint 累積滿 BALANCE_CHECKPOINT_EVERY 筆就寫一個新的。
+# checkpoint 時間點取「現在 − BALANCE_CHECKPOINT_LAG」，時間戳早於此、但尚未 commit 的交易不會被漏掉。
+# 餘額由交易紀錄推算，不讀 wallets.balance（兩者是否一致由 reconcile.py 檢查）。
+# 封存邊界以前的 checkpoint 不使用，改由 archive 的月彙總（與封存檔）算出封存期間的淨額。
+
+logger = logging.getLogger(__name__)
+
+_BATCH_USERS = 500
+
+_cursor = None
+_stats = {"runs": 0, "checkpoints_written": 0, "errors": 0, "last_transaction_id": None}
+
+
+# 使用者在 (after, until] 之間的交易筆數與淨額；after 為 None 表示從頭開始
+def _tail(db: Session, user_id: int, after, until):
+    totals = []
+    for column, sign, extra in (
+        (Transaction.to_user_id, 1.0, ()),
+        (Transaction.from_user_id, -1.0, (Transaction.type != "deposit",)),
+    ):
+        conditions = [column == user_id, Transaction.timestamp <= until, *extra]
+        if after is not None:
+            conditions.append(Transaction.timestamp > after)
+        count, total = db.execute(
+            select(func.count(), func.coalesce(func.sum(Transaction.amount), 0.0)).where(*conditions)
+        ).one()
+        totals.append((count, sign * total))
+    return sum(count for count, _ in totals), sum(total for _, total in totals)
+
+
+def _latest_checkpoint(db: Session, user_id: int, until):
+    return db.execute(
+        select(BalanceCheckpoint.as_of, BalanceCheckpoint.balance)
+        .where(BalanceCheckpoint.user_id == user_id, BalanceCheckpoint.as_of <= until)
+        .order_by(BalanceCheckpoint.as_of.desc())
+        .limit(1)
+    ).first()
+
+
+# 起算點：(之後的交易從哪個時間點之後開始算, 起始餘額)；時間點為 None 表示整個 transactions 表
+def _start(db: Session, user_id: int, until):
+    checkpoint = _latest_checkpoint(db, user_id, until)
+    edge = archive.boundary(db)
+    if checkpoint is not None and (edge is None or checkpoint.as_of >= edge):
+        return checkpoint.as_of, checkpoint.balance
+    if edge is None:
+        return None, 0.0
+    # transactions 只剩封存邊界以後的資料；until 早於邊界時不需要再讀熱資料
+    return (until if until < edge else None), archive.balance_until(db, user_id, until)
+
+
+def parse_timestamp(ts: str) -> datetime:
+    try:
+        value = datetime.fromisoformat(ts)
+    except ValueError:
+        raise HTTPException(400, detail="ts 格式錯誤，請使用 ISO 8601")
+    # 交易時間以 UTC naive datetime 儲存
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def balance_at(db: Session, user_id: int, ts: datetime) -> dict:
+    after, base = _start(db, user_id, ts)
+    count, total = _tail(db, user_id, after, ts)
+    return {
+        "timestamp": ts,
+        "balance": round(base + total, 10),
+        "checkpoint_at": after if after != ts else None,
+        "tail_transactions": count,
+    }
+
+
+# 寫入一輪 checkpoint，回傳寫入筆數。只看交易 id 大於上一輪游標的使用者
+def write_checkpoints(db: Session, every: int = BALANCE_CHECKPOINT_EVERY, lag: float = BALANCE_CHECKPOINT_LAG) -> int:
+    global _cursor
+    cutoff = datetime.utcnow() - timedelta(seconds=lag)
+    if _cursor is None:
+        _cursor = db.execute(select(func.coalesce(func.max(BalanceCheckpoint.last_transaction_id), 0))).scalar_one()
+    high = db.execute(select(func.coalesce(func.max(Transaction.id), 0))).scalar_one()
+    if high <= _cursor:
+        return 0
+
+    window = and_(Transaction.id > _cursor, Transaction.id <= high)
+    user_ids = db.execute(
+        union(
+            select(Transaction.from_user_id.label("user_id")).where(window),
+            select(Transaction.to_user_id.label("user_id")).where(window),
+        )
+    ).scalars().all()
+
+    written = 0
+    try:
+        for i in range(0, len(user_ids), _BATCH_USERS):
+            for user_id in user_ids[i:i + _BATCH_USERS]:
+                after, base = _start(db, user_id, cutoff)
+                if after is not None and after >= cutoff:
+                    continue
+                count, total = _tail(db, user_id, after, cutoff)
+                if count < every:
+                    continue
+                db.add(BalanceCheckpoint(
+                    user_id=user_id, as_of=cutoff, balance=base + total, postings=count, last_transaction_id=high,
+                ))
+                written += 1
+            db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    _cursor = high
+    _stats["last_transaction_id"] = high
+    return written
+
+
+def _run_once() -> int:
+    db = SessionLocal()
+    try:
+        return write_checkpoints(db)
+    finally:
+        db.close()
+
+
+async def run(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            written = await run_in_threadpool(_run_once)
+        except Exception:
+            _stats["errors"] += 1
+            logger.exception("balance checkpoint run failed")
+            continue
+        _stats["runs"] += 1
+        _stats["checkpoints_written"] += written
+
+
+def stats() -> dict:
+    return dict(_stats)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] != ["checkpoint"]:
+        sys.exit("usage: python balance_history.py checkpoint")
+    print(f"wrote {_run_once()} balance checkpoints")
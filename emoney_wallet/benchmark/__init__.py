@@ -0,0 +1,5 @@
+# 壓力測試 / benchmark：在暫存 SQLite 檔上啟動 main.app，批次建立測試資料後依設定的比例送出請求，
+# 輸出吞吐量、延遲分位數、每個請求的 SQL 數與餘額一致性檢查（JSON，可跨 commit 比較）。
+#
+#   cd emoney_wallet
+#   python -m benchmark --users 1000 --merchants 20 --requests 5000 --concurrency 32 --output result.json
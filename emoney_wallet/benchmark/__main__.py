@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+DEFAULT_MIX = "login=1,balance=4,transfer=3,charge=3,refund=1,records=2"
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="電子錢包 API 壓力測試")
+    parser.add_argument("--users", type=int, default=1000, help="一般使用者數")
+    parser.add_argument("--merchants", type=int, default=20, help="商戶數")
+    parser.add_argument("--balance", type=float, default=10000.0, help="每位使用者的初始餘額")
+    parser.add_argument("--charges", type=int, default=1000, help="預先建立、供 refund 使用的 charge 筆數")
+    parser.add_argument("--requests", type=int, default=5000, help="量測的請求數")
+    parser.add_argument("--warmup", type=int, default=100, help="量測前先送出、不列入統計的請求數")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時進行的請求數")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="各操作比例，例如 balance=4,transfer=3")
+    parser.add_argument("--bcrypt-rounds", type=int, default=None, help="測試資料的 bcrypt cost（預設同 config）")
+    parser.add_argument("--seed", type=int, default=42, help="亂數種子")
+    parser.add_argument("--output", help="結果 JSON 檔案（預設輸出到 stdout）")
+    parser.add_argument("--keep-db", action="store_true", help="保留暫存資料庫檔")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.mix = parse_mix(args.mix)
+
+    workdir = tempfile.mkdtemp(prefix="emoney-bench-")
+    path = os.path.join(workdir, "bench.db")
+    os.environ["EMONEY_DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ["EMONEY_ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{path}"
+    try:
+        # db / main 在 import 時就會建立 engine，必須先設定好資料庫位置
+        from benchmark.runner import run
+        report = asyncio.run(run(args))
+    finally:
+        if args.keep_db:
+            print(f"database kept at {path}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if report["invariants"]["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
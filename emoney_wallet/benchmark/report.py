@@ -0,0 +1,101 @@
+from sqlalchemy import case, func, select
+import db
+import ledger
+from models import Transaction, Wallet, WalletSlot
+
+_EPSILON = 1e-6
+
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+# samples: [(status_code, 秒數, SQL 數)]
+def summarize(samples, elapsed: float) -> dict:
+    latencies = sorted(seconds for _, seconds, _ in samples)
+    status_codes = {}
+    for status, _, _ in samples:
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+    count = len(samples)
+    return {
+        "count": count,
+        "errors": sum(1 for status, _, _ in samples if status >= 400),
+        "status_codes": status_codes,
+        "throughput_rps": round(count / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / count * 1000, 3) if count else 0.0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if count else 0.0,
+        },
+        "sql_per_request": round(sum(statements for _, _, statements in samples) / count, 2) if count else 0.0,
+    }
+
+
+# 餘額一致性：總額守恆、沒有負餘額、每個錢包 = 初始餘額 + 交易紀錄的淨額、refund 沒有超過原始 charge
+def check_invariants(initial_balances: dict) -> dict:
+    session = db.SessionLocal()
+    try:
+        wallet_total = session.execute(select(func.coalesce(func.sum(Wallet.balance), 0.0))).scalar()
+        slot_total = session.execute(select(func.coalesce(func.sum(WalletSlot.balance), 0.0))).scalar()
+        deposits = session.execute(
+            select(func.coalesce(func.sum(Transaction.amount), 0.0)).where(Transaction.type == "deposit")
+        ).scalar()
+        expected_total = sum(initial_balances.values()) + deposits
+        negative = session.execute(select(func.count()).select_from(Wallet).where(Wallet.balance < -_EPSILON)).scalar()
+
+        # deposit 的 from / to 都是本人，只算入帳
+        incoming = dict(session.execute(
+            select(Transaction.to_user_id, func.sum(Transaction.amount)).group_by(Transaction.to_user_id)
+        ).all())
+        outgoing = dict(session.execute(
+            select(Transaction.from_user_id, func.sum(Transaction.amount))
+            .where(Transaction.type != "deposit")
+            .group_by(Transaction.from_user_id)
+        ).all())
+        mismatched = []
+        for user_id, initial in initial_balances.items():
+            expected = initial + (incoming.get(user_id) or 0.0) - (outgoing.get(user_id) or 0.0)
+            actual = ledger.balance_of(session, user_id)
+            if actual is None or abs(actual - expected) > _EPSILON * max(1.0, abs(expected)):
+                mismatched.append({"user_id": user_id, "expected": expected, "actual": actual})
+
+        refunds = (
+            select(Transaction.original_transaction_id.label("charge_id"), func.sum(Transaction.amount).label("total"))
+            .where(Transaction.type == "refund", Transaction.original_transaction_id.isnot(None))
+            .group_by(Transaction.original_transaction_id)
+            .subquery()
+        )
+        refunded = func.coalesce(refunds.c.total, 0.0)
+        over_refunded = session.execute(
+            select(func.count())
+            .select_from(Transaction)
+            .outerjoin(refunds, refunds.c.charge_id == Transaction.id)
+            .where(
+                Transaction.type == "charge",
+                case(
+                    (refunded > Transaction.amount + _EPSILON, 1),
+                    (func.abs(refunded - func.coalesce(Transaction.refunded_amount, 0.0)) > _EPSILON, 1),
+                    else_=0,
+                ) == 1,
+            )
+        ).scalar()
+    finally:
+        session.close()
+
+    total = wallet_total + slot_total
+    result = {
+        "total_balance": round(total, 6),
+        "expected_total_balance": round(expected_total, 6),
+        "total_conserved": abs(total - expected_total) <= _EPSILON * max(1.0, abs(expected_total)),
+        "negative_wallets": negative,
+        "ledger_mismatches": len(mismatched),
+        "ledger_mismatch_samples": mismatched[:10],
+        "over_refunded_charges": over_refunded,
+    }
+    result["ok"] = result["total_conserved"] and not negative and not mismatched and not over_refunded
+    return result
@@ -0,0 +1,177 @@
+import asyncio
+import contextvars
+import platform
+import random
+import subprocess
+import time
+import httpx
+from sqlalchemy import event
+import config
+import db
+import hashing
+from main import app
+from routers.auth import create_access_token
+from benchmark import report
+from benchmark.seed import seed, PASSWORD, PIN
+
+# 每個請求一個計數器，SQLAlchemy 的 cursor 事件在同一個 context（含 threadpool）內累加。
+# group commit writer 在自己的 thread 執行，其 SQL 不計入個別請求。
+_statements = contextvars.ContextVar("benchmark_statements", default=None)
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter = _statements.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def _instrument():
+    engines = [db.engine, db.read_engine]
+    if db.async_engine is not None:
+        engines.append(db.async_engine.sync_engine)
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", _count_statement)
+
+
+class Workload:
+    def __init__(self, fixture, rng: random.Random):
+        self.fixture = fixture
+        self.rng = rng
+        self.tokens = {}
+        for _, username in fixture.customers + fixture.merchants:
+            token = create_access_token(data={"sub": username})
+            self.tokens[username] = {"Authorization": f"Bearer {token}"}
+        self.refundable = list(fixture.charges)
+
+    def _customer(self) -> str:
+        return self.rng.choice(self.fixture.customers)[1]
+
+    def _merchant(self) -> str:
+        return self.rng.choice(self.fixture.merchants)[1]
+
+    async def login(self, client):
+        return await client.post("/auth/login", data={"username": self._customer(), "password": PASSWORD})
+
+    async def balance(self, client):
+        return await client.get("/wallet/balance", headers=self.tokens[self._customer()])
+
+    async def transfer(self, client):
+        sender, recipient = self._customer(), self._customer()
+        while recipient == sender and len(self.fixture.customers) > 1:
+            recipient = self._customer()
+        return await client.post(
+            "/wallet/transfer",
+            headers=self.tokens[sender],
+            json={"to_username": recipient, "amount": 1.0, "pin": PIN},
+        )
+
+    async def charge(self, client):
+        return await client.post(
+            "/merchant/merchant/charge",
+            headers=self.tokens[self._merchant()],
+            json={"from_username": self._customer(), "amount": 1.0},
+        )
+
+    async def refund(self, client):
+        if not self.refundable:
+            return await self.charge(client)
+        merchant, charge_id = self.rng.choice(self.refundable)
+        return await client.post(
+            "/merchant/merchant/refund/by-transaction",
+            headers=self.tokens[merchant],
+            json={"transaction_id": charge_id, "amount": 1.0},
+        )
+
+    async def records(self, client):
+        return await client.get("/wallet/records", headers=self.tokens[self._customer()], params={"limit": 50})
+
+
+OPERATIONS = ("login", "balance", "transfer", "charge", "refund", "records")
+
+
+async def _drive(client, workload, plan, concurrency: int, samples=None):
+    queue = iter(plan)
+
+    async def worker():
+        for op in queue:
+            counter = [0]
+            token = _statements.set(counter)
+            started = time.perf_counter()
+            try:
+                response = await getattr(workload, op)(client)
+                status = response.status_code
+            except Exception:
+                status = 599
+            finally:
+                elapsed = time.perf_counter() - started
+                _statements.reset(token)
+            if samples is not None:
+                samples[op].append((status, elapsed, counter[0]))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    unknown = set(args.mix) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+
+    rounds = args.bcrypt_rounds or config.BCRYPT_ROUNDS
+    # 登入時若雜湊 cost 與設定不同會重算並寫回，測試期間讓兩者一致
+    hashing.BCRYPT_ROUNDS = rounds
+
+    rng = random.Random(args.seed)
+    seed_started = time.perf_counter()
+    fixture = seed(args.users, args.merchants, args.balance, args.charges, rounds, rng)
+    seed_seconds = time.perf_counter() - seed_started
+
+    _instrument()
+    workload = Workload(fixture, rng)
+    ops = [op for op in OPERATIONS if args.mix.get(op)]
+    weights = [args.mix[op] for op in ops]
+    warmup = rng.choices(ops, weights, k=args.warmup)
+    plan = rng.choices(ops, weights, k=args.requests)
+    samples = {op: [] for op in ops}
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            await _drive(client, workload, warmup, args.concurrency)
+            started = time.perf_counter()
+            await _drive(client, workload, plan, args.concurrency, samples)
+            elapsed = time.perf_counter() - started
+
+    all_samples = [sample for op in ops for sample in samples[op]]
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            "users": args.users,
+            "merchants": args.merchants,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "mix": args.mix,
+            "bcrypt_rounds": rounds,
+            "seed": args.seed,
+            "db_async": config.DB_ASYNC,
+            "group_commit": config.GROUP_COMMIT,
+            "merchant_wallet_slots": config.MERCHANT_WALLET_SLOTS,
+            "payment_queue": config.PAYMENT_QUEUE,
+            "velocity_limits": config.VELOCITY_LIMITS is not None,
+        },
+        "seed_seconds": round(seed_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "total": report.summarize(all_samples, elapsed),
+        "operations": {op: report.summarize(samples[op], elapsed) for op in ops},
+        "invariants": report.check_invariants(fixture.initial_balances),
+    }
@@ -0,0 +1,61 @@
+import random
+from passlib.hash import bcrypt
+from sqlalchemy import insert
+import db
+import ledger
+from models import User, Wallet
+
+PASSWORD = "bench-password"
+PIN = "1234"
+
+
+class Fixture:
+    def __init__(self, customers, merchants, initial_balances, charges):
+        self.customers = customers            # [(user_id, username)]
+        self.merchants = merchants            # [(user_id, username)]
+        self.initial_balances = initial_balances  # {user_id: balance}
+        self.charges = charges                # [(merchant_username, transaction_id)]
+
+
+# 以 executemany 一次寫入使用者與錢包；密碼與 PIN 都相同，只需各算一次 bcrypt
+def seed(users: int, merchants: int, balance: float, charges: int, rounds: int, rng: random.Random) -> Fixture:
+    hashed_password = bcrypt.using(rounds=rounds).hash(PASSWORD)
+    hashed_pin = bcrypt.using(rounds=rounds).hash(PIN)
+
+    customer_rows = [(i, f"user{i}") for i in range(1, users + 1)]
+    merchant_rows = [(users + i, f"merchant{i}") for i in range(1, merchants + 1)]
+    initial_balances = {uid: balance for uid, _ in customer_rows}
+    initial_balances.update({uid: 0.0 for uid, _ in merchant_rows})
+
+    with db.engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {
+                "id": uid,
+                "username": username,
+                "hashed_password": hashed_password,
+                "is_merchant": uid > users,
+                "kyc_status": "verified",
+                "pin_code": hashed_pin,
+                "pin_fail_count": 0,
+                "is_pin_locked": False,
+            }
+            for uid, username in customer_rows + merchant_rows
+        ])
+        conn.execute(insert(Wallet.__table__), [
+            {"user_id": uid, "balance": amount} for uid, amount in initial_balances.items()
+        ])
+
+    # 供 refund 使用的既有 charge，走 ledger 以保持餘額與彙總一致
+    seeded_charges = []
+    session = db.SessionLocal()
+    try:
+        for _ in range(charges):
+            payer_id, _ = rng.choice(customer_rows)
+            merchant_id, merchant_name = rng.choice(merchant_rows)
+            posting = ledger.apply_posting(session, payer_id, merchant_id, 20.0, "charge")
+            seeded_charges.append((merchant_name, posting.transaction_id))
+        session.commit()
+    finally:
+        session.close()
+
+    return Fixture(customer_rows, merchant_rows, initial_balances, seeded_charges)
@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# 列表回應序列化的微型 benchmark：同一頁資料比較
+#   orm     ORM 物件 → response_model 逐筆驗證 → json.dumps（原本 /records 的路徑）
+#   columns 只查欄位的 Row → 預先組好的 dict（含對方帳號）→ orjson（目前的路徑）
+# 查詢與序列化分開計時，輸出每頁毫秒數（JSON）。
+#
+#   cd emoney_wallet
+#   python -m benchmark.serialization --rows 20000 --limit 500 --repeat 20
+
+
+def _seed(user_id: int, rows: int):
+    from datetime import datetime, timedelta
+    from sqlalchemy import insert
+    import db
+    from models import User, Wallet, Transaction
+
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {"id": user_id, "username": "bench-owner"},
+            {"id": user_id + 1, "username": "bench-peer"},
+        ])
+        conn.execute(insert(Wallet.__table__), [{"user_id": user_id, "balance": 0.0}, {"user_id": user_id + 1, "balance": 0.0}])
+        conn.execute(insert(Transaction.__table__), [
+            {
+                "from_user_id": user_id if i % 2 else user_id + 1,
+                "to_user_id": user_id + 1 if i % 2 else user_id,
+                "amount": float(i % 1000) + 0.5,
+                "type": "transfer",
+                "timestamp": now - timedelta(seconds=i),
+            }
+            for i in range(rows)
+        ])
+
+
+def _timed(fn, repeat: int):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run(args) -> dict:
+    from pydantic import TypeAdapter
+    import db
+    from pagination import history_page
+    from schemas.transaction import TransactionRecord
+    from serialization import RECORD_COLUMNS, transaction_records, ORJSONResponse
+    import usernames
+
+    user_id = 1
+    _seed(user_id, args.rows)
+    adapter = TypeAdapter(list[TransactionRecord])
+    session = db.ReadSessionLocal()
+    try:
+        orm_rows, orm_query = _timed(lambda: history_page(session, user_id, args.limit)[0], args.repeat)
+        session.expunge_all()
+
+        def orm_serialize():
+            validated = adapter.validate_python(orm_rows, from_attributes=True)
+            content = adapter.dump_python(validated, mode="json")
+            return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+        orm_body, orm_serialize_seconds = _timed(orm_serialize, args.repeat)
+
+        column_rows, column_query = _timed(
+            lambda: history_page(session, user_id, args.limit, columns=RECORD_COLUMNS)[0], args.repeat
+        )
+        column_body, column_serialize_seconds = _timed(
+            lambda: ORJSONResponse(transaction_records(column_rows, usernames.counterparties(session, column_rows))).body,
+            args.repeat,
+        )
+    finally:
+        session.close()
+
+    # 舊路徑沒有對方帳號，比對時略過這兩欄
+    def comparable(body):
+        return [
+            {key: value for key, value in record.items() if key not in ("from_username", "to_username")}
+            for record in json.loads(body)
+        ]
+
+    if comparable(orm_body) != comparable(column_body):
+        raise SystemExit("serialized output differs between paths")
+
+    def entry(query, serialize):
+        return {
+            "query_ms": round(query * 1000, 3),
+            "serialize_ms": round(serialize * 1000, 3),
+            "total_ms": round((query + serialize) * 1000, 3),
+        }
+
+    orm = entry(orm_query, orm_serialize_seconds)
+    columns = entry(column_query, column_serialize_seconds)
+    return {
+        "rows_in_table": args.rows,
+        "page_size": args.limit,
+        "repeat": args.repeat,
+        "orm": orm,
+        "columns": columns,
+        "serialize_speedup": round(orm["serialize_ms"] / columns["serialize_ms"], 2) if columns["serialize_ms"] else None,
+        "total_speedup": round(orm["total_ms"] / columns["total_ms"], 2) if columns["total_ms"] else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark.serialization", description="列表回應序列化 benchmark")
+    parser.add_argument("--rows", type=int, default=20000, help="資料表中的交易筆數")
+    parser.add_argument("--limit", type=int, default=500, help="每頁筆數")
+    parser.add_argument("--repeat", type=int, default=20, help="每項重複次數（取最佳值）")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="emoney-bench-")
+    path = os.path.join(workdir, "bench.db")
+    os.environ["EMONEY_DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ["EMONEY_ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{path}"
+    try:
+        report = run(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,136 @@
+import os
 
 SECRET_KEY = "super_secure_secret_123456"  # 建議用 secrets.token_urlsafe(32)
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+
+# 交易紀錄分頁
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 500
+
+# 密碼 / PIN 雜湊：process pool 大小與 bcrypt cost（調整後舊雜湊會在登入時自動重算）
+HASH_WORKERS = os.cpu_count() or 2
+BCRYPT_ROUNDS = 12
+
+# get_current_user 的 token / 使用者快取（秒）
+PRINCIPAL_CACHE_SIZE = 10000
+PRINCIPAL_CACHE_TTL = 60
+
+# 可使用需要管理者身分的端點（目前為 /admin/velocity）的帳號；空集合表示沒有人可以使用
+ADMIN_USERNAMES = set()
+
+# 資料庫位置，可用環境變數覆寫（benchmark 會指到暫存檔）
+DATABASE_URL = os.environ.get("EMONEY_DATABASE_URL", "sqlite:///./emoney.db")
+
+# True 時改用 AsyncEngine / AsyncSession 處理主要 API（本機 aiosqlite，正式環境可換成 postgresql+asyncpg://...）
+DB_ASYNC = False
+ASYNC_DATABASE_URL = os.environ.get("EMONEY_ASYNC_DATABASE_URL", "sqlite+aiosqlite:///./emoney.db")
+
+# 交易紀錄匯出時每批從 DB 取出的筆數
+EXPORT_BATCH_SIZE = 1000
+
+# 批次轉帳（薪資、回饋金發放）單次最多筆數，以及解析收款人時每個 IN 查詢的大小
+BATCH_TRANSFER_MAX_ITEMS = 10000
+BATCH_LOOKUP_CHUNK = 500
+
+# SQLite 連線設定（每條連線套用），以及讀取專用連線池大小
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+}
+READ_POOL_SIZE = 10
+READ_POOL_MAX_OVERFLOW = 20
+
+# Group commit：轉帳與商戶收款交給單一 writer，累積到 MAX_BATCH 筆或等待 MAX_DELAY 後一次 commit
+GROUP_COMMIT = False
+GROUP_COMMIT_MAX_BATCH = 128
+GROUP_COMMIT_MAX_DELAY_MS = 2
+
+# Idempotency-Key：成功回應保留時間（秒）、記憶體快取筆數，
+# 以及等待其他 worker 上同一個 key 的原始請求完成的上限與輪詢間隔（秒）
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_CACHE_SIZE = 10000
+IDEMPOTENCY_WAIT_TIMEOUT = 30
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+# 處理中紀錄的租約（秒）：超過此時間後，重送的請求回放已完成的記帳，尚未記帳時接手執行（原始請求的記帳隨之失效）
+IDEMPOTENCY_LOCK_SECONDS = 60
+
+# 商戶收款入帳的分片數（1 表示不分片，直接入 wallets），以及 sweeper 把分片併回主錢包的間隔（秒）
+MERCHANT_WALLET_SLOTS = 1
+WALLET_SWEEP_INTERVAL = 5
+
+# 超過此秒數的請求寫入 slow request log（logger "emoney.slow_requests"），None 表示關閉
+SLOW_REQUEST_SECONDS = None
+
+# 非同步付款佇列：開啟後轉帳與商戶收款驗證完即寫入 payment_requests 並回 202，由 worker 批次記帳。
+# worker 數、每批筆數、佇列空閒時的輪詢間隔（秒），以及 /payments/{id} long-poll 最長等待秒數
+PAYMENT_QUEUE = False
+PAYMENT_QUEUE_WORKERS = 2
+PAYMENT_QUEUE_BATCH = 64
+PAYMENT_QUEUE_POLL_INTERVAL = 0.2
+PAYMENT_LONG_POLL_MAX = 30
+
+# Refresh token 有效天數，以及撤銷清單的 Bloom filter 大小（bits / hash 數）與清除過期項目的間隔（秒）
+REFRESH_TOKEN_EXPIRE_DAYS = 14
+REVOCATION_BLOOM_BITS = 1 << 20
+REVOCATION_BLOOM_HASHES = 7
+REVOCATION_PURGE_INTERVAL = 60
+
+# 交易列表對方帳號（user id → username）快取的筆數與保留時間（秒）
+USERNAME_CACHE_SIZE = 100000
+USERNAME_CACHE_TTL = 24 * 60 * 60
+
+# 對帳工作（reconcile.py）：每次串流讀取的筆數、process 數（None 表示 CPU 數）、checkpoint 檔與容許的相對誤差
+RECONCILE_CHUNK_SIZE = 50000
+RECONCILE_WORKERS = None
+RECONCILE_CHECKPOINT_PATH = "./reconcile_checkpoint.npz"
+RECONCILE_TOLERANCE = 1e-6
+
+# 歷史餘額 checkpoint：背景工作間隔（秒，None 表示不啟動）、累積幾筆交易寫一個 checkpoint，
+# 以及 checkpoint 時間點落後現在的秒數（避開時間戳較早但尚未 commit 的交易）
+BALANCE_CHECKPOINT_INTERVAL = 300
+BALANCE_CHECKPOINT_EVERY = 100
+BALANCE_CHECKPOINT_LAG = 60
+
+# 交易封存：超過 ARCHIVE_AFTER_DAYS 天的完整月份搬到 ARCHIVE_DIR 下的每月 SQLite 檔，
+# 每批搬移筆數，以及單一讀取連線同時 ATTACH 的封存檔上限（SQLite 預設最多 10 個）
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_DIR = "./archive"
+ARCHIVE_BATCH_SIZE = 5000
+ARCHIVE_MAX_ATTACHED = 8
+
+# 商戶 webhook：dispatcher 輪詢 outbox 的間隔（秒，None 表示不啟動）、每個 webhook 請求最多帶幾筆事件、
+# 同時送出的端點數、HTTP 逾時（秒）、連續失敗的退避起點與上限（秒），以及事件最多嘗試次數
+WEBHOOK_DISPATCH_INTERVAL = 0.5
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_CONCURRENCY = 16
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_BACKOFF_BASE = 1
+WEBHOOK_BACKOFF_MAX = 600
+WEBHOOK_MAX_ATTEMPTS = 12
+# webhook 只接受 https 且解析到公開位址的主機；本機測試接收端（python webhooks.py receive）需開啟此項，
+# 允許 http:// 與 loopback 位址（私有網段、link-local 仍然拒絕）
+WEBHOOK_ALLOW_LOCAL_HTTP = False
+
+# 轉帳 / 收款的頻率與金額上限（velocity.py），依 kyc_status 設定，None 表示該項不限制；VELOCITY_LIMITS = None 整個關閉。
+# "user" 限制付款方（轉帳轉出、被商戶收款），"merchant" 限制收款商戶。未列出的 kyc_status 套用 not_verified。
+# VELOCITY_WINDOWS 為各時間窗的（秒數, bucket 數），bucket 越多越精確、記憶體越多。
+# 另有清除閒置計數的間隔（秒），以及啟動時補回計數每批讀取的交易筆數
+VELOCITY_WINDOWS = {"minute": (60, 12), "day": (24 * 60 * 60, 24)}
+VELOCITY_LIMITS = {
+    "user": {
+        "not_verified": {"minute": {"count": 20, "amount": 10000}, "day": {"count": 200, "amount": 50000}},
+        "pending": {"minute": {"count": 20, "amount": 10000}, "day": {"count": 200, "amount": 50000}},
+        "verified": {"minute": {"count": 120, "amount": 200000}, "day": {"count": 5000, "amount": 2000000}},
+    },
+    "merchant": {
+        "not_verified": {"minute": {"count": 600, "amount": 100000}, "day": {"count": 20000, "amount": 1000000}},
+        "pending": {"minute": {"count": 600, "amount": 100000}, "day": {"count": 20000, "amount": 1000000}},
+        "verified": {"minute": {"count": None, "amount": None}, "day": {"count": None, "amount": None}},
+    },
+}
+VELOCITY_PURGE_INTERVAL = 300
+VELOCITY_WARM_CHUNK = 5000
@@ -1,15 +1,74 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
 from models import Base
+import storage
+import user_search
+from config import DATABASE_URL, DB_ASYNC, ASYNC_DATABASE_URL
 
-DATABASE_URL = "sqlite:///./emoney.db"
-
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = storage.configure_sqlite(
+    create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=storage.TimedQueuePool)
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base.metadata.create_all(bind=engine)
 
 
+# create_all 不會替已存在的資料表補欄位，舊資料庫在這裡以 ALTER TABLE 補上（新欄位必須可為 NULL 或有 server_default）
+def ensure_columns(bind):
+    added = set()
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(bind.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.execute(text(ddl))
+                added.add((table.name, column.name))
+
+        # 舊資料沒有 refund ↔ charge 的關聯，沿用舊規則（同雙方、同金額的 refund）視為已全額退款
+        if ("transactions", "refunded_amount") in added:
+            conn.execute(text(
+                "UPDATE transactions SET refunded_amount = amount "
+                "WHERE type = 'charge' AND EXISTS ("
+                "SELECT 1 FROM transactions r WHERE r.type = 'refund' "
+                "AND r.from_user_id = transactions.to_user_id "
+                "AND r.to_user_id = transactions.from_user_id "
+                "AND r.amount = transactions.amount)"
+            ))
+
+
+# create_all 不會替已存在的資料表補建索引，舊資料庫在這裡補上
+def ensure_indexes(bind):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+
+ensure_columns(engine)
+ensure_indexes(engine)
+user_search.ensure_index(engine)
+
+# GET 類端點使用的讀取專用連線池（query_only），建表後才建立
+read_engine = storage.create_read_engine(DATABASE_URL)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+
+# 非同步模式：建表仍由上面的同步 engine 負責，API 改走 AsyncSession。
+# expire_on_commit=False，commit 後讀取屬性不會觸發隱含的 lazy load。
+async_engine = None
+AsyncSessionLocal = None
+if DB_ASYNC:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
+    storage.configure_sqlite(async_engine.sync_engine, name="async")
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -1,12 +1,17 @@
 from fastapi import Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+import time
+from sqlalchemy import select
+from sqlalchemy.orm import Session, make_transient_to_detached
 from jose import JWTError, jwt
-from db import SessionLocal
+from db import SessionLocal, ReadSessionLocal, AsyncSessionLocal
 from models import User
-from config import SECRET_KEY, ALGORITHM
+from config import SECRET_KEY, ALGORITHM, PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL, ADMIN_USERNAMES
+from cache import TTLCache
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
-from passlib.hash import bcrypt
+import hashing
+import tokens
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -17,31 +22,149 @@ def get_db():
     finally:
         db.close()
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# 只讀端點用：走讀取專用連線池，寫入會被 query_only 擋下
+def get_read_db():
+    db = ReadSessionLocal()
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# 已驗證的 token → username，以及 username → User 欄位快照。
+# 使用者資料異動後必須呼叫 invalidate_user；多個 worker process 之間靠 TTL 收斂。
+token_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+principal_cache = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+
+def invalidate_user(username: str):
+    principal_cache.pop(username)
+
+
+def principal_cache_stats() -> dict:
+    return {"tokens": token_cache.stats(), "principals": principal_cache.stats(), "revocation": tokens.denylist.stats()}
+
+
+# 回傳 token 的 claims（sub / sid / jti / exp）；撤銷檢查在快取命中時也要做
+def decode_token(token: str) -> dict:
+    claims = token_cache.get(token)
+    if claims is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            if payload.get("sub") is None:
+                raise HTTPException(status_code=401, detail="Invalid token")
+        except JWTError:
             raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+
+        claims = {key: payload.get(key) for key in ("sub", "sid", "jti", "exp")}
+        # 快取時間不超過 token 本身的有效期限
+        ttl = payload.get("exp", 0) - time.time()
+        if ttl > 0:
+            token_cache.set(token, claims, ttl)
+
+    if tokens.is_revoked(claims):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return claims
+
+
+def decode_username(token: str) -> str:
+    return decode_token(token)["sub"]
+
+
+# 由快照還原成已存在於 DB 的物件並掛回本次 session，之後的修改照常 flush
+def _restore_principal(db, snapshot: dict) -> User:
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    db.add(user)
+    return user
+
+
+def _remember_principal(user: User):
+    principal_cache.set(user.username, {c.key: getattr(user, c.key) for c in User.__table__.columns})
+
+
+def _load_current_user(token: str, db: Session) -> User:
+    username = decode_username(token)
+
+    snapshot = principal_cache.get(username)
+    if snapshot is not None:
+        return _restore_principal(db, snapshot)
 
     user = db.query(User).filter(User.username == username).first()
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
+    _remember_principal(user)
     return user
 
-def verify_pin(pin_input: str, user: User, db: Session):
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    return _load_current_user(token, db)
+
+
+# 只讀端點用，與 get_read_db 共用同一個 session
+def get_current_user_read(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)):
+    return _load_current_user(token, db)
+
+
+# 讀取使用者個人資料的管理端點用：登入者必須在 ADMIN_USERNAMES 內
+def require_admin(token: str = Depends(oauth2_scheme)):
+    username = decode_username(token)
+    if username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return username
+
+
+# 會長時間等待的端點（long-poll）用：只在解析使用者時短暫借用讀取 session，回傳已脫離 session 的 User，
+# 等待期間不佔住連線池的連線
+def get_current_user_detached(token: str = Depends(oauth2_scheme)):
+    db = ReadSessionLocal()
+    try:
+        return _load_current_user(token, db)
+    finally:
+        db.close()
+
+
+# DB_ASYNC 模式使用；AsyncSession 只在該模式下才 import（需要 greenlet）
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db=Depends(get_async_db)):
+    username = decode_username(token)
+
+    snapshot = principal_cache.get(username)
+    if snapshot is not None:
+        return _restore_principal(db, snapshot)
+
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    _remember_principal(user)
+    return user
+
+
+# verify_pin 同時給同步 Session 與 AsyncSession 使用
+async def _commit(db):
+    if isinstance(db, Session):
+        await run_in_threadpool(db.commit)
+    else:
+        await db.commit()
+
+async def verify_pin(pin_input: str, user: User, db: Session):
     if user.is_pin_locked:
         raise HTTPException(403, detail="Your PIN is locked due to multiple failed attempts.")
 
-    if not user.pin_code or not bcrypt.verify(pin_input, user.pin_code):
+    if not user.pin_code or not await hashing.verify_secret(pin_input, user.pin_code):
         user.pin_fail_count += 1
         if user.pin_fail_count >= 3:
             user.is_pin_locked = True
-        db.commit()
+        username = user.username
+        await _commit(db)
+        invalidate_user(username)
         raise HTTPException(403, detail="Invalid PIN code.")
 
     # 驗證成功時，清除錯誤紀錄
-    user.pin_fail_count = 0
-    db.commit()
\ No newline at end of file
+    if user.pin_fail_count:
+        user.pin_fail_count = 0
+        username = user.username
+        await _commit(db)
+        invalidate_user(username)
\ No newline at end of file
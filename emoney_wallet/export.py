@@ -0,0 +1,71 @@
+import csv
+import io
+import json
+from fastapi.responses import StreamingResponse
+from db import ReadSessionLocal
+from models import Transaction
+from pagination import history_statement, retarget
+import archive
+from config import EXPORT_BATCH_SIZE
+
+EXPORT_COLUMNS = [
+    Transaction.id,
+    Transaction.from_user_id,
+    Transaction.to_user_id,
+    Transaction.amount,
+    Transaction.type,
+    Transaction.timestamp,
+    Transaction.original_transaction_id,
+]
+EXPORT_FIELDS = [c.key for c in EXPORT_COLUMNS]
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _csv_chunk(rows) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([row.timestamp.isoformat() if key == "timestamp" else row[i] for i, key in enumerate(EXPORT_FIELDS)])
+    return buf.getvalue()
+
+
+def _ndjson_chunk(rows) -> str:
+    lines = []
+    for row in rows:
+        record = row._asdict()
+        record["timestamp"] = row.timestamp.isoformat()
+        lines.append(json.dumps(record, ensure_ascii=False))
+    return "\n".join(lines) + "\n"
+
+
+# 以 server-side cursor 每次取 EXPORT_BATCH_SIZE 筆，逐批轉成文字送出，記憶體用量與總筆數無關。
+# 回應送出期間請求的 session 可能已關閉，串流自行開一個 session。
+# start_date 早於封存邊界時，熱資料之後依月份由新到舊接著讀封存檔（封存資料一定比熱資料舊，順序不變）。
+def _stream(user_id: int, filters, fmt: str, start_date: str = None):
+    db = ReadSessionLocal()
+    try:
+        if fmt == "csv":
+            yield ",".join(EXPORT_FIELDS) + "\n"
+        to_chunk = _csv_chunk if fmt == "csv" else _ndjson_chunk
+        stmt = history_statement(user_id, EXPORT_COLUMNS, filters)
+        months = archive.months_since(db, start_date) if start_date else []
+        # 封存檔在讀到該月份時才 ATTACH，同時 ATTACH 的數量不超過上限
+        for month in [None, *months]:
+            source = stmt if month is None else retarget(stmt, archive.attach(db, month))
+            result = db.execute(source.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE))
+            for rows in result.partitions():
+                yield to_chunk(rows)
+    finally:
+        db.close()
+
+
+def export_response(user_id: int, filters, fmt: str, filename: str, start_date: str = None) -> StreamingResponse:
+    return StreamingResponse(
+        _stream(user_id, filters, fmt, start_date),
+        media_type=MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
@@ -0,0 +1,146 @@
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from sqlalchemy.orm import sessionmaker
+import db
+import ledger
+import storage
+from config import GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_DELAY_MS
+
+# Group commit：各請求的記帳交給單一 writer thread，依序在同一個 DB transaction 內套用，
+# 湊滿 GROUP_COMMIT_MAX_BATCH 筆或等待 GROUP_COMMIT_MAX_DELAY_MS 後 commit 一次。
+# 每筆以 SAVEPOINT 隔開，餘額不足等錯誤只回滾該筆；結果在 commit 成功後才回給請求，
+# 已回覆成功的交易一定已寫入。各筆在呼叫端的 contextvars 內套用（Idempotency-Key 的連結等）。
+
+_STOP = object()
+
+_writer = None
+_lock = threading.Lock()
+_stats = {"batches": 0, "postings": 0, "failed": 0, "max_batch": 0, "commit_seconds": 0.0}
+
+
+# writer 專用連線（BEGIN IMMEDIATE）。每批只 commit 一次，因此可用 synchronous=FULL 保住每筆已回覆的交易。
+def _create_engine():
+    return storage.create_writer_engine(db.engine, "group_commit", overrides={"synchronous": "FULL"})
+
+
+class _Writer:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._session_factory = sessionmaker(bind=_create_engine(), autoflush=False, expire_on_commit=False)
+        self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, apply, *args, **kwargs) -> Future:
+        future = Future()
+        self._queue.put((future, contextvars.copy_context(), apply, args, kwargs))
+        return future
+
+    def stop(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + GROUP_COMMIT_MAX_DELAY_MS / 1000
+            stopping = False
+            while len(batch) < GROUP_COMMIT_MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._apply_batch(batch)
+            if stopping:
+                return
+
+    def _apply_batch(self, batch):
+        outcomes = []
+        session = self._session_factory()
+        started = time.perf_counter()
+        try:
+            for future, context, apply, args, kwargs in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                savepoint = session.begin_nested()
+                try:
+                    outcomes.append((future, context.run(apply, session, *args, **kwargs), None))
+                    savepoint.commit()
+                except Exception as e:
+                    savepoint.rollback()
+                    outcomes.append((future, None, e))
+            session.commit()
+        except Exception as e:
+            # commit 失敗時整批都沒有寫入，成功的項目一併回報錯誤
+            session.rollback()
+            outcomes = [(future, None, error or e) for future, _, error in outcomes]
+        finally:
+            session.close()
+
+        failed = 0
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                failed += 1
+                future.set_exception(error)
+
+        with _lock:
+            _stats["batches"] += 1
+            _stats["postings"] += len(outcomes)
+            _stats["failed"] += failed
+            _stats["max_batch"] = max(_stats["max_batch"], len(outcomes))
+            _stats["commit_seconds"] += time.perf_counter() - started
+
+
+def _get_writer() -> _Writer:
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = _Writer()
+        return _writer
+
+
+# 同步呼叫端（threadpool 內的端點）：阻塞到所屬批次 commit 完成
+def post(from_user_id: int, to_user_id: int, amount: float, tx_type: str, **fields) -> ledger.Posting:
+    return _get_writer().submit(ledger.apply_posting, from_user_id, to_user_id, amount, tx_type, **fields).result()
+
+
+async def post_async(from_user_id: int, to_user_id: int, amount: float, tx_type: str, **fields) -> ledger.Posting:
+    future = _get_writer().submit(ledger.apply_posting, from_user_id, to_user_id, amount, tx_type, **fields)
+    return await asyncio.wrap_future(future)
+
+
+def stats() -> dict:
+    with _lock:
+        batches = _stats["batches"]
+        return {
+            "running": _writer is not None,
+            "queue_depth": _writer._queue.qsize() if _writer is not None else 0,
+            "batches": batches,
+            "postings": _stats["postings"],
+            "failed": _stats["failed"],
+            "max_batch": _stats["max_batch"],
+            "avg_batch": round(_stats["postings"] / batches, 2) if batches else 0.0,
+            "commit_seconds": round(_stats["commit_seconds"], 3),
+        }
+
+
+# 處理完佇列中已送出的記帳後停止 writer
+def shutdown():
+    global _writer
+    with _lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
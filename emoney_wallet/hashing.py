@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from passlib.hash import bcrypt
+from config import HASH_WORKERS, BCRYPT_ROUNDS
+import metrics
+
+# bcrypt 每次約數百毫秒 CPU，交給獨立的 process pool 計算，
+# 不佔用 event loop 與 Starlette threadpool，也能吃滿多核心。
+
+_executor = None
+_lock = threading.Lock()
+_stats = {"pending": 0, "max_pending": 0, "completed": 0, "total_seconds": 0.0}
+
+
+def _hash(secret: str, rounds: int) -> str:
+    return bcrypt.using(rounds=rounds).hash(secret)
+
+
+def _verify(secret: str, hashed: str) -> bool:
+    return bcrypt.verify(secret, hashed)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        return _executor
+
+
+async def _submit(fn, *args):
+    with _lock:
+        _stats["pending"] += 1
+        _stats["max_pending"] = max(_stats["max_pending"], _stats["pending"])
+    started = time.perf_counter()
+    try:
+        return await asyncio.wrap_future(_get_executor().submit(fn, *args))
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.record_bcrypt(elapsed)
+        with _lock:
+            _stats["pending"] -= 1
+            _stats["completed"] += 1
+            _stats["total_seconds"] += elapsed
+
+
+async def hash_secret(secret: str) -> str:
+    return await _submit(_hash, secret, BCRYPT_ROUNDS)
+
+
+async def verify_secret(secret: str, hashed: str) -> bool:
+    return await _submit(_verify, secret, hashed)
+
+
+# 雜湊的 cost 與目前設定不同時，登入成功後應以新 cost 重新雜湊
+def needs_rehash(hashed: str) -> bool:
+    return bcrypt.using(rounds=BCRYPT_ROUNDS).needs_update(hashed)
+
+
+def stats() -> dict:
+    with _lock:
+        pending = _stats["pending"]
+        return {
+            "workers": HASH_WORKERS,
+            "rounds": BCRYPT_ROUNDS,
+            "pending": pending,
+            "queue_depth": max(0, pending - HASH_WORKERS),
+            "max_pending": _stats["max_pending"],
+            "completed": _stats["completed"],
+            "total_seconds": round(_stats["total_seconds"], 3),
+        }
+
+
+def shutdown():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
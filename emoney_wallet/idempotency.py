@@ -0,0 +1,359 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from db import SessionLocal
+from models import IdempotencyKey
+from deps import decode_username
+from cache import TTLCache
+from config import IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_WAIT_TIMEOUT, IDEMPOTENCY_POLL_INTERVAL, IDEMPOTENCY_LOCK_SECONDS
+
+# Idempotency-Key（ASGI middleware）：帶 key 的 POST 只執行一次，重送時直接回放第一次的回應。
+# 以 idempotency_keys 表的 (username, key) 唯一索引搶佔 key，跨 worker process 也只有一個請求會執行；
+# 同一個 process 內的重複請求等待原始請求的 future，不輪詢 DB。
+# 記帳時在同一個 DB transaction 內把交易 id（付款佇列模式為 payment id）寫回 key 的紀錄（record_posting / record_payment），
+# 帳動了就一定查得到。處理中的紀錄帶有 IDEMPOTENCY_LOCK_SECONDS 的租約，租約過後同一個請求的重送：
+#   已連結記帳結果 → 回放該結果，不再執行；
+#   尚未連結 → attempt 加一後接手執行。原始請求若仍在執行，記帳時 attempt 對不上而整筆 rollback，不會重複扣款。
+# 4xx 回應（驗證失敗、餘額不足等）沒有動到帳，釋放 key 讓客戶端以同一個 key 重試；
+# 5xx 與未處理的例外可能發生在記帳之後，和 2xx 一樣保存並回放，避免重送時重複扣款。
+
+HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+
+response_cache = TTLCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL)
+_in_flight = {}
+# 目前請求持有的 key：(username, key, attempt)；group commit 的 writer 在呼叫端的 context 內套用，同樣看得到
+_claim = contextvars.ContextVar("idempotency_claim", default=None)
+
+
+class Superseded(Exception):
+    pass
+
+
+def _fingerprint(method: str, path: str, body: bytes) -> str:
+    digest = hashlib.sha256(f"{method} {path}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _snapshot(record: IdempotencyKey) -> dict:
+    return {
+        "request_hash": record.request_hash,
+        "status_code": record.status_code,
+        "content_type": record.content_type,
+        "body": record.response_body,
+    }
+
+
+def _owned(username: str, key: str, attempt: int):
+    return (IdempotencyKey.username == username, IdempotencyKey.key == key, IdempotencyKey.attempt == attempt)
+
+
+# 記帳端（ledger / payment_queue）在記帳的 transaction 內呼叫；key 已被其他重送接手時丟出 Superseded，讓整筆記帳 rollback
+def _link(db, **values):
+    claim = _claim.get()
+    if claim is None:
+        return
+    linked = db.execute(
+        update(IdempotencyKey)
+        .where(*_owned(*claim), IdempotencyKey.status_code.is_(None))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not linked:
+        raise Superseded("Idempotency-Key was taken over by a retry")
+
+
+def record_posting(db, transaction_id: int):
+    _link(db, transaction_id=transaction_id)
+
+
+def record_payment(db, payment_id: int):
+    _link(db, payment_id=payment_id)
+
+
+# 已記帳但沒有存到回應（process 在回應前當掉）：由連結的記帳結果產生回放內容
+def _outcome(record: IdempotencyKey) -> dict:
+    if record.payment_id is not None:
+        location = f"/payments/{record.payment_id}"
+        status_code, body = 202, {"payment_id": record.payment_id, "status": "pending", "status_url": location}
+    else:
+        status_code, body = 200, {"message": "Request already processed", "transaction_id": record.transaction_id}
+    return {"request_hash": record.request_hash, "status_code": status_code, "content_type": "application/json", "body": json.dumps(body)}
+
+
+# 處理中紀錄的租約已過期：已記帳時改存回放內容，否則 attempt 加一接手。
+# 條件式 UPDATE，多個重送同時到達或原始請求同時記帳時只有一方成功。回傳接手的 attempt 或 None
+def _take_over(db, record: IdempotencyKey, now: datetime):
+    attempt = record.attempt + 1
+    pending = (*_owned(record.username, record.key, record.attempt), IdempotencyKey.status_code.is_(None))
+    if record.transaction_id is not None or record.payment_id is not None:
+        outcome = _outcome(record)
+        db.execute(
+            update(IdempotencyKey)
+            .where(*pending)
+            .values(status_code=outcome["status_code"], content_type=outcome["content_type"], response_body=outcome["body"])
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return None
+    claimed = db.execute(
+        update(IdempotencyKey)
+        .where(*pending, IdempotencyKey.transaction_id.is_(None), IdempotencyKey.payment_id.is_(None))
+        .values(attempt=attempt, locked_until=now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return attempt if claimed else None
+
+
+# 搶佔 key：回傳 (attempt, None)；已有紀錄時回傳 (None, 快照)（status_code 為 None 表示仍在處理中）
+def _db_claim(username: str, key: str, request_hash: str):
+    db = SessionLocal()
+    try:
+        for _ in range(2):
+            now = datetime.utcnow()
+            try:
+                db.add(IdempotencyKey(
+                    username=username, key=key, request_hash=request_hash, created_at=now, attempt=0,
+                    locked_until=now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS),
+                ))
+                db.commit()
+                return 0, None
+            except IntegrityError:
+                db.rollback()
+
+            record = db.execute(
+                select(IdempotencyKey).where(IdempotencyKey.username == username, IdempotencyKey.key == key)
+            ).scalars().first()
+            if record is None:
+                continue
+            if record.created_at >= now - timedelta(seconds=IDEMPOTENCY_TTL):
+                # 同一個請求的重送，且原始請求的租約已過期（process 當掉或執行過久）；舊資料沒有 locked_until，以 created_at 起算
+                locked_until = record.locked_until or record.created_at + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+                if record.status_code is None and record.request_hash == request_hash and locked_until <= now:
+                    attempt = _take_over(db, record, now)
+                    if attempt is not None:
+                        return attempt, None
+                    db.refresh(record)
+                return None, _snapshot(record)
+            # 已過期的 key 視為不存在
+            db.delete(record)
+            db.commit()
+        raise HTTPException(status_code=409, detail="Idempotency-Key is busy, retry later")
+    finally:
+        db.close()
+
+
+# 以下兩者都限定 attempt：key 已被重送接手時不覆寫接手者的紀錄。回傳是否有寫入
+def _db_complete(username: str, key: str, attempt: int, result: dict) -> bool:
+    db = SessionLocal()
+    try:
+        completed = db.execute(
+            update(IdempotencyKey)
+            .where(*_owned(username, key, attempt))
+            .values(status_code=result["status_code"], content_type=result["content_type"], response_body=result["body"])
+        ).rowcount
+        db.commit()
+        return bool(completed)
+    finally:
+        db.close()
+
+
+# 已連結記帳結果的紀錄不刪除
+def _db_release(username: str, key: str, attempt: int):
+    db = SessionLocal()
+    try:
+        db.execute(
+            delete(IdempotencyKey)
+            .where(*_owned(username, key, attempt), IdempotencyKey.transaction_id.is_(None), IdempotencyKey.payment_id.is_(None))
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+# 刪除過期的 key（依 created_at 索引），回傳刪除筆數
+def purge_expired(db) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL)
+    deleted = db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff)).rowcount
+    db.commit()
+    return deleted
+
+
+def _release_waiters(scope_key):
+    future = _in_flight.pop(scope_key, None)
+    if future is not None and not future.done():
+        future.set_result(None)
+
+
+# 取得 key 的執行權（回傳 (attempt, None)）或已完成的結果快照（(None, 快照)）
+async def _acquire(username: str, key: str, request_hash: str):
+    scope_key = (username, key)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+        stored = response_cache.get(scope_key)
+        if stored is not None:
+            return None, stored
+
+        waiter = _in_flight.get(scope_key)
+        if waiter is not None:
+            await asyncio.shield(waiter)
+            continue
+
+        _in_flight[scope_key] = asyncio.get_running_loop().create_future()
+        try:
+            attempt, stored = await run_in_threadpool(_db_claim, username, key, request_hash)
+        except BaseException:
+            _release_waiters(scope_key)
+            raise
+        if stored is None:
+            return attempt, None
+
+        _release_waiters(scope_key)
+        if stored["status_code"] is not None:
+            response_cache.set(scope_key, stored)
+            return None, stored
+        # 原始請求正在其他 worker process 上執行
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+
+async def _send_json(send, status_code: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": status_code, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _replay(send, stored: dict):
+    headers = [(b"idempotent-replayed", b"true")]
+    if stored["content_type"]:
+        headers.append((b"content-type", stored["content_type"].encode("latin-1")))
+    await send({"type": "http.response.start", "status": stored["status_code"], "headers": headers})
+    await send({"type": "http.response.body", "body": (stored["body"] or "").encode()})
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        key = headers.get(HEADER)
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        if not key or not authorization.lower().startswith("bearer "):
+            return await self.app(scope, receive, send)
+        key = key.decode("latin-1")
+        if len(key) > MAX_KEY_LENGTH:
+            return await _send_json(send, 400, f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+        try:
+            username = decode_username(authorization[7:])
+        except HTTPException:
+            # token 無效，交給端點本身回 401
+            return await self.app(scope, receive, send)
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+        request_hash = _fingerprint(scope["method"], scope["path"], body)
+
+        try:
+            attempt, stored = await _acquire(username, key, request_hash)
+        except HTTPException as e:
+            return await _send_json(send, e.status_code, e.detail)
+        if stored is not None:
+            if stored["request_hash"] != request_hash:
+                return await _send_json(send, 422, "Idempotency-Key was already used with a different request")
+            return await _replay(send, stored)
+
+        await self._run_once(scope, body, send, username, key, attempt, request_hash)
+
+    async def _run_once(self, scope, body, send, username, key, attempt, request_hash):
+        scope_key = (username, key)
+        response = {"status_code": None, "content_type": None, "chunks": []}
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if body_sent:
+                return {"type": "http.disconnect"}
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                response["status_code"] = message["status"]
+                for name, value in message.get("headers", []):
+                    if name.lower() == b"content-type":
+                        response["content_type"] = value.decode("latin-1")
+            elif message["type"] == "http.response.body":
+                response["chunks"].append(message.get("body", b""))
+            await send(message)
+
+        stored = None
+        release = False
+        token = _claim.set((username, key, attempt))
+        try:
+            await self.app(scope, replay_receive, capture_send)
+            status_code = response["status_code"]
+            if status_code is not None and 400 <= status_code < 500:
+                release = True
+            elif status_code is not None:
+                stored = {
+                    "request_hash": request_hash,
+                    "status_code": status_code,
+                    "content_type": response["content_type"],
+                    "body": b"".join(response["chunks"]).decode(),
+                }
+        except Exception:
+            if not body_sent:
+                # 端點還沒讀到 body 就失敗，不可能動到帳
+                release = True
+            elif response["status_code"] is None:
+                # 未處理的例外：外層回 500，無法確定帳是否已動，比照 5xx 保存
+                stored = {
+                    "request_hash": request_hash,
+                    "status_code": 500,
+                    "content_type": "text/plain; charset=utf-8",
+                    "body": "Internal Server Error",
+                }
+            raise
+        finally:
+            _claim.reset(token)
+            try:
+                if stored is not None:
+                    if await run_in_threadpool(_db_complete, username, key, attempt, stored):
+                        response_cache.set(scope_key, stored)
+                elif release:
+                    await run_in_threadpool(_db_release, username, key, attempt)
+                # 其餘情況（回應送到一半失敗、連線中斷被取消）保留處理中的紀錄，租約過後由重送接手
+            finally:
+                _release_waiters(scope_key)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] != ["purge"]:
+        sys.exit("usage: python idempotency.py purge")
+    session = SessionLocal()
+    try:
+        print(f"purged {purge_expired(session)} expired idempotency keys")
+    finally:
+        session.close()
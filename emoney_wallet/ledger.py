@@ -0,0 +1,280 @@
+import itertools
+from datetime import datetime
+from typing import NamedTuple
+from sqlalchemy import update, insert, delete, select, func, bindparam
+from sqlalchemy.orm import Session
+from models import Wallet, WalletSlot, Transaction
+from storage import dialect_insert
+from config import MERCHANT_WALLET_SLOTS
+import merchant_stats
+import webhooks
+import idempotency
+
+
+class LedgerError(Exception):
+    pass
+
+
+class InsufficientFunds(LedgerError):
+    pass
+
+
+class WalletNotFound(LedgerError):
+    # side: "from" 付款方 / "to" 收款方
+    def __init__(self, side: str):
+        super().__init__(f"{side} wallet not found")
+        self.side = side
+
+
+class RefundExceedsCharge(LedgerError):
+    pass
+
+
+class Posting(NamedTuple):
+    transaction_id: int
+    from_balance: float
+    to_balance: float
+
+
+# 條件式扣款：餘額檢查與扣款在同一個 UPDATE 內完成，不會有 lost update
+def _debit(db: Session, user_id: int, amount: float):
+    return db.execute(
+        update(Wallet)
+        .where(Wallet.user_id == user_id, Wallet.balance >= amount)
+        .values(balance=Wallet.balance - amount)
+        .returning(Wallet.balance)
+        .execution_options(synchronize_session=False)
+    ).scalars().first()
+
+
+def _credit(db: Session, user_id: int, amount: float):
+    return db.execute(
+        update(Wallet)
+        .where(Wallet.user_id == user_id)
+        .values(balance=Wallet.balance + amount)
+        .returning(Wallet.balance)
+        .execution_options(synchronize_session=False)
+    ).scalars().first()
+
+
+# 錢包總餘額（主錢包 + 分片），錢包不存在時查無資料
+def balance_statement(user_id: int):
+    slots = select(func.coalesce(func.sum(WalletSlot.balance), 0.0)).where(WalletSlot.user_id == user_id).scalar_subquery()
+    return select(Wallet.balance + slots).where(Wallet.user_id == user_id)
+
+
+def balance_of(db: Session, user_id: int):
+    balance = db.execute(balance_statement(user_id)).scalar()
+    return None if balance is None else float(balance)
+
+
+_slot_counter = itertools.count()
+
+
+# 商戶收款入帳：輪流寫入其中一個分片（upsert），不鎖主錢包列；回傳總餘額
+def _credit_slot(db: Session, user_id: int, amount: float):
+    if db.execute(select(Wallet.id).where(Wallet.user_id == user_id)).first() is None:
+        return None
+    insert = dialect_insert(db)
+    stmt = insert(WalletSlot).values(user_id=user_id, slot=next(_slot_counter) % MERCHANT_WALLET_SLOTS, balance=amount)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[WalletSlot.user_id, WalletSlot.slot],
+        set_={"balance": WalletSlot.balance + stmt.excluded.balance},
+    ))
+    return balance_of(db, user_id)
+
+
+# 把使用者的分片併回主錢包，回傳是否有分片
+def _fold_slots(db: Session, user_id: int) -> bool:
+    amounts = db.execute(
+        delete(WalletSlot).where(WalletSlot.user_id == user_id).returning(WalletSlot.balance)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    if not amounts:
+        return False
+    _credit(db, user_id, sum(amounts))
+    return True
+
+
+# 主錢包餘額不足時，先併入分片再扣一次（商戶退款、商戶付款）
+def _debit_or_fold(db: Session, user_id: int, amount: float):
+    balance = _debit(db, user_id, amount)
+    if balance is None and _fold_slots(db, user_id):
+        balance = _debit(db, user_id, amount)
+    return balance
+
+
+def _insert_transaction(db: Session, from_user_id: int, to_user_id: int, amount: float, tx_type: str, timestamp: datetime, **fields):
+    return db.execute(
+        insert(Transaction)
+        .values(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            amount=amount,
+            type=tx_type,
+            timestamp=timestamp,
+            **fields
+        )
+        .returning(Transaction.id)
+    ).scalar_one()
+
+
+# 在目前的 DB transaction 內完成一筆轉帳（不 commit），失敗時丟出 LedgerError，由呼叫端 rollback。
+# 兩個錢包依 user_id 由小到大更新，固定鎖定順序避免互相等待造成 deadlock。
+def apply_posting(db: Session, from_user_id: int, to_user_id: int, amount: float, tx_type: str, **fields) -> Posting:
+    balances = {}
+    for user_id, side in sorted([(from_user_id, "from"), (to_user_id, "to")]):
+        if side == "from":
+            balance = _debit_or_fold(db, user_id, amount)
+            if balance is None:
+                exists = db.execute(select(Wallet.id).where(Wallet.user_id == user_id)).first()
+                if exists is None:
+                    raise WalletNotFound("from")
+                raise InsufficientFunds()
+            if MERCHANT_WALLET_SLOTS > 1:
+                balance = balance_of(db, user_id)
+        elif tx_type == "charge" and MERCHANT_WALLET_SLOTS > 1:
+            balance = _credit_slot(db, user_id, amount)
+            if balance is None:
+                raise WalletNotFound("to")
+        else:
+            balance = _credit(db, user_id, amount)
+            if balance is None:
+                raise WalletNotFound("to")
+        # SQLite 的 RETURNING 可能回傳未套用欄位型別的整數值
+        balances[side] = float(balance)
+
+    now = datetime.utcnow()
+    tx_id = _insert_transaction(db, from_user_id, to_user_id, amount, tx_type, now, **fields)
+    merchant_stats.record(db, tx_type, from_user_id, to_user_id, amount, now)
+    webhooks.record(db, tx_type, from_user_id, to_user_id, amount, tx_id, now, fields.get("original_transaction_id"))
+    idempotency.record_posting(db, tx_id)
+    return Posting(tx_id, balances["from"], balances["to"])
+
+
+def apply_deposit(db: Session, user_id: int, amount: float) -> Posting:
+    balance = _credit(db, user_id, amount)
+    if balance is None:
+        raise WalletNotFound("to")
+    tx_id = _insert_transaction(db, user_id, user_id, amount, "deposit", datetime.utcnow())
+    idempotency.record_posting(db, tx_id)
+    return Posting(tx_id, float(balance), float(balance))
+
+
+# 浮點金額累加的容許誤差
+_EPSILON = 1e-9
+
+
+# 針對原始 charge 退款（可部分、多次）。先以條件式 UPDATE 累加 charge 的 refunded_amount，
+# 超過原始金額時不會更新任何列；與扣款、入帳、refund 紀錄在同一個 transaction 內完成。
+def apply_refund(db: Session, charge_id: int, merchant_id: int, customer_id: int, amount: float) -> Posting:
+    refunded = func.coalesce(Transaction.refunded_amount, 0)
+    reserved = db.execute(
+        update(Transaction)
+        .where(
+            Transaction.id == charge_id,
+            Transaction.type == "charge",
+            refunded + amount <= Transaction.amount + _EPSILON,
+        )
+        .values(refunded_amount=refunded + amount)
+        .returning(Transaction.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if reserved is None:
+        raise RefundExceedsCharge()
+
+    return apply_posting(db, merchant_id, customer_id, amount, "refund", original_transaction_id=charge_id)
+
+
+# 批次入帳：同一條 UPDATE 以 executemany 套用到多個錢包（用 Table 而非 ORM entity，避免走 ORM 依主鍵的 bulk update）
+_wallets = Wallet.__table__
+_bulk_credit = (
+    update(_wallets)
+    .where(_wallets.c.user_id == bindparam("credit_user_id"))
+    .values(balance=_wallets.c.balance + bindparam("credit_amount"))
+)
+
+
+# 一對多批次轉帳：付款方只扣款一次（總額），收款方以批次 UPDATE 入帳，交易紀錄批次寫入。
+# credits 為 [(to_user_id, amount), ...]，回傳 (依 credits 順序的交易 id, 付款方新餘額)。
+# 錢包一樣依 user_id 由小到大更新；呼叫端需先確認所有收款方錢包存在。
+def apply_batch(db: Session, from_user_id: int, credits, tx_type: str = "transfer"):
+    per_user = {}
+    for user_id, amount in credits:
+        per_user[user_id] = per_user.get(user_id, 0.0) + amount
+    total = sum(per_user.values())
+
+    ordered = sorted(per_user.items())
+    lower = [{"credit_user_id": u, "credit_amount": a} for u, a in ordered if u < from_user_id]
+    higher = [{"credit_user_id": u, "credit_amount": a} for u, a in ordered if u >= from_user_id]
+
+    if lower:
+        db.execute(_bulk_credit, lower)
+    balance = _debit_or_fold(db, from_user_id, total)
+    if balance is None:
+        exists = db.execute(select(Wallet.id).where(Wallet.user_id == from_user_id)).first()
+        if exists is None:
+            raise WalletNotFound("from")
+        raise InsufficientFunds()
+    if higher:
+        db.execute(_bulk_credit, higher)
+
+    now = datetime.utcnow()
+    rows = [
+        {"from_user_id": from_user_id, "to_user_id": user_id, "amount": amount, "type": tx_type, "timestamp": now}
+        for user_id, amount in credits
+    ]
+    tx_ids = db.execute(
+        insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+
+    # 付款方同時也是收款方（扣款後又有入帳）或有分片時，重新讀一次總餘額
+    if from_user_id in per_user or MERCHANT_WALLET_SLOTS > 1:
+        balance = balance_of(db, from_user_id)
+    return tx_ids, float(balance)
+
+
+# 把所有分片併回主錢包（sweeper 定期呼叫），一個 transaction 內完成，回傳併回的錢包數
+def sweep_slots(db: Session) -> int:
+    try:
+        rows = db.execute(
+            delete(WalletSlot).returning(WalletSlot.user_id, WalletSlot.balance)
+            .execution_options(synchronize_session=False)
+        ).all()
+        per_user = {}
+        for user_id, amount in rows:
+            per_user[user_id] = per_user.get(user_id, 0.0) + amount
+        if per_user:
+            db.execute(_bulk_credit, [{"credit_user_id": u, "credit_amount": a} for u, a in sorted(per_user.items())])
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return len(per_user)
+
+
+def _commit_or_rollback(db: Session, apply, *args, **kwargs):
+    try:
+        posting = apply(db, *args, **kwargs)
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return posting
+
+
+# 單筆轉帳 / 儲值 / 退款：一個短 transaction，成功即 commit
+def post(db: Session, from_user_id: int, to_user_id: int, amount: float, tx_type: str, **fields) -> Posting:
+    return _commit_or_rollback(db, apply_posting, from_user_id, to_user_id, amount, tx_type, **fields)
+
+
+def deposit(db: Session, user_id: int, amount: float) -> Posting:
+    return _commit_or_rollback(db, apply_deposit, user_id, amount)
+
+
+def refund(db: Session, charge_id: int, merchant_id: int, customer_id: int, amount: float) -> Posting:
+    return _commit_or_rollback(db, apply_refund, charge_id, merchant_id, customer_id, amount)
+
+
+def post_batch(db: Session, from_user_id: int, credits, tx_type: str = "transfer"):
+    return _commit_or_rollback(db, apply_batch, from_user_id, credits, tx_type)
@@ -1,16 +1,111 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, APIRouter
+from fastapi.responses import PlainTextResponse
 from fastapi.openapi.utils import get_openapi
 from routers.auth import router as auth_router
 from routers.wallet import router as wallet_router
 from routers.merchant import router as merchant_router
 from routers.admin import router as admin_router
+from routers.payments import router as payments_router
+from config import DB_ASYNC, MERCHANT_WALLET_SLOTS, WALLET_SWEEP_INTERVAL, SLOW_REQUEST_SECONDS, PAYMENT_QUEUE, BALANCE_CHECKPOINT_INTERVAL, WEBHOOK_DISPATCH_INTERVAL
+import hashing
+import group_commit
+import payment_queue
+import wallet_sweeper
+import balance_history
+import webhooks
+import velocity
+import db
+import tokens
+from idempotency import IdempotencyMiddleware
+import metrics
+import storage
 
-app = FastAPI()
 
-app.include_router(auth_router, prefix="/auth")
-app.include_router(wallet_router, prefix="/wallet")
-app.include_router(merchant_router, prefix="/merchant")
-app.include_router(admin_router, prefix="/admin")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 補回最近撤銷的 session，重啟後已登出的 access token 仍然無效
+    with db.SessionLocal() as session:
+        tokens.load_denylist(session)
+        # 由最近的轉帳 / 收款補回 velocity 計數
+        velocity.warm_start(session)
+    sweeper = None
+    if MERCHANT_WALLET_SLOTS > 1:
+        sweeper = asyncio.create_task(wallet_sweeper.run(WALLET_SWEEP_INTERVAL))
+    checkpointer = None
+    if BALANCE_CHECKPOINT_INTERVAL is not None:
+        checkpointer = asyncio.create_task(balance_history.run(BALANCE_CHECKPOINT_INTERVAL))
+    dispatcher = None
+    if WEBHOOK_DISPATCH_INTERVAL is not None:
+        dispatcher = asyncio.create_task(webhooks.run(WEBHOOK_DISPATCH_INTERVAL))
+    if PAYMENT_QUEUE:
+        payment_queue.start()
+    yield
+    if sweeper is not None:
+        sweeper.cancel()
+    if checkpointer is not None:
+        checkpointer.cancel()
+    if dispatcher is not None:
+        dispatcher.cancel()
+    payment_queue.shutdown()
+    group_commit.shutdown()
+    hashing.shutdown()
+    if db.async_engine is not None:
+        await db.async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# DB_ASYNC 模式先掛非同步版本；同步 router 只保留沒有非同步版本的端點
+def include_router(router: APIRouter, prefix: str, async_router: APIRouter = None):
+    if DB_ASYNC and async_router is not None:
+        app.include_router(async_router, prefix=prefix)
+        overridden = {(r.path, frozenset(r.methods)) for r in async_router.routes}
+        router = APIRouter(routes=[r for r in router.routes if (r.path, frozenset(r.methods)) not in overridden])
+    app.include_router(router, prefix=prefix)
+
+
+if DB_ASYNC:
+    from routers.async_auth import router as async_auth_router
+    from routers.async_wallet import router as async_wallet_router
+    from routers.async_merchant import router as async_merchant_router
+    from routers.async_admin import router as async_admin_router
+else:
+    async_auth_router = async_wallet_router = async_merchant_router = async_admin_router = None
+
+include_router(auth_router, "/auth", async_auth_router)
+include_router(wallet_router, "/wallet", async_wallet_router)
+include_router(merchant_router, "/merchant", async_merchant_router)
+include_router(admin_router, "/admin", async_admin_router)
+app.include_router(payments_router, prefix="/payments")
+
+# 會動到帳的 POST 支援 Idempotency-Key，客戶端逾時重送不會重複扣款
+app.add_middleware(
+    IdempotencyMiddleware,
+    paths=["/wallet/transfer", "/wallet/deposit", "/merchant/merchant/charge"],
+)
+# 最外層：延遲與 SQL / bcrypt / 連線池等待都要涵蓋整個請求
+app.add_middleware(metrics.MetricsMiddleware, slow_request_seconds=SLOW_REQUEST_SECONDS)
+
+
+# Prometheus scrape 端點
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    pools = storage.pool_stats()
+    hash_stats = hashing.stats()
+    gauges = {
+        "emoney_db_pool_checked_out": ("DB connections currently checked out", [
+            ({"pool": name}, info["checkedout"]) for name, info in pools.items() if "checkedout" in info
+        ]),
+        "emoney_db_pool_size": ("DB connection pool size", [
+            ({"pool": name}, info["size"]) for name, info in pools.items() if "size" in info
+        ]),
+        "emoney_bcrypt_pending": ("bcrypt operations submitted and not finished", [({}, hash_stats["pending"])]),
+        "emoney_bcrypt_queue_depth": ("bcrypt operations waiting for a worker", [({}, hash_stats["queue_depth"])]),
+    }
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
 
 # 自定義 Swagger UI 的 OpenAPI schema → 顯示 Bearer token 欄位
 def custom_openapi():
@@ -0,0 +1,130 @@
+from datetime import date
+from sqlalchemy import delete, select, func, case
+from sqlalchemy.orm import Session
+from models import MerchantDailyStat, Transaction
+from storage import dialect_insert
+import archive
+
+STAT_FIELDS = ["gross_charges", "refunds", "net", "charge_count", "refund_count"]
+
+
+# 由 ledger 在同一個 DB transaction 內呼叫：charge 記在收款商戶，refund 記在退款商戶
+def record(db: Session, tx_type: str, from_user_id: int, to_user_id: int, amount: float, timestamp):
+    if tx_type == "charge":
+        merchant_id, gross, refunds, charge_count, refund_count = to_user_id, amount, 0.0, 1, 0
+    elif tx_type == "refund":
+        merchant_id, gross, refunds, charge_count, refund_count = from_user_id, 0.0, amount, 0, 1
+    else:
+        return
+
+    insert = dialect_insert(db)
+    stmt = insert(MerchantDailyStat).values(
+        merchant_id=merchant_id,
+        day=timestamp.date(),
+        gross_charges=gross,
+        refunds=refunds,
+        net=gross - refunds,
+        charge_count=charge_count,
+        refund_count=refund_count,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MerchantDailyStat.merchant_id, MerchantDailyStat.day],
+        set_={field: getattr(MerchantDailyStat, field) + getattr(stmt.excluded, field) for field in STAT_FIELDS},
+    )
+    db.execute(stmt)
+
+
+# 由 transactions 重新計算彙總（補歷史資料或修正後使用），在一個 transaction 內替換。
+# 已封存的月份不在 transactions 裡，只重算並替換封存邊界（archive.boundary）以後的日期，封存月份的彙總保持原樣
+def rebuild(db: Session) -> int:
+    edge = archive.boundary(db)
+    is_charge = Transaction.type == "charge"
+    merchant_id = case((is_charge, Transaction.to_user_id), else_=Transaction.from_user_id)
+    day = func.date(Transaction.timestamp)
+    gross = func.sum(case((is_charge, Transaction.amount), else_=0.0))
+    refunds = func.sum(case((is_charge, 0.0), else_=Transaction.amount))
+
+    rows = db.execute(
+        select(
+            merchant_id.label("merchant_id"),
+            day.label("day"),
+            gross.label("gross_charges"),
+            refunds.label("refunds"),
+            func.sum(case((is_charge, 1), else_=0)).label("charge_count"),
+            func.sum(case((is_charge, 0), else_=1)).label("refund_count"),
+        )
+        .where(Transaction.type.in_(["charge", "refund"]), *([Transaction.timestamp >= edge] if edge else []))
+        .group_by(merchant_id, day)
+    ).all()
+
+    stale = delete(MerchantDailyStat)
+    if edge is not None:
+        stale = stale.where(MerchantDailyStat.day >= edge.date())
+    db.execute(stale)
+    if rows:
+        db.add_all([
+            MerchantDailyStat(
+                merchant_id=row.merchant_id,
+                day=row.day if isinstance(row.day, date) else date.fromisoformat(row.day),
+                gross_charges=row.gross_charges,
+                refunds=row.refunds,
+                net=row.gross_charges - row.refunds,
+                charge_count=row.charge_count,
+                refund_count=row.refund_count,
+            )
+            for row in rows
+        ])
+    db.commit()
+    return len(rows)
+
+
+# 金額欄位為 float、筆數欄位為 int，沒有資料的期間與總計也維持相同型別
+_ZERO = {field: 0 if field.endswith("_count") else 0.0 for field in STAT_FIELDS}
+
+
+def _zeros() -> dict:
+    return dict(_ZERO)
+
+
+# 依日或月彙總指定期間；讀取的只有該商戶期間內的每日列（依主鍵範圍），與交易筆數無關
+def summary(db: Session, merchant_id: int, start: date, end: date, granularity: str = "day"):
+    rows = db.execute(
+        select(MerchantDailyStat)
+        .where(
+            MerchantDailyStat.merchant_id == merchant_id,
+            MerchantDailyStat.day >= start,
+            MerchantDailyStat.day <= end,
+        )
+        .order_by(MerchantDailyStat.day)
+    ).scalars().all()
+
+    periods = {}
+    totals = _zeros()
+    for row in rows:
+        key = row.day.isoformat() if granularity == "day" else row.day.strftime("%Y-%m")
+        period = periods.setdefault(key, _zeros())
+        for field in STAT_FIELDS:
+            value = getattr(row, field) or _ZERO[field]
+            period[field] += value
+            totals[field] += value
+
+    return {
+        "start_date": start.isoformat(),
+        "end_date": end.isoformat(),
+        "granularity": granularity,
+        "totals": totals,
+        "periods": [{"period": key, **values} for key, values in periods.items()],
+    }
+
+
+if __name__ == "__main__":
+    import sys
+    from db import SessionLocal
+
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python merchant_stats.py rebuild")
+    session = SessionLocal()
+    try:
+        print(f"rebuilt {rebuild(session)} merchant daily rows")
+    finally:
+        session.close()
@@ -0,0 +1,215 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# 觀測數據：每個路由的延遲 histogram 與狀態碼、SQL 次數與時間、bcrypt 時間、連線池等待時間。
+# 請求期間的累計值掛在 ContextVar 上（threadpool 會複製 context，同一個物件照常累加），
+# 請求結束時併入該路由的計數；/metrics 以 Prometheus text format 輸出。
+# 在請求之外執行的工作（group commit writer、sweeper）只計入全域總數。
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("emoney.slow_requests")
+
+
+class RequestStats:
+    __slots__ = ("sql_count", "sql_seconds", "bcrypt_seconds", "pool_wait_seconds")
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+
+
+class _RouteStats:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.status = {}
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+
+    def observe(self, seconds: float, status: int, stats: RequestStats):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.latency_sum += seconds
+        self.status[status] = self.status.get(status, 0) + 1
+        self.sql_count += stats.sql_count
+        self.sql_seconds += stats.sql_seconds
+        self.bcrypt_seconds += stats.bcrypt_seconds
+        self.pool_wait_seconds += stats.pool_wait_seconds
+
+
+_current = ContextVar("emoney_request_stats", default=None)
+_lock = threading.Lock()
+_routes = {}
+_totals = {"sql_count": 0, "sql_seconds": 0.0, "bcrypt_count": 0, "bcrypt_seconds": 0.0}
+_pool_waits = {}
+
+
+def record_sql(seconds: float):
+    with _lock:
+        _totals["sql_count"] += 1
+        _totals["sql_seconds"] += seconds
+    stats = _current.get()
+    if stats is not None:
+        stats.sql_count += 1
+        stats.sql_seconds += seconds
+
+
+def record_bcrypt(seconds: float):
+    with _lock:
+        _totals["bcrypt_count"] += 1
+        _totals["bcrypt_seconds"] += seconds
+    stats = _current.get()
+    if stats is not None:
+        stats.bcrypt_seconds += seconds
+
+
+def record_pool_wait(pool: str, seconds: float):
+    with _lock:
+        waits = _pool_waits.setdefault(pool, [0, 0.0])
+        waits[0] += 1
+        waits[1] += seconds
+    stats = _current.get()
+    if stats is not None:
+        stats.pool_wait_seconds += seconds
+
+
+# 每個 statement 的開始時間記在該次執行的 ExecutionContext 上，失敗的 statement 不會殘留狀態
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        record_sql(time.perf_counter() - started if started is not None else 0.0)
+
+
+# 以路由樣板（/wallet/transaction/{tx_id}）而非實際路徑分組，避免 label 無限增加。
+# include_router 的前綴不在 route.path 上，由實際路徑扣掉樣板套入參數後的結果推回。
+def _route_template(scope) -> str:
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    try:
+        rendered = template.format(**scope.get("path_params", {}))
+    except (KeyError, IndexError, ValueError):
+        return template
+    path = scope["path"]
+    if path.endswith(rendered):
+        return path[:len(path) - len(rendered)] + template
+    return template
+
+
+class MetricsMiddleware:
+    def __init__(self, app, slow_request_seconds: float = None):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def capture_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, capture_send)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            path = _route_template(scope)
+            with _lock:
+                _routes.setdefault((scope["method"], path), _RouteStats()).observe(elapsed, status, stats)
+            if self.slow_request_seconds is not None and elapsed >= self.slow_request_seconds:
+                logger.warning(
+                    "slow request %s %s status=%d total=%.1fms sql=%d/%.1fms bcrypt=%.1fms pool_wait=%.1fms",
+                    scope["method"], scope["path"], status, elapsed * 1000,
+                    stats.sql_count, stats.sql_seconds * 1000,
+                    stats.bcrypt_seconds * 1000, stats.pool_wait_seconds * 1000,
+                )
+
+
+def _labels(**labels) -> str:
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# gauges: {metric 名稱: (說明, [(labels dict, 數值), ...])}，由呼叫端提供目前狀態（連線池、雜湊佇列等）
+def render(gauges: dict = None) -> str:
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_labels(**labels) if labels else ''} {_format(value)}")
+
+    with _lock:
+        routes = sorted(_routes.items())
+        name = "emoney_http_request_duration_seconds"
+        lines.append(f"# HELP {name} HTTP request latency")
+        lines.append(f"# TYPE {name} histogram")
+        for (method, path), route in routes:
+            for bound, count in zip(LATENCY_BUCKETS, route.buckets):
+                lines.append(f"{name}_bucket{_labels(method=method, route=path, le=repr(bound))} {count}")
+            lines.append(f"{name}_bucket{_labels(method=method, route=path, le='+Inf')} {route.count}")
+            lines.append(f"{name}_sum{_labels(method=method, route=path)} {_format(route.latency_sum)}")
+            lines.append(f"{name}_count{_labels(method=method, route=path)} {route.count}")
+
+        family("emoney_http_responses_total", "counter", "HTTP responses by status code", [
+            ({"method": method, "route": path, "status": status}, count)
+            for (method, path), route in routes for status, count in sorted(route.status.items())
+        ])
+        for name, field, help_text in (
+            ("emoney_route_sql_statements_total", "sql_count", "SQL statements executed while serving the route"),
+            ("emoney_route_sql_seconds_total", "sql_seconds", "Time spent in SQL statements while serving the route"),
+            ("emoney_route_bcrypt_seconds_total", "bcrypt_seconds", "Time spent waiting for bcrypt while serving the route"),
+            ("emoney_route_pool_wait_seconds_total", "pool_wait_seconds", "Time spent waiting for a DB connection while serving the route"),
+        ):
+            family(name, "counter", help_text, [
+                ({"method": method, "route": path}, getattr(route, field)) for (method, path), route in routes
+            ])
+
+        family("emoney_sql_statements_total", "counter", "SQL statements executed", [({}, _totals["sql_count"])])
+        family("emoney_sql_seconds_total", "counter", "Time spent in SQL statements", [({}, _totals["sql_seconds"])])
+        family("emoney_bcrypt_operations_total", "counter", "bcrypt hash / verify operations", [({}, _totals["bcrypt_count"])])
+        family("emoney_bcrypt_seconds_total", "counter", "Time spent waiting for bcrypt", [({}, _totals["bcrypt_seconds"])])
+        family("emoney_db_pool_waits_total", "counter", "DB connection checkouts", [
+            ({"pool": pool}, waits[0]) for pool, waits in sorted(_pool_waits.items())
+        ])
+        family("emoney_db_pool_wait_seconds_total", "counter", "Time spent waiting for a DB connection", [
+            ({"pool": pool}, waits[1]) for pool, waits in sorted(_pool_waits.items())
+        ])
+
+    for name, (help_text, samples) in sorted((gauges or {}).items()):
+        family(name, "gauge", help_text, samples)
+    return "\n".join(lines) + "\n"
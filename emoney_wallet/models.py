@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Date, Boolean, Index, Text, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -18,9 +18,17 @@ class User(Base):
 class Wallet(Base):
     __tablename__ = "wallets"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     balance = Column(Float, default=0.0)
 
+# 商戶錢包分片：收款入帳分散到 N 個 slot，避免大商戶的收款都搶同一列 wallets。
+# 錢包實際餘額 = wallets.balance + 該使用者所有 slot 的 balance，由 sweeper 定期併回 wallets
+class WalletSlot(Base):
+    __tablename__ = "wallet_slots"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    slot = Column(Integer, primary_key=True)
+    balance = Column(Float, default=0.0, nullable=False)
+
 class Transaction(Base):
     __tablename__ = "transactions"
     id = Column(Integer, primary_key=True, index=True)
@@ -29,3 +37,143 @@ class Transaction(Base):
     amount = Column(Float)
     timestamp = Column(DateTime, default=datetime.utcnow)
     type = Column(String)
+    # refund 指向原始 charge；charge 記錄目前已退款總額
+    original_transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=True, index=True)
+    refunded_amount = Column(Float, default=0.0, server_default="0")
+
+    # 交易紀錄以 (使用者, 時間, id) 倒序分頁，兩個方向各一組複合索引
+    __table_args__ = (
+        Index("ix_transactions_from_ts", "from_user_id", "timestamp", "id"),
+        Index("ix_transactions_to_ts", "to_user_id", "timestamp", "id"),
+    )
+
+# 商戶每日營收彙總，由 ledger 在記帳的同一個 transaction 內累加（UTC 日期）
+class MerchantDailyStat(Base):
+    __tablename__ = "merchant_daily_stats"
+    merchant_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    gross_charges = Column(Float, default=0.0)
+    refunds = Column(Float, default=0.0)
+    net = Column(Float, default=0.0)
+    charge_count = Column(Integer, default=0)
+    refund_count = Column(Integer, default=0)
+
+# Idempotency-Key：同一使用者的同一個 key 只執行一次，之後回放第一次的回應（4xx 不保存）。
+# status_code 為 NULL 表示原始請求仍在處理中（可能在其他 worker process）；
+# locked_until 為處理中的租約；transaction_id / payment_id 與記帳在同一個 transaction 內寫入，
+# 租約過後的重送據此回放已完成的記帳，或 attempt 加一後接手（原始請求之後的記帳會因 attempt 不符而 rollback）
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    id = Column(Integer, primary_key=True)
+    username = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    request_hash = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    content_type = Column(String, nullable=True)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    locked_until = Column(DateTime, nullable=True)
+    attempt = Column(Integer, nullable=False, default=0, server_default="0")
+    transaction_id = Column(Integer, nullable=True)
+    payment_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("username", "key", name="uq_idempotency_keys_username_key"),
+    )
+
+# Refresh token：只存 token_id 與 secret 的 HMAC；同一次登入換發出的 token 共用 family_id。
+# rotated_at 不為 NULL 表示已換發過，再次使用時撤銷整個 family
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    id = Column(Integer, primary_key=True)
+    token_id = Column(String, unique=True, index=True, nullable=False)
+    family_id = Column(String, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    token_hash = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    rotated_at = Column(DateTime, nullable=True)
+    revoked_at = Column(DateTime, nullable=True, index=True)
+
+# 非同步付款佇列（PAYMENT_QUEUE 模式）：驗證過的轉帳 / 收款請求，由 payment_queue worker 依 id 順序記帳。
+# status: pending / succeeded / failed；結果與記帳在同一個 transaction 內寫回
+class PaymentRequest(Base):
+    __tablename__ = "payment_requests"
+    id = Column(Integer, primary_key=True)
+    type = Column(String, nullable=False)  # transfer / charge
+    requester_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    from_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    to_user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    amount = Column(Float, nullable=False)
+    counterparty = Column(String, nullable=False)  # 回應訊息用的對方帳號
+    status = Column(String, nullable=False, default="pending")
+    transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
+    result = Column(Text, nullable=True)
+    error_status = Column(Integer, nullable=True)
+    error_detail = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_payment_requests_status_id", "status", "id"),
+    )
+
+# 錢包歷史餘額 checkpoint：as_of 時間點（含）以前所有交易的淨額，由 balance_history 背景工作寫入。
+# 主鍵 (user_id, as_of) 同時是「某時間點以前最近一筆」的查詢索引
+class BalanceCheckpoint(Base):
+    __tablename__ = "balance_checkpoints"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    as_of = Column(DateTime, primary_key=True)
+    balance = Column(Float, nullable=False)
+    postings = Column(Integer, nullable=False, default=0)  # 與上一個 checkpoint 之間的交易筆數
+    last_transaction_id = Column(Integer, nullable=False, index=True)  # 寫入時已掃描到的交易 id
+
+# 已封存的月份（月初日期，UTC）與封存檔名（位於 ARCHIVE_DIR）
+class ArchivedMonth(Base):
+    __tablename__ = "archived_months"
+    month = Column(Date, primary_key=True)
+    filename = Column(String, nullable=False)
+    row_count = Column(Integer, nullable=False, default=0)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+# 已封存月份中每位使用者的收支彙總，封存時與刪除熱資料在同一個 transaction 內寫入。
+# incoming 含 deposit；outgoing 不含 deposit（與對帳的計算方式相同）
+class TransactionMonthSummary(Base):
+    __tablename__ = "transaction_month_summaries"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    month = Column(Date, primary_key=True)
+    incoming = Column(Float, nullable=False, default=0.0)
+    outgoing = Column(Float, nullable=False, default=0.0)
+    incoming_count = Column(Integer, nullable=False, default=0)
+    outgoing_count = Column(Integer, nullable=False, default=0)
+
+# 商戶 webhook 端點：每個商戶一個 URL 與簽章用的 secret。
+# 送達失敗時整個端點退避（failures / next_attempt_at），同一商戶的事件維持依序送達；
+# dispatcher 取件時也以 next_attempt_at 當租約，多個 process 不會同時送同一個端點
+class MerchantWebhook(Base):
+    __tablename__ = "merchant_webhooks"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    url = Column(String, nullable=False)
+    secret = Column(String, nullable=False)
+    failures = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Transactional outbox：charge / refund 記帳時在同一個 transaction 內寫入（僅限有設定 webhook 的商戶）。
+# status: pending / delivered / failed（超過重試次數）
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+    id = Column(Integer, primary_key=True)
+    merchant_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    type = Column(String, nullable=False)  # charge.succeeded / refund.succeeded
+    transaction_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    delivered_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbox_events_status_merchant_id", "status", "merchant_id", "id"),
+    )
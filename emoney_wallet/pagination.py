@@ -0,0 +1,122 @@
+import base64
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import Column, select, tuple_, union_all
+from sqlalchemy.sql.visitors import replacement_traverse
+from sqlalchemy.orm import Session
+from models import Transaction
+from user_search import counterparty_matches
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+# 游標 = 最後一筆的 (timestamp, id)，以 base64 包裝避免用戶端自行組字串
+def encode_cursor(tx) -> str:
+    raw = f"{tx.timestamp.isoformat()}|{tx.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        ts, tx_id = raw.split("|")
+        return datetime.fromisoformat(ts), int(tx_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(400, detail="Invalid cursor")
+
+
+# deposit 的付款方與收款方相同，收款方分支排除掉以免重複
+def _sides(user_id: int):
+    return [
+        Transaction.from_user_id == user_id,
+        (Transaction.to_user_id == user_id) & (Transaction.from_user_id != user_id),
+    ]
+
+
+# 以 keyset 分頁查詢使用者相關交易（付款方或收款方），依時間倒序。
+# 付款方與收款方分別走 ix_transactions_from_ts / ix_transactions_to_ts，
+# 各自只取 limit + 1 筆再合併，避免 OR 條件造成全表掃描與排序。
+# 指定 columns 時只查這些欄位（需包含 id 與 timestamp），回傳 Row 而非 ORM 物件。
+# source 為欄位相同的另一張表（封存檔中的 transactions），查詢與篩選條件整個改指向該表，需搭配 columns。
+# 回傳 (本頁交易, 下一頁游標或 None)
+def history_page(db: Session, user_id: int, limit: int, after: str = None, filters=(), columns=None, source=None):
+    key = tuple_(Transaction.timestamp, Transaction.id)
+    order = (Transaction.timestamp.desc(), Transaction.id.desc())
+
+    conditions = list(filters)
+    if after:
+        conditions.append(key < tuple_(*decode_cursor(after)))
+
+    branches = [
+        select(Transaction.id).where(side, *conditions).order_by(*order).limit(limit + 1).subquery()
+        for side in _sides(user_id)
+    ]
+    ids = union_all(*[select(branch.c.id) for branch in branches])
+
+    stmt = (
+        select(*(columns or (Transaction,)))
+        .where(Transaction.id.in_(ids))
+        .order_by(*order)
+        .limit(limit + 1)
+    )
+    if source is not None:
+        stmt = retarget(stmt, source)
+    result = db.execute(stmt)
+    rows = result.all() if columns else result.scalars().all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+# 把查詢中 transactions 表與其欄位換成 source（同欄位的表），其他表（users 等）不變
+def retarget(stmt, source):
+    table = Transaction.__table__
+
+    def replace(element):
+        if element is table or getattr(element, "_deannotate", lambda: None)() is table:
+            return source
+        if isinstance(element, Column) and element.table is table:
+            return source.c[element.name]
+        return None
+
+    return replacement_traverse(stmt, {}, replace)
+
+
+# 使用者全部相關交易（只取指定欄位）依時間倒序的查詢。
+# 兩個分支各自依索引排序，UNION ALL 後由資料庫做 merge，不需要暫存排序，適合串流匯出。
+def history_statement(user_id: int, columns, filters=()):
+    stmt = union_all(*[select(*columns).where(side, *filters) for side in _sides(user_id)])
+    return stmt.order_by(stmt.selected_columns.timestamp.desc(), stmt.selected_columns.id.desc())
+
+
+# 交易紀錄的篩選條件，/records、匯出與非同步版本共用
+def record_filters(user_id: int, type: str = None, start_date: str = None, end_date: str = None, keyword: str = None):
+    filters = []
+
+    # 交易類型過濾
+    if type:
+        filters.append(Transaction.type == type)
+
+    # 時間過濾
+    if start_date:
+        try:
+            start = datetime.strptime(start_date, "%Y-%m-%d")
+            filters.append(Transaction.timestamp >= start)
+        except:
+            raise HTTPException(400, detail="start_date 格式錯誤")
+
+    if end_date:
+        try:
+            end = datetime.strptime(end_date, "%Y-%m-%d")
+            filters.append(Transaction.timestamp <= end)
+        except:
+            raise HTTPException(400, detail="end_date 格式錯誤")
+
+    # 關鍵字搜尋對方 username（子查詢，不再把符合的 id 全部撈回來組 IN 清單）
+    if keyword:
+        filters.append(counterparty_matches(user_id, keyword))
+
+    return filters
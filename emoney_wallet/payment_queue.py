@@ -0,0 +1,250 @@
+import asyncio
+import json
+import logging
+import threading
+from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session, sessionmaker
+import db
+import ledger
+import idempotency
+import storage
+import velocity
+from models import PaymentRequest
+from config import PAYMENT_QUEUE_WORKERS, PAYMENT_QUEUE_BATCH, PAYMENT_QUEUE_POLL_INTERVAL, PAYMENT_LONG_POLL_MAX
+
+# 非同步付款佇列（PAYMENT_QUEUE 模式）：轉帳與商戶收款在請求端只做驗證，寫入 payment_requests 後回 202，
+# worker thread 依 id 順序每次取一批，在同一個 transaction 內逐筆以 SAVEPOINT 套用 ledger.apply_posting
+# 並寫回結果，一批 commit 一次。取件與記帳同在一個 transaction，worker 中途當掉時整批維持 pending，
+# 重啟後重新處理，不會重複記帳。SQLite 上各 worker 以 BEGIN IMMEDIATE 排隊，PostgreSQL 上以 SKIP LOCKED 分批。
+# /payments/{id} 可 long-poll：同一個 process 的 worker 完成時直接喚醒，其他 process 寫入的結果靠輪詢看到。
+
+logger = logging.getLogger(__name__)
+
+# 記帳失敗對應的 HTTP 狀態與訊息，與同步端點一致
+_ERRORS = {
+    "transfer": {"funds": "Insufficient balance", "from": "Sender wallet not found", "to": "Recipient wallet not found"},
+    "charge": {"funds": "Insufficient balance in payer's wallet", "from": "Payer wallet not found", "to": "Merchant wallet not found"},
+}
+
+_workers = []
+_stop = threading.Event()
+_wakeup = threading.Event()
+_lock = threading.Lock()
+_waiters = {}
+_stats = {"batches": 0, "processed": 0, "succeeded": 0, "failed": 0, "errors": 0, "max_batch": 0}
+
+
+# 請求端：寫入佇列並 commit，回傳 payment id。
+# reservation 為 velocity.limit 的計數，在 commit（worker 可能立即取件）之前依 payment id 保留
+def enqueue(db: Session, tx_type: str, requester_id: int, from_user_id: int, to_user_id: int, amount: float, counterparty: str, reservation=None) -> int:
+    payment = PaymentRequest(
+        type=tx_type,
+        requester_id=requester_id,
+        from_user_id=from_user_id,
+        to_user_id=to_user_id,
+        amount=amount,
+        counterparty=counterparty,
+        status="pending",
+    )
+    db.add(payment)
+    db.flush()
+    payment_id = payment.id
+    idempotency.record_payment(db, payment_id)
+    velocity.hold(payment_id, reservation)
+    db.commit()
+    _wakeup.set()
+    return payment_id
+
+
+def accepted_response(payment_id: int) -> JSONResponse:
+    location = f"/payments/{payment_id}"
+    return JSONResponse(
+        status_code=202,
+        content={"payment_id": payment_id, "status": "pending", "status_url": location},
+        headers={"Location": location},
+    )
+
+
+def _result(payment: PaymentRequest, posting: ledger.Posting) -> dict:
+    if payment.type == "charge":
+        return {"message": f"Charged {payment.amount} from {payment.counterparty}", "new_merchant_balance": posting.to_balance}
+    return {"message": f"Transferred {payment.amount} to {payment.counterparty}", "new_balance": posting.from_balance}
+
+
+def _error(payment: PaymentRequest, error: ledger.LedgerError):
+    messages = _ERRORS[payment.type]
+    if isinstance(error, ledger.WalletNotFound):
+        return 404, messages[error.side]
+    if isinstance(error, ledger.InsufficientFunds):
+        return 400, messages["funds"]
+    return 400, str(error) or type(error).__name__
+
+
+def _apply_batch(session: Session) -> list:
+    payments = session.execute(
+        select(PaymentRequest)
+        .where(PaymentRequest.status == "pending")
+        .order_by(PaymentRequest.id)
+        .limit(PAYMENT_QUEUE_BATCH)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+
+    counts = {"succeeded": 0, "failed": 0}
+    for payment in payments:
+        savepoint = session.begin_nested()
+        try:
+            posting = ledger.apply_posting(session, payment.from_user_id, payment.to_user_id, payment.amount, payment.type)
+            savepoint.commit()
+        except ledger.LedgerError as e:
+            savepoint.rollback()
+            payment.status = "failed"
+            payment.error_status, payment.error_detail = _error(payment, e)
+        else:
+            payment.status = "succeeded"
+            payment.transaction_id = posting.transaction_id
+            payment.result = json.dumps(_result(payment, posting))
+        payment.processed_at = datetime.utcnow()
+        counts[payment.status] += 1
+    session.commit()
+    if not payments:
+        return []
+
+    # 結果 commit 後才處理 velocity 計數：失敗的退回，成功的不再保留
+    velocity.settle(
+        [payment.id for payment in payments if payment.status == "failed"],
+        [payment.id for payment in payments if payment.status == "succeeded"],
+    )
+
+    with _lock:
+        _stats["batches"] += 1
+        _stats["processed"] += len(payments)
+        _stats["succeeded"] += counts["succeeded"]
+        _stats["failed"] += counts["failed"]
+        _stats["max_batch"] = max(_stats["max_batch"], len(payments))
+    return [payment.id for payment in payments]
+
+
+def _run(session_factory):
+    while not _stop.is_set():
+        # 先清掉喚醒旗標，處理期間新進的請求會讓下一次 wait 立即返回
+        _wakeup.clear()
+        session = session_factory()
+        try:
+            done = _apply_batch(session)
+        except Exception:
+            # 整批 rollback，維持 pending，下一輪重試
+            session.rollback()
+            done = []
+            with _lock:
+                _stats["errors"] += 1
+            logger.exception("payment queue batch failed")
+        finally:
+            session.close()
+
+        if done:
+            _notify(done)
+            if len(done) >= PAYMENT_QUEUE_BATCH:
+                continue
+        _wakeup.wait(PAYMENT_QUEUE_POLL_INTERVAL)
+
+
+def start():
+    if _workers:
+        return
+    _stop.clear()
+    engine = storage.create_writer_engine(db.engine, "payment_queue", pool_size=PAYMENT_QUEUE_WORKERS)
+    session_factory = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    for i in range(PAYMENT_QUEUE_WORKERS):
+        worker = threading.Thread(target=_run, args=(session_factory,), name=f"payment-queue-{i}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+
+# 停止 worker；進行中的批次會先完成，尚未處理的請求留在佇列中
+def shutdown():
+    _stop.set()
+    _wakeup.set()
+    for worker in _workers:
+        worker.join()
+    _workers.clear()
+
+
+# worker 完成後喚醒同一個 process 內等待這些 payment 的 long-poll 請求
+def _notify(payment_ids):
+    with _lock:
+        events = [waiter for payment_id in payment_ids for waiter in _waiters.pop(payment_id, ())]
+    for loop, event in events:
+        loop.call_soon_threadsafe(event.set)
+
+
+def _load(payment_id: int):
+    session = db.ReadSessionLocal()
+    try:
+        return session.get(PaymentRequest, payment_id)
+    finally:
+        session.close()
+
+
+# 讀取 user_id 可查看（發起方、付款方或收款方）的付款狀態；wait > 0 時在仍為 pending 的情況下最多等待 wait 秒。
+# 查無或無權查看時不等待，一律回傳 None，不洩漏 payment id 是否存在
+async def wait_for(payment_id: int, wait: float, user_id: int):
+    payment = await run_in_threadpool(_load, payment_id)
+    if payment is None or user_id not in (payment.requester_id, payment.from_user_id, payment.to_user_id):
+        return None
+    if payment.status != "pending" or wait <= 0:
+        return payment
+
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    waiter = (loop, event)
+    with _lock:
+        _waiters.setdefault(payment_id, []).append(waiter)
+    try:
+        deadline = loop.time() + min(wait, PAYMENT_LONG_POLL_MAX)
+        while True:
+            payment = await run_in_threadpool(_load, payment_id)
+            remaining = deadline - loop.time()
+            if payment is None or payment.status != "pending" or remaining <= 0:
+                return payment
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, PAYMENT_QUEUE_POLL_INTERVAL * 5))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        with _lock:
+            waiters = _waiters.get(payment_id)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del _waiters[payment_id]
+
+
+def status_response(payment: PaymentRequest) -> dict:
+    return {
+        "payment_id": payment.id,
+        "type": payment.type,
+        "status": payment.status,
+        "amount": payment.amount,
+        "from_user_id": payment.from_user_id,
+        "to_user_id": payment.to_user_id,
+        "transaction_id": payment.transaction_id,
+        "result": json.loads(payment.result) if payment.result else None,
+        "error": {"status_code": payment.error_status, "detail": payment.error_detail} if payment.status == "failed" else None,
+        "created_at": payment.created_at,
+        "processed_at": payment.processed_at,
+    }
+
+
+def stats() -> dict:
+    session = db.ReadSessionLocal()
+    try:
+        pending = session.execute(
+            select(func.count()).select_from(PaymentRequest).where(PaymentRequest.status == "pending")
+        ).scalar_one()
+    finally:
+        session.close()
+    with _lock:
+        return {"running": bool(_workers), "workers": len(_workers), "pending": pending, "waiters": len(_waiters), **_stats}
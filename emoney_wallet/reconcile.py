@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sqlalchemy import create_engine, func, select
+import storage
+from models import ArchivedMonth, Transaction, TransactionMonthSummary, Wallet, WalletSlot
+from config import (
+    DATABASE_URL, RECONCILE_CHUNK_SIZE, RECONCILE_WORKERS, RECONCILE_CHECKPOINT_PATH, RECONCILE_TOLERANCE,
+)
+
+# 帳務對帳：由 transactions 重算每個錢包應有的餘額，與 wallets.balance + wallet_slots 比對。
+#   應有餘額 = 收款方為本人的金額總和 − 付款方為本人的金額總和（deposit 的付款方也是本人，只算入帳）
+# 先在同一個 statement 內讀出所有錢包餘額與目前最大的交易 id（同一個 snapshot），
+# 再依 user id 區間分給 process pool，各自以索引串流該區間的交易、用 NumPy bincount 分組加總。
+# 結果（各使用者應有餘額與已掃描到的交易 id）寫入 checkpoint，下次只需掃描之後新增的交易。
+# 已封存的月份不在 transactions 裡，全部重算時改加 transaction_month_summaries 的收支；
+# checkpoint 記下當時的封存月份，封存過新月份後自動改為全部重算。
+#
+#   python reconcile.py                # 從 checkpoint 接續
+#   python reconcile.py --full         # 忽略 checkpoint 全部重算
+#
+# 有錢包偏離時 exit code 為 1。
+
+_RANGES_PER_WORKER = 4
+
+
+def _engine(url: str):
+    kwargs = {"connect_args": {"check_same_thread": False}} if url.startswith("sqlite") else {}
+    return storage.configure_sqlite(create_engine(url, **kwargs), name="reconcile", read_only=True)
+
+
+# 子 process：[lo, hi) 區間內每個使用者在 (after_id, through_id] 之間的淨額與交易筆數
+def _scan_range(url: str, lo: int, hi: int, after_id: int, through_id: int, chunk_size: int):
+    size = hi - lo
+    sums = np.zeros(size, dtype=np.float64)
+    counts = np.zeros(size, dtype=np.int64)
+    engine = _engine(url)
+    try:
+        with engine.connect() as conn:
+            sides = (
+                (Transaction.to_user_id, 1.0, ()),
+                (Transaction.from_user_id, -1.0, (Transaction.type != "deposit",)),
+            )
+            for column, sign, extra in sides:
+                result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(
+                    select(column, func.coalesce(Transaction.amount, 0.0))
+                    .where(column >= lo, column < hi, Transaction.id > after_id, Transaction.id <= through_id, *extra)
+                )
+                for rows in result.partitions():
+                    chunk = np.array(rows, dtype=np.float64)
+                    index = chunk[:, 0].astype(np.int64) - lo
+                    sums += sign * np.bincount(index, weights=chunk[:, 1], minlength=size)
+                    counts += np.bincount(index, minlength=size)
+    finally:
+        engine.dispose()
+    return lo, sums, counts
+
+
+# 所有錢包的實際餘額（含分片）與最大交易 id，同一個 statement 讀出以確保是同一個時間點
+def _snapshot(engine, chunk_size: int):
+    slots = (
+        select(WalletSlot.user_id, func.sum(WalletSlot.balance).label("balance"))
+        .group_by(WalletSlot.user_id)
+        .subquery()
+    )
+    through_id = select(func.coalesce(func.max(Transaction.id), 0)).scalar_subquery()
+    stmt = (
+        select(Wallet.user_id, Wallet.balance + func.coalesce(slots.c.balance, 0.0), through_id)
+        .outerjoin(slots, slots.c.user_id == Wallet.user_id)
+    )
+    user_ids, balances, high = [], [], None
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(stmt)
+        for rows in result.partitions():
+            chunk = np.array([(user_id, balance or 0.0) for user_id, balance, _ in rows], dtype=np.float64)
+            user_ids.append(chunk[:, 0].astype(np.int64))
+            balances.append(chunk[:, 1])
+            high = rows[-1][2]
+        if high is None:
+            high = conn.execute(select(through_id)).scalar_one()
+    user_ids = np.concatenate(user_ids) if user_ids else np.zeros(0, dtype=np.int64)
+    balances = np.concatenate(balances) if balances else np.zeros(0, dtype=np.float64)
+    return user_ids, balances, int(high)
+
+
+# 已封存月份數與各使用者在封存期間的淨額
+def _archived(engine):
+    with engine.connect() as conn:
+        months = conn.execute(select(func.count()).select_from(ArchivedMonth)).scalar_one()
+        rows = conn.execute(
+            select(
+                TransactionMonthSummary.user_id,
+                func.sum(TransactionMonthSummary.incoming - TransactionMonthSummary.outgoing),
+            ).group_by(TransactionMonthSummary.user_id)
+        ).all()
+    user_ids = np.array([user_id for user_id, _ in rows], dtype=np.int64)
+    net = np.array([total or 0.0 for _, total in rows], dtype=np.float64)
+    return months, user_ids, net
+
+
+def load_checkpoint(path: str):
+    if not path or not os.path.exists(path):
+        return 0, 0, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    with np.load(path) as data:
+        months = int(data["archived_months"]) if "archived_months" in data else 0
+        return int(data["through_id"]), months, data["user_ids"], data["expected"]
+
+
+# 先寫暫存檔再 rename，中斷時不會留下寫一半的 checkpoint
+def save_checkpoint(path: str, through_id: int, archived_months: int, expected: np.ndarray):
+    user_ids = np.flatnonzero(expected)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(
+            f, through_id=np.int64(through_id), archived_months=np.int64(archived_months),
+            user_ids=user_ids, expected=expected[user_ids],
+        )
+    os.replace(tmp, path)
+
+
+def _ranges(max_user_id: int, parts: int):
+    width = max(1, -(-(max_user_id + 1) // parts))
+    return [(lo, min(lo + width, max_user_id + 1)) for lo in range(0, max_user_id + 1, width)]
+
+
+def run(url: str = DATABASE_URL, checkpoint: str = RECONCILE_CHECKPOINT_PATH, full: bool = False,
+        workers: int = RECONCILE_WORKERS, chunk_size: int = RECONCILE_CHUNK_SIZE,
+        tolerance: float = RECONCILE_TOLERANCE) -> dict:
+    started = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+
+    engine = _engine(url)
+    try:
+        wallet_ids, balances, through_id = _snapshot(engine, chunk_size)
+        archived_months, archived_ids, archived_net = _archived(engine)
+    finally:
+        engine.dispose()
+
+    after_id, checkpoint_months, checkpoint_ids, checkpoint_expected = load_checkpoint(None if full else checkpoint)
+    if after_id > through_id or checkpoint_months != archived_months:
+        # checkpoint 比資料庫新（例如資料庫被還原）或之後又封存過，整份重算
+        after_id, checkpoint_months, checkpoint_ids, checkpoint_expected = load_checkpoint(None)
+    if not after_id:
+        checkpoint_ids, checkpoint_expected = archived_ids, archived_net
+
+    max_user_id = int(max(wallet_ids.max(initial=0), checkpoint_ids.max(initial=0)))
+    expected = np.zeros(max_user_id + 1, dtype=np.float64)
+    expected[checkpoint_ids] = checkpoint_expected
+    scanned = np.zeros(max_user_id + 1, dtype=np.int64)
+
+    if through_id > after_id:
+        ranges = _ranges(max_user_id, workers * _RANGES_PER_WORKER)
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+            futures = [pool.submit(_scan_range, url, lo, hi, after_id, through_id, chunk_size) for lo, hi in ranges]
+            for future in futures:
+                lo, sums, counts = future.result()
+                expected[lo:lo + len(sums)] += sums
+                scanned[lo:lo + len(counts)] += counts
+
+    actual = np.full(max_user_id + 1, np.nan)
+    actual[wallet_ids] = balances
+    has_wallet = ~np.isnan(actual)
+    drift = np.where(has_wallet, actual - expected, -expected)
+    drifted = np.flatnonzero(
+        (has_wallet & (np.abs(drift) > tolerance * np.maximum(1.0, np.abs(expected))))
+        | (~has_wallet & (expected != 0))
+    )
+
+    if checkpoint:
+        save_checkpoint(checkpoint, through_id, archived_months, expected)
+
+    return {
+        "through_transaction_id": through_id,
+        "scanned_after_id": after_id,
+        "rows_scanned": int(scanned.sum()),
+        "users_with_new_transactions": int(np.count_nonzero(scanned)),
+        "wallets": int(len(wallet_ids)),
+        "drift_count": int(len(drifted)),
+        "total_drift": round(float(np.abs(drift[drifted]).sum()), 6),
+        "drifted": [
+            {
+                "user_id": int(user_id),
+                "expected": round(float(expected[user_id]), 6),
+                "actual": round(float(actual[user_id]), 6) if has_wallet[user_id] else None,
+                "drift": round(float(drift[user_id]), 6),
+            }
+            for user_id in drifted
+        ],
+        "workers": workers,
+        "elapsed_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python reconcile.py", description="錢包餘額與交易紀錄對帳")
+    parser.add_argument("--full", action="store_true", help="忽略 checkpoint，從第一筆交易重算")
+    parser.add_argument("--checkpoint", default=RECONCILE_CHECKPOINT_PATH, help="checkpoint 檔路徑")
+    parser.add_argument("--no-checkpoint", action="store_true", help="不讀寫 checkpoint（等同 --full 且不寫檔）")
+    parser.add_argument("--workers", type=int, default=RECONCILE_WORKERS, help="process 數（預設為 CPU 數）")
+    parser.add_argument("--chunk-size", type=int, default=RECONCILE_CHUNK_SIZE, help="每次串流讀取的筆數")
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    args = parser.parse_args(argv)
+
+    report = run(
+        url=args.database_url,
+        checkpoint=None if args.no_checkpoint else args.checkpoint,
+        full=args.full or args.no_checkpoint,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+    )
+    print(json.dumps(report, indent=2))
+    return 1 if report["drift_count"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
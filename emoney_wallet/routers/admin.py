@@ -3,7 +3,17 @@ from schemas.user import KYCUpdateRequest, MerchantStatusUpdateRequest
 from models import User
 from db import SessionLocal
 from sqlalchemy.orm import Session
-from deps import get_db, get_current_user
+from deps import get_db, get_current_user, invalidate_user, principal_cache_stats, require_admin
+import hashing
+import idempotency
+import group_commit
+import wallet_sweeper
+import payment_queue
+import balance_history
+import webhooks
+import velocity
+import storage
+import usernames
 
 router = APIRouter()
 
@@ -21,6 +31,7 @@ def admin_set_kyc_status(
 
     user.kyc_status = data.status
     db.commit()
+    invalidate_user(username)
 
     return {
         "message": f"KYC status of '{username}' updated to '{data.status}'"
@@ -38,6 +49,59 @@ def set_merchant_status(
 
     user.is_merchant = data.is_merchant
     db.commit()
+    invalidate_user(username)
 
     status_text = "enabled" if data.is_merchant else "disabled"
-    return {"message": f"Merchant status for '{username}' has been {status_text}"}
\ No newline at end of file
+    return {"message": f"Merchant status for '{username}' has been {status_text}"}
+
+
+@router.get("/admin/hash-stats")
+def get_hash_stats():
+    return hashing.stats()
+
+
+@router.get("/admin/cache-stats")
+def get_cache_stats():
+    return {**principal_cache_stats(), "idempotency": idempotency.response_cache.stats(), "usernames": usernames.cache.stats()}
+
+
+@router.get("/admin/db-stats")
+def get_db_stats():
+    return storage.pool_stats()
+
+
+@router.get("/admin/group-commit-stats")
+def get_group_commit_stats():
+    return group_commit.stats()
+
+
+@router.get("/admin/sweeper-stats")
+def get_sweeper_stats():
+    return wallet_sweeper.stats()
+
+
+@router.get("/admin/payment-queue-stats")
+def get_payment_queue_stats():
+    return payment_queue.stats()
+
+
+@router.get("/admin/balance-checkpoint-stats")
+def get_balance_checkpoint_stats():
+    return balance_history.stats()
+
+
+@router.get("/admin/webhook-stats")
+def get_webhook_stats():
+    return webhooks.stats()
+
+
+# 使用者（付款方）與商戶（收款方）目前的 velocity 計數與套用的上限；未指定 username 時回傳整體統計。
+# 涉及個人交易活動，只開放給管理者
+@router.get("/admin/velocity", dependencies=[Depends(require_admin)])
+def get_velocity_counters(username: str = None, db: Session = Depends(get_db)):
+    if username is None:
+        return velocity.stats()
+    user = db.query(User).filter(User.username == username).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"username": user.username, "kyc_status": user.kyc_status, **velocity.inspect(user.id, user.kyc_status)}
@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from schemas.user import KYCUpdateRequest, MerchantStatusUpdateRequest
+from models import User
+from deps import get_async_db, invalidate_user
+
+# DB_ASYNC 模式下的 /admin 端點，行為與 routers/admin.py 相同
+
+router = APIRouter()
+
+
+async def _get_user(db: AsyncSession, username: str) -> User:
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+@router.post("/admin/set-kyc")
+async def admin_set_kyc_status(
+    username: str,
+    data: KYCUpdateRequest,
+    db: AsyncSession = Depends(get_async_db)
+):
+    user = await _get_user(db, username)
+    user.kyc_status = data.status
+    await db.commit()
+    invalidate_user(username)
+
+    return {
+        "message": f"KYC status of '{username}' updated to '{data.status}'"
+    }
+
+
+@router.post("/admin/set-merchant")
+async def set_merchant_status(
+    username: str,
+    data: MerchantStatusUpdateRequest,
+    db: AsyncSession = Depends(get_async_db)
+):
+    user = await _get_user(db, username)
+    user.is_merchant = data.is_merchant
+    await db.commit()
+    invalidate_user(username)
+
+    status_text = "enabled" if data.is_merchant else "disabled"
+    return {"message": f"Merchant status for '{username}' has been {status_text}"}
@@ -0,0 +1,122 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import User, Wallet
+from schemas.user import UserCreate, Token, RefreshRequest, UserInfoExtended, KYCUpdateRequest, PinInput
+from deps import get_async_db, get_current_user_async, invalidate_user, decode_token
+from routers.auth import issue_token_pair, oauth2_scheme
+import hashing
+import ledger
+import tokens
+
+# DB_ASYNC 模式下的 /auth 端點，行為與 routers/auth.py 相同
+
+router = APIRouter()
+
+
+@router.post("/register")
+async def register(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    existing_user = (await db.execute(select(User.id).where(User.username == user.username))).first()
+    if existing_user:
+        raise HTTPException(status_code=400, detail="Username already exists")
+
+    hashed_password = await hashing.hash_secret(user.password)
+
+    # 使用者與錢包（初始餘額 0）一起 commit
+    new_user = User(username=user.username, hashed_password=hashed_password)
+    db.add(new_user)
+    await db.flush()
+    db.add(Wallet(user_id=new_user.id, balance=0.0))
+    await db.commit()
+
+    return {"message": "User registered successfully"}
+
+
+@router.post("/login", response_model=Token)
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(User).where(User.username == form_data.username))).scalars().first()
+    if not user:
+        raise HTTPException(status_code=400, detail="Incorrect username or password")
+
+    if not await hashing.verify_secret(form_data.password, user.hashed_password):
+        raise HTTPException(status_code=400, detail="Incorrect username or password")
+
+    if hashing.needs_rehash(user.hashed_password):
+        user.hashed_password = await hashing.hash_secret(form_data.password)
+        await db.commit()
+        invalidate_user(user.username)
+
+    refresh_token, family_id = await db.run_sync(tokens.issue, user.id)
+    username = user.username
+    await db.commit()
+    return issue_token_pair(username, refresh_token, family_id)
+
+
+@router.post("/refresh", response_model=Token)
+async def refresh(data: RefreshRequest, db: AsyncSession = Depends(get_async_db)):
+    username, refresh_token, family_id = await db.run_sync(tokens.rotate, data.refresh_token)
+    return issue_token_pair(username, refresh_token, family_id)
+
+
+@router.post("/logout")
+async def logout(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    claims = decode_token(token)
+    await db.run_sync(tokens.revoke_session, claims)
+    return {"message": "Logged out"}
+
+
+@router.get("/me", response_model=UserInfoExtended)
+async def get_my_profile(
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    balance = (await db.execute(ledger.balance_statement(current_user.id))).first()
+    if balance is None:
+        raise HTTPException(status_code=404, detail="Wallet not found")
+
+    return {
+        "id": current_user.id,
+        "username": current_user.username,
+        "balance": balance[0],
+        "is_merchant": current_user.is_merchant,
+        "kyc_status": current_user.kyc_status
+    }
+
+
+@router.patch("/me/kyc")
+async def update_kyc_status(
+    data: KYCUpdateRequest,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # 使用者只能提交為 pending
+    if data.status != "pending":
+        raise HTTPException(status_code=403, detail="Only 'pending' status can be requested")
+
+    current_user.kyc_status = "pending"
+    await db.commit()
+    invalidate_user(current_user.username)
+
+    return {"message": "KYC status set to pending"}
+
+
+@router.post("/me/pin")
+async def set_or_update_pin(
+    data: PinInput,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    current_user.pin_code = await hashing.hash_secret(data.pin)
+    await db.commit()
+    invalidate_user(current_user.username)
+    return {"message": "PIN set successfully"}
+
+
+@router.post("/me/unlock-pin")
+async def unlock_pin(current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    current_user.pin_fail_count = 0
+    current_user.is_pin_locked = False
+    await db.commit()
+    invalidate_user(current_user.username)
+    return {"message": "PIN has been unlocked"}
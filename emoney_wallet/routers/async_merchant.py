@@ -0,0 +1,75 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import User
+from schemas.merchant import MerchantChargeRequest, ManualRefundRequest, RefundByTransactionRequest
+from config import PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, GROUP_COMMIT, PAYMENT_QUEUE
+from deps import get_async_db, get_current_user_async
+from pagination import record_filters
+from routers import merchant
+from serialization import page_response
+import archive
+import group_commit
+import usernames
+import payment_queue
+import velocity
+
+# DB_ASYNC 模式下的 /merchant 端點。
+# 收款與退款直接以 AsyncSession.run_sync 執行同步版本的處理函式，兩邊規則只維護一份。
+
+router = APIRouter()
+
+
+@router.post("/merchant/charge")
+async def merchant_charge(
+    data: MerchantChargeRequest,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if not GROUP_COMMIT or PAYMENT_QUEUE:
+        return await db.run_sync(lambda s: merchant.merchant_charge(data, current_user, s))
+
+    # group commit 模式：不能在 event loop 上等待 writer，檢查完改以 await 送出
+    payer = await db.run_sync(lambda s: merchant.charge_payer(data, current_user, s))
+    with velocity.limit("charge", (payer.id, payer.kyc_status), (current_user.id, current_user.kyc_status), data.amount):
+        with merchant.charge_errors():
+            posting = await group_commit.post_async(payer.id, current_user.id, data.amount, "charge")
+    return merchant.charge_response(data, posting)
+
+
+@router.get("/merchant/records")
+async def get_merchant_records(
+    type: str = None,
+    start_date: str = Query(None, description="開始日期，格式 YYYY-MM-DD"),
+    end_date: str = Query(None, description="結束日期，格式 YYYY-MM-DD"),
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX, description="每頁筆數"),
+    after: str = Query(None, description="上一頁回傳的 X-Next-Cursor"),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if not current_user.is_merchant:
+        raise HTTPException(status_code=403, detail="Only merchants can view charge records")
+
+    filters = record_filters(current_user.id, type, start_date, end_date)
+    records, next_cursor = await db.run_sync(
+        archive.history_page, current_user.id, limit, after, filters, merchant.MERCHANT_RECORD_COLUMNS, start_date
+    )
+    names = await db.run_sync(usernames.counterparties, records)
+    return page_response(merchant.serialize_merchant_records(records, names), next_cursor)
+
+
+@router.post("/merchant/refund")
+async def refund_to_customer(
+    data: ManualRefundRequest,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await db.run_sync(lambda s: merchant.refund_to_customer(data, current_user, s))
+
+
+@router.post("/merchant/refund/by-transaction")
+async def refund_by_transaction(
+    data: RefundByTransactionRequest,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await db.run_sync(lambda s: merchant.refund_by_transaction(data, current_user, s))
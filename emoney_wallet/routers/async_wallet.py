@@ -0,0 +1,142 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import User, Wallet, Transaction
+from schemas.transaction import TransactionRecord
+from schemas.wallet import BalanceResponse, DepositRequest, TransferRequest
+from config import PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, GROUP_COMMIT, PAYMENT_QUEUE
+from deps import get_async_db, get_current_user_async, verify_pin
+from pagination import history_page, record_filters
+from routers.wallet import serialize_transactions, with_usernames, TRANSACTION_COLUMNS
+from serialization import RECORD_COLUMNS, transaction_records, page_response
+import ledger
+import archive
+import group_commit
+import usernames
+import payment_queue
+import balance_history
+import velocity
+
+# DB_ASYNC 模式下的 /wallet 端點，行為與 routers/wallet.py 相同。
+# 查詢條件與記帳邏輯沿用同步版本，透過 AsyncSession.run_sync 在非同步連線上執行。
+
+router = APIRouter()
+
+
+@router.get("/balance", response_model=BalanceResponse)
+async def get_balance(current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    balance = (await db.execute(ledger.balance_statement(current_user.id))).first()
+    if balance is None:
+        raise HTTPException(status_code=404, detail="Wallet not found")
+    return {"balance": balance[0]}
+
+
+@router.get("/balance/at")
+async def get_balance_at(
+    ts: str = Query(..., description="時間點，ISO 8601（未帶時區視為 UTC）"),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    return await db.run_sync(balance_history.balance_at, current_user.id, balance_history.parse_timestamp(ts))
+
+
+@router.post("/deposit")
+async def deposit_money(
+    data: DepositRequest,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if data.amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+
+    try:
+        posting = await db.run_sync(ledger.deposit, current_user.id, data.amount)
+    except ledger.WalletNotFound:
+        raise HTTPException(status_code=404, detail="Wallet not found")
+
+    return {"message": f"Deposited {data.amount} successfully", "new_balance": posting.to_balance}
+
+
+@router.post("/transfer")
+async def transfer_money(
+    data: TransferRequest,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    await verify_pin(data.pin, current_user, db)
+
+    if data.amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+
+    recipient = (await db.execute(select(User.id).where(User.username == data.to_username))).first()
+    if not recipient:
+        raise HTTPException(status_code=404, detail="Recipient not found")
+
+    with velocity.limit("transfer", (current_user.id, current_user.kyc_status), amount=data.amount) as reservation:
+        if PAYMENT_QUEUE:
+            payment_id = await db.run_sync(
+                payment_queue.enqueue, "transfer", current_user.id, current_user.id, recipient.id, data.amount, data.to_username,
+                reservation=reservation,
+            )
+            return payment_queue.accepted_response(payment_id)
+
+        try:
+            if GROUP_COMMIT:
+                posting = await group_commit.post_async(current_user.id, recipient.id, data.amount, "transfer")
+            else:
+                posting = await db.run_sync(ledger.post, current_user.id, recipient.id, data.amount, "transfer")
+        except ledger.InsufficientFunds:
+            raise HTTPException(status_code=400, detail="Insufficient balance")
+        except ledger.WalletNotFound as e:
+            detail = "Sender wallet not found" if e.side == "from" else "Recipient wallet not found"
+            raise HTTPException(status_code=404, detail=detail)
+
+    return {
+        "message": f"Transferred {data.amount} to {data.to_username}",
+        "new_balance": posting.from_balance
+    }
+
+
+@router.get("/transactions")
+async def get_transactions(
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX, description="每頁筆數"),
+    after: str = Query(None, description="上一頁回傳的 X-Next-Cursor"),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    txs, next_cursor = await db.run_sync(history_page, current_user.id, limit, after, (), TRANSACTION_COLUMNS)
+    names = await db.run_sync(usernames.counterparties, txs)
+    return page_response(serialize_transactions(txs, names), next_cursor)
+
+
+@router.get("/records", response_model=list[TransactionRecord])
+async def get_my_transaction_records(
+    type: str = Query(None, description="交易類型：transfer / charge / refund"),
+    start_date: str = Query(None, description="開始日期，格式 YYYY-MM-DD"),
+    end_date: str = Query(None, description="結束日期，格式 YYYY-MM-DD"),
+    keyword: str = Query(None, description="對方帳號關鍵字"),
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX, description="每頁筆數"),
+    after: str = Query(None, description="上一頁回傳的 X-Next-Cursor"),
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    filters = record_filters(current_user.id, type, start_date, end_date, keyword)
+    rows, next_cursor = await db.run_sync(archive.history_page, current_user.id, limit, after, filters, RECORD_COLUMNS, start_date)
+    names = await db.run_sync(usernames.counterparties, rows)
+    return page_response(transaction_records(rows, names), next_cursor)
+
+
+@router.get("/transaction/{tx_id}", response_model=TransactionRecord)
+async def get_transaction_detail(
+    tx_id: int,
+    current_user: User = Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db)
+):
+    tx = await db.get(Transaction, tx_id)
+    if not tx:
+        raise HTTPException(404, detail="Transaction not found")
+
+    if tx.from_user_id != current_user.id and tx.to_user_id != current_user.id:
+        raise HTTPException(403, detail="Unauthorized access to this transaction")
+
+    return with_usernames(tx, await db.run_sync(usernames.counterparties, [tx]))
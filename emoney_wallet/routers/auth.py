@@ -1,16 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from passlib.hash import bcrypt
 from db import SessionLocal
 from models import User, Wallet
-from schemas.user import UserCreate, Token, UserInfoExtended, KYCUpdateRequest, MerchantStatusUpdateRequest, PinInput
+from schemas.user import UserCreate, Token, RefreshRequest, UserInfoExtended, KYCUpdateRequest, MerchantStatusUpdateRequest, PinInput
 from schemas.wallet import BalanceResponse, DepositRequest, TransferRequest
 from schemas.merchant import MerchantChargeRequest, RefundRequest
-from jose import jwt, JWTError
+from jose import jwt
+import uuid
 from datetime import datetime, timedelta
 from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
-from deps import get_db, get_current_user
+from deps import get_db, get_current_user, invalidate_user, decode_token, decode_username
+import hashing
+import ledger
+import tokens
 
 
 router = APIRouter()
@@ -21,17 +25,23 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # 使用者註冊
 @router.post("/register")
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: Session = Depends(get_db)):
     # 檢查使用者是否已存在
-    existing_user = db.query(User).filter(User.username == user.username).first()
+    existing_user = await run_in_threadpool(lambda: db.query(User).filter(User.username == user.username).first())
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already exists")
 
-    # 加密密碼
-    hashed_password = bcrypt.hash(user.password)
+    # 加密密碼（交給 hashing process pool）
+    hashed_password = await hashing.hash_secret(user.password)
 
+    await run_in_threadpool(_create_user_with_wallet, db, user.username, hashed_password)
+
+    return {"message": "User registered successfully"}
+
+
+def _create_user_with_wallet(db: Session, username: str, hashed_password: str):
     # 新增使用者
-    new_user = User(username=user.username, hashed_password=hashed_password)
+    new_user = User(username=username, hashed_password=hashed_password)
     db.add(new_user)
     db.commit()
     db.refresh(new_user)
@@ -41,8 +51,6 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
     db.add(wallet)
     db.commit()
 
-    return {"message": "User registered successfully"}
-
 
 # 產生 JWT token
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -51,24 +59,50 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    # jti 讓單一 access token 也能被撤銷
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 # 登入
 @router.post("/login", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == form_data.username).first()
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = await run_in_threadpool(lambda: db.query(User).filter(User.username == form_data.username).first())
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    if not bcrypt.verify(form_data.password, user.hashed_password):
+    if not await hashing.verify_secret(form_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
+    # bcrypt cost 調整後，趁登入時以新 cost 重新雜湊
+    if hashing.needs_rehash(user.hashed_password):
+        user.hashed_password = await hashing.hash_secret(form_data.password)
+        await run_in_threadpool(db.commit)
+        invalidate_user(form_data.username)
+
+    refresh_token, family_id = tokens.issue(db, user.id)
+    await run_in_threadpool(db.commit)
+    return issue_token_pair(user.username, refresh_token, family_id)
+
+
+def issue_token_pair(username: str, refresh_token: str, family_id: str) -> dict:
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": user.username}, expires_delta=access_token_expires)
+    access_token = create_access_token(data={"sub": username, "sid": family_id}, expires_delta=access_token_expires)
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
 
-    return {"access_token": access_token, "token_type": "bearer"}
+# 以 refresh token 換發新的 token pair，不經過 bcrypt
+@router.post("/refresh", response_model=Token)
+def refresh(data: RefreshRequest, db: Session = Depends(get_db)):
+    username, refresh_token, family_id = tokens.rotate(db, data.refresh_token)
+    return issue_token_pair(username, refresh_token, family_id)
+
+
+# 登出：撤銷此 session 的 refresh token 與已發出的 access token
+@router.post("/logout")
+def logout(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    tokens.revoke_session(db, decode_token(token))
+    return {"message": "Logged out"}
 
 
 @router.get("/me", response_model=UserInfoExtended)
@@ -76,26 +110,20 @@ def get_my_profile(
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db)
 ):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    username = decode_username(token)
 
     user = db.query(User).filter(User.username == username).first()
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    wallet = db.query(Wallet).filter(Wallet.user_id == user.id).first()
-    if wallet is None:
+    balance = ledger.balance_of(db, user.id)
+    if balance is None:
         raise HTTPException(status_code=404, detail="Wallet not found")
 
     return {
         "id": user.id,
         "username": user.username,
-        "balance": wallet.balance,
+        "balance": balance,
         "is_merchant": user.is_merchant,
         "kyc_status": user.kyc_status
     }
@@ -106,13 +134,7 @@ def update_kyc_status(
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db)
 ):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    username = decode_username(token)
 
     user = db.query(User).filter(User.username == username).first()
     if not user:
@@ -124,23 +146,27 @@ def update_kyc_status(
 
     user.kyc_status = "pending"
     db.commit()
+    invalidate_user(username)
 
     return {"message": "KYC status set to pending"}
 
 @router.post("/me/pin")
-def set_or_update_pin(
+async def set_or_update_pin(
     data: PinInput,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    user = db.query(User).filter(User.id == current_user.id).first()
-    user.pin_code = bcrypt.hash(data.pin)
-    db.commit()
+    username = current_user.username
+    current_user.pin_code = await hashing.hash_secret(data.pin)
+    await run_in_threadpool(db.commit)
+    invalidate_user(username)
     return {"message": "PIN set successfully"}
 
 @router.post("/me/unlock-pin")
 def unlock_pin(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    username = current_user.username
     current_user.pin_fail_count = 0
     current_user.is_pin_locked = False
     db.commit()
+    invalidate_user(username)
     return {"message": "PIN has been unlocked"}
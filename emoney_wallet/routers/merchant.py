@@ -1,21 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from db import SessionLocal
-from models import User, Wallet, Transaction
-from schemas.merchant import  MerchantChargeRequest, ManualRefundRequest, RefundByTransactionRequest
+from models import User, Wallet, Transaction, MerchantWebhook
+from schemas.merchant import  MerchantChargeRequest, ManualRefundRequest, RefundByTransactionRequest, WebhookRequest
 from sqlalchemy.orm import Session
 from sqlalchemy import or_
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
-from deps import get_db, get_current_user
+from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, GROUP_COMMIT, PAYMENT_QUEUE
+from deps import get_db, get_read_db, get_current_user, get_current_user_read
+from pagination import record_filters
+from export import export_response
+from serialization import page_response
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+import ledger
+import archive
+import group_commit
+import usernames
+import payment_queue
+import merchant_stats
+import webhooks
+import velocity
 
 router = APIRouter()
 
 
-@router.post("/merchant/charge")
-def merchant_charge(
-    data: MerchantChargeRequest,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
+# 收款前的檢查，回傳付款者（DB_ASYNC 版本共用）
+def charge_payer(data: MerchantChargeRequest, current_user: User, db: Session) -> User:
     # 確認當前帳號是商戶
     if not current_user.is_merchant:
         raise HTTPException(status_code=403, detail="Only merchants can charge customers")
@@ -27,64 +36,119 @@ def merchant_charge(
     payer = db.query(User).filter(User.username == data.from_username).first()
     if not payer:
         raise HTTPException(status_code=404, detail="Payer user not found")
+    return payer
 
-    payer_wallet = db.query(Wallet).filter(Wallet.user_id == payer.id).first()
-    merchant_wallet = db.query(Wallet).filter(Wallet.user_id == current_user.id).first()
 
-    if payer_wallet.balance < data.amount:
+# 把記帳錯誤轉成 HTTP 回應（同步與非同步呼叫端共用）
+@contextmanager
+def charge_errors():
+    try:
+        yield
+    except ledger.InsufficientFunds:
         raise HTTPException(status_code=400, detail="Insufficient balance in payer's wallet")
+    except ledger.WalletNotFound as e:
+        detail = "Payer wallet not found" if e.side == "from" else "Merchant wallet not found"
+        raise HTTPException(status_code=404, detail=detail)
 
-    # 扣款 & 收款
-    payer_wallet.balance -= data.amount
-    merchant_wallet.balance += data.amount
-
-    # 加入交易紀錄
-    transaction = Transaction(
-        from_user_id=payer.id,
-        to_user_id=current_user.id,
-        amount=data.amount,
-        type="charge"
-    )
-    db.add(transaction)
-    db.commit()
 
+def charge_response(data: MerchantChargeRequest, posting: ledger.Posting) -> dict:
     return {
         "message": f"Charged {data.amount} from {data.from_username}",
-        "new_merchant_balance": merchant_wallet.balance
+        "new_merchant_balance": posting.to_balance
     }
 
+
+@router.post("/merchant/charge")
+def merchant_charge(
+    data: MerchantChargeRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    payer = charge_payer(data, current_user, db)
+
+    # 付款者與商戶的頻率 / 金額上限
+    with velocity.limit("charge", (payer.id, payer.kyc_status), (current_user.id, current_user.kyc_status), data.amount) as reservation:
+        # 付款佇列模式：驗證完寫入佇列，回 202 與查詢狀態的 payment id
+        if PAYMENT_QUEUE:
+            payment_id = payment_queue.enqueue(
+                db, "charge", current_user.id, payer.id, current_user.id, data.amount, data.from_username, reservation=reservation
+            )
+            return payment_queue.accepted_response(payment_id)
+
+        # 扣款 & 收款 & 交易紀錄
+        with charge_errors():
+            if GROUP_COMMIT:
+                posting = group_commit.post(payer.id, current_user.id, data.amount, "charge")
+            else:
+                posting = ledger.post(db, payer.id, current_user.id, data.amount, "charge")
+
+    return charge_response(data, posting)
+
+# /merchant/records 只需要這幾欄（id 供分頁游標使用）
+MERCHANT_RECORD_COLUMNS = (Transaction.from_user_id, Transaction.to_user_id, Transaction.amount, Transaction.type, Transaction.timestamp, Transaction.id)
+
+
 @router.get("/merchant/records")
 def get_merchant_records(
     type: str = None,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    start_date: str = Query(None, description="開始日期，格式 YYYY-MM-DD"),
+    end_date: str = Query(None, description="結束日期，格式 YYYY-MM-DD"),
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX, description="每頁筆數"),
+    after: str = Query(None, description="上一頁回傳的 X-Next-Cursor"),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
 ):
     # 確認是商戶
     if not current_user.is_merchant:
         raise HTTPException(status_code=403, detail="Only merchants can view charge records")
 
-    query = db.query(Transaction).filter(
-        or_(
-            Transaction.to_user_id == current_user.id,
-            Transaction.from_user_id == current_user.id
-        )
-    )
-    if type:
-        query = query.filter(Transaction.type == type)
-    
-    records = query.order_by(Transaction.timestamp.desc()).all()
-
-    result = []
-    for tx in records:
-        result.append({
-            "from_user_id": tx.from_user_id,
-            "to_user_id": tx.to_user_id,
-            "amount": tx.amount,
-            "type": tx.type,
-            "timestamp": tx.timestamp.isoformat()
-        })
-
-    return result
+    filters = record_filters(current_user.id, type, start_date, end_date)
+    records, next_cursor = archive.history_page(db, current_user.id, limit, after, filters, MERCHANT_RECORD_COLUMNS, start_date)
+    return page_response(serialize_merchant_records(records, usernames.counterparties(db, records)), next_cursor)
+
+
+def serialize_merchant_records(rows, names: dict):
+    return [
+        {
+            "from_user_id": from_user_id, "to_user_id": to_user_id, "amount": amount, "type": tx_type, "timestamp": timestamp,
+            "from_username": names.get(from_user_id), "to_username": names.get(to_user_id),
+        }
+        for from_user_id, to_user_id, amount, tx_type, timestamp, _ in rows
+    ]
+
+@router.get("/merchant/records/export")
+def export_merchant_records(
+    format: str = Query("csv", pattern="^(csv|ndjson)$", description="匯出格式：csv / ndjson"),
+    type: str = None,
+    start_date: str = Query(None, description="開始日期，格式 YYYY-MM-DD"),
+    end_date: str = Query(None, description="結束日期，格式 YYYY-MM-DD"),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
+):
+    if not current_user.is_merchant:
+        raise HTTPException(status_code=403, detail="Only merchants can view charge records")
+
+    filters = record_filters(current_user.id, type, start_date, end_date)
+    return export_response(current_user.id, filters, format, "merchant_records", start_date)
+
+@router.get("/merchant/summary")
+def get_merchant_summary(
+    granularity: str = Query("day", pattern="^(day|month)$", description="彙總單位：day / month"),
+    start_date: str = Query(None, description="開始日期，格式 YYYY-MM-DD，預設為 30 天前"),
+    end_date: str = Query(None, description="結束日期，格式 YYYY-MM-DD，預設為今天（UTC）"),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
+):
+    if not current_user.is_merchant:
+        raise HTTPException(status_code=403, detail="Only merchants can view sales summary")
+
+    try:
+        end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else datetime.utcnow().date()
+        start = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else end - timedelta(days=30)
+    except ValueError:
+        raise HTTPException(400, detail="日期格式錯誤")
+
+    return merchant_stats.summary(db, current_user.id, start, end, granularity)
 
 @router.post("/merchant/refund")
 def refund_to_customer(
@@ -102,29 +166,18 @@ def refund_to_customer(
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    merchant_wallet = db.query(Wallet).filter(Wallet.user_id == current_user.id).first()
-    customer_wallet = db.query(Wallet).filter(Wallet.user_id == customer.id).first()
-
-    if merchant_wallet.balance < data.amount:
+    # 扣款與退回，並建立 refund 紀錄
+    try:
+        posting = ledger.post(db, current_user.id, customer.id, data.amount, "refund")
+    except ledger.InsufficientFunds:
         raise HTTPException(status_code=400, detail="Insufficient balance for refund")
-
-    # 扣款與退回
-    merchant_wallet.balance -= data.amount
-    customer_wallet.balance += data.amount
-
-    # 建立 refund 紀錄
-    transaction = Transaction(
-        from_user_id=current_user.id,
-        to_user_id=customer.id,
-        amount=data.amount,
-        type="refund"
-    )
-    db.add(transaction)
-    db.commit()
+    except ledger.WalletNotFound as e:
+        detail = "Merchant wallet not found" if e.side == "from" else "Customer wallet not found"
+        raise HTTPException(status_code=404, detail=detail)
 
     return {
         "message": f"Refunded {data.amount} to {data.to_username}",
-        "new_merchant_balance": merchant_wallet.balance
+        "new_merchant_balance": posting.from_balance
     }
 
 
@@ -137,42 +190,112 @@ def refund_by_transaction(
     if not current_user.is_merchant:
         raise HTTPException(403, detail="Only merchants can refund")
 
-    original_tx = db.query(Transaction).filter(Transaction.id == data.transaction_id).first()
+    original_tx = db.get(Transaction, data.transaction_id)
     if not original_tx or original_tx.type != "charge":
         raise HTTPException(404, detail="Original charge transaction not found")
 
     if original_tx.to_user_id != current_user.id:
         raise HTTPException(403, detail="You are not the receiver of this transaction")
 
-    # 檢查是否已退款
-    existing_refund = db.query(Transaction).filter(
-        Transaction.type == "refund",
-        Transaction.from_user_id == original_tx.to_user_id,
-        Transaction.to_user_id == original_tx.from_user_id,
-        Transaction.amount == original_tx.amount
-    ).first()
-    if existing_refund:
+    # 檢查是否已退款（支援部分退款，累計不可超過原始金額）
+    remaining = original_tx.amount - (original_tx.refunded_amount or 0)
+    if remaining <= 0:
         raise HTTPException(400, detail="Already refunded")
 
-    merchant_wallet = db.query(Wallet).filter(Wallet.user_id == current_user.id).first()
-    customer_wallet = db.query(Wallet).filter(Wallet.user_id == original_tx.from_user_id).first()
+    amount = remaining if data.amount is None else data.amount
+    if amount <= 0:
+        raise HTTPException(400, detail="Refund amount must be positive")
 
-    if merchant_wallet.balance < original_tx.amount:
+    try:
+        posting = ledger.refund(db, original_tx.id, current_user.id, original_tx.from_user_id, amount)
+    except ledger.RefundExceedsCharge:
+        raise HTTPException(400, detail="Refund exceeds the remaining refundable amount")
+    except ledger.InsufficientFunds:
         raise HTTPException(400, detail="Insufficient balance to refund")
-
-    merchant_wallet.balance -= original_tx.amount
-    customer_wallet.balance += original_tx.amount
-
-    refund_tx = Transaction(
-        from_user_id=current_user.id,
-        to_user_id=original_tx.from_user_id,
-        amount=original_tx.amount,
-        type="refund"
-    )
-    db.add(refund_tx)
-    db.commit()
+    except ledger.WalletNotFound as e:
+        detail = "Merchant wallet not found" if e.side == "from" else "Customer wallet not found"
+        raise HTTPException(404, detail=detail)
 
     return {
         "message": "Refund completed successfully",
-        "refund_id": refund_tx.id
+        "refund_id": posting.transaction_id,
+        "refunded_amount": amount
     }
+
+
+def webhook_response(endpoint: MerchantWebhook, db: Session, secret: bool = False) -> dict:
+    response = {
+        "url": endpoint.url,
+        "failures": endpoint.failures or 0,
+        "next_attempt_at": endpoint.next_attempt_at,
+        "last_error": endpoint.last_error,
+        "events": webhooks.event_counts(db, endpoint.user_id),
+    }
+    if secret:
+        response["secret"] = endpoint.secret
+    return response
+
+
+# 設定收款 / 退款通知的 webhook；第一次設定或 rotate_secret 時回傳新的簽章 secret
+@router.put("/merchant/webhook")
+def set_webhook(
+    data: WebhookRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not current_user.is_merchant:
+        raise HTTPException(403, detail="Only merchants can configure webhooks")
+    try:
+        webhooks.check_url(data.url)
+    except webhooks.UnsafeURL as e:
+        raise HTTPException(400, detail=str(e))
+
+    endpoint = db.get(MerchantWebhook, current_user.id)
+    created = endpoint is None
+    if created:
+        endpoint = MerchantWebhook(user_id=current_user.id, secret=webhooks.new_secret(), failures=0)
+        db.add(endpoint)
+    elif data.rotate_secret:
+        endpoint.secret = webhooks.new_secret()
+    endpoint.url = data.url
+    # 換了網址就重新開始，不沿用舊網址的退避
+    endpoint.failures = 0
+    endpoint.next_attempt_at = None
+    db.commit()
+    return webhook_response(endpoint, db, secret=created or data.rotate_secret)
+
+
+@router.get("/merchant/webhook")
+def get_webhook(
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
+):
+    endpoint = db.get(MerchantWebhook, current_user.id)
+    if endpoint is None:
+        raise HTTPException(404, detail="Webhook not configured")
+    return webhook_response(endpoint, db)
+
+
+# 刪除後不再寫入新事件；尚未送出的事件保留，重新設定後會接著送
+@router.delete("/merchant/webhook")
+def delete_webhook(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    endpoint = db.get(MerchantWebhook, current_user.id)
+    if endpoint is None:
+        raise HTTPException(404, detail="Webhook not configured")
+    db.delete(endpoint)
+    db.commit()
+    return {"message": "Webhook deleted"}
+
+
+# 超過重試次數的事件重新排入送出
+@router.post("/merchant/webhook/redeliver")
+def redeliver_webhook_events(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if db.get(MerchantWebhook, current_user.id) is None:
+        raise HTTPException(404, detail="Webhook not configured")
+    return {"requeued": webhooks.redeliver(db, current_user.id)}
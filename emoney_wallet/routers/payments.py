@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from models import User
+from deps import get_current_user_detached
+import payment_queue
+
+# PAYMENT_QUEUE 模式下 202 回應的付款狀態查詢；wait 秒數內仍在處理中時會等待結果（long-poll）。
+# 使用者在等待前解析完畢，等待期間不持有 DB session。
+
+router = APIRouter()
+
+
+@router.get("/{payment_id}")
+async def get_payment_status(
+    payment_id: int,
+    wait: float = Query(0, ge=0, description="仍在處理中時最多等待的秒數"),
+    current_user: User = Depends(get_current_user_detached)
+):
+    # 權限在等待前檢查；別人的付款與不存在的付款同樣回 404
+    payment = await payment_queue.wait_for(payment_id, wait, current_user.id)
+    if payment is None:
+        raise HTTPException(status_code=404, detail="Payment not found")
+
+    return payment_queue.status_response(payment)
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from sqlalchemy import or_, and_
 from datetime import datetime
@@ -7,9 +8,19 @@ from fastapi.security import OAuth2PasswordBearer
 from db import SessionLocal
 from models import User, Wallet, Transaction
 from schemas.transaction import TransactionRecord
-from schemas.wallet import BalanceResponse, DepositRequest, TransferRequest
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
-from deps import get_db, get_current_user, verify_pin
+from schemas.wallet import BalanceResponse, DepositRequest, TransferRequest, BatchTransferRequest, BatchTransferResponse
+from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, BATCH_TRANSFER_MAX_ITEMS, BATCH_LOOKUP_CHUNK, GROUP_COMMIT, PAYMENT_QUEUE
+from deps import get_db, get_read_db, get_current_user, get_current_user_read, verify_pin
+from pagination import history_page, record_filters
+import ledger
+import archive
+import group_commit
+import usernames
+import payment_queue
+import balance_history
+import velocity
+from export import export_response
+from serialization import RECORD_COLUMNS, transaction_records, page_response
 
 
 router = APIRouter()
@@ -20,11 +31,20 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # 查詢餘額
 @router.get("/balance", response_model=BalanceResponse)
-def get_balance(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    wallet = db.query(Wallet).filter(Wallet.user_id == current_user.id).first()
-    if not wallet:
+def get_balance(current_user: User = Depends(get_current_user_read), db: Session = Depends(get_read_db)):
+    balance = ledger.balance_of(db, current_user.id)
+    if balance is None:
         raise HTTPException(status_code=404, detail="Wallet not found")
-    return {"balance": wallet.balance}
+    return {"balance": balance}
+
+# 某時間點（UTC）的餘額：最近的 checkpoint 加上之後的交易
+@router.get("/balance/at")
+def get_balance_at(
+    ts: str = Query(..., description="時間點，ISO 8601（未帶時區視為 UTC）"),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
+):
+    return balance_history.balance_at(db, current_user.id, balance_history.parse_timestamp(ts))
 
 @router.post("/deposit")
 def deposit_money(
@@ -32,87 +52,146 @@ def deposit_money(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    wallet = db.query(Wallet).filter(Wallet.user_id == current_user.id).first()
-    if not wallet:
-        raise HTTPException(status_code=404, detail="Wallet not found")
-
     if data.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
 
-    wallet.balance += data.amount
-    transaction = Transaction(
-    from_user_id=current_user.id,
-    to_user_id=current_user.id,  
-    amount=data.amount,
-    type="deposit"
-    )
-    db.add(transaction)
-    db.commit()
-    return {"message": f"Deposited {data.amount} successfully", "new_balance": wallet.balance}
+    try:
+        posting = ledger.deposit(db, current_user.id, data.amount)
+    except ledger.WalletNotFound:
+        raise HTTPException(status_code=404, detail="Wallet not found")
+
+    return {"message": f"Deposited {data.amount} successfully", "new_balance": posting.to_balance}
 
 @router.post("/transfer")
-def transfer_money(
+async def transfer_money(
     data: TransferRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    verify_pin(data.pin, current_user, db)
+    await verify_pin(data.pin, current_user, db)
 
-    sender_wallet = db.query(Wallet).filter(Wallet.user_id == current_user.id).first()
-    if not sender_wallet:
-        raise HTTPException(status_code=404, detail="Sender wallet not found")
-
-    
     if data.amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
 
-    if sender_wallet.balance < data.amount:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-
-    
-    recipient_user = db.query(User).filter(User.username == data.to_username).first()
+    recipient_user = await run_in_threadpool(lambda: db.query(User).filter(User.username == data.to_username).first())
     if not recipient_user:
         raise HTTPException(status_code=404, detail="Recipient not found")
 
-    recipient_wallet = db.query(Wallet).filter(Wallet.user_id == recipient_user.id).first()
-    if not recipient_wallet:
-        raise HTTPException(status_code=404, detail="Recipient wallet not found")
-
-    
-    sender_wallet.balance -= data.amount
-    recipient_wallet.balance += data.amount
-    transaction = Transaction(
-    from_user_id=current_user.id,
-    to_user_id=recipient_user.id,
-    amount=data.amount,
-    type="transfer"
-    )
-    db.add(transaction)
-    db.commit()
+    # 轉出方的頻率 / 金額上限；記帳失敗時退回計數
+    with velocity.limit("transfer", (current_user.id, current_user.kyc_status), amount=data.amount) as reservation:
+        # 付款佇列模式：驗證完寫入佇列，回 202 與查詢狀態的 payment id
+        if PAYMENT_QUEUE:
+            payment_id = await run_in_threadpool(
+                payment_queue.enqueue, db, "transfer", current_user.id, current_user.id, recipient_user.id, data.amount, data.to_username,
+                reservation=reservation,
+            )
+            return payment_queue.accepted_response(payment_id)
+
+        # 扣款、入帳與交易紀錄在同一個 DB transaction 內完成（group commit 模式下與其他請求共用一次 commit）
+        try:
+            if GROUP_COMMIT:
+                posting = await group_commit.post_async(current_user.id, recipient_user.id, data.amount, "transfer")
+            else:
+                posting = await run_in_threadpool(ledger.post, db, current_user.id, recipient_user.id, data.amount, "transfer")
+        except ledger.InsufficientFunds:
+            raise HTTPException(status_code=400, detail="Insufficient balance")
+        except ledger.WalletNotFound as e:
+            detail = "Sender wallet not found" if e.side == "from" else "Recipient wallet not found"
+            raise HTTPException(status_code=404, detail=detail)
 
     return {
         "message": f"Transferred {data.amount} to {data.to_username}",
-        "new_balance": sender_wallet.balance
+        "new_balance": posting.from_balance
     }
 
-@router.get("/transactions")
-def get_transactions(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    txs = db.query(Transaction).filter(
-        (Transaction.from_user_id == current_user.id) |
-        (Transaction.to_user_id == current_user.id)
-    ).order_by(Transaction.timestamp.desc()).all()
+# 批次轉帳：PIN 只驗一次，收款人以 IN 查詢一次解析，付款方扣款一次，全部在同一個 commit 內完成。
+# 個別項目（找不到收款人、金額不合法）標示為 failed，其餘照常入帳；餘額不足則整批不執行。
+@router.post("/transfer/batch", response_model=BatchTransferResponse)
+async def batch_transfer(
+    data: BatchTransferRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not data.items:
+        raise HTTPException(status_code=400, detail="No transfer items")
+    if len(data.items) > BATCH_TRANSFER_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_TRANSFER_MAX_ITEMS} items per batch")
+
+    await verify_pin(data.pin, current_user, db)
+
+    user_id = current_user.id
+    try:
+        return await run_in_threadpool(_run_batch_transfer, db, user_id, data.items, current_user.kyc_status)
+    except ledger.InsufficientFunds:
+        raise HTTPException(status_code=400, detail="Insufficient balance")
+    except ledger.WalletNotFound:
+        raise HTTPException(status_code=404, detail="Sender wallet not found")
+
+
+def _run_batch_transfer(db: Session, user_id: int, items, kyc_status: str = None):
+    usernames = list({item.to_username for item in items})
+    recipients = {}
+    for i in range(0, len(usernames), BATCH_LOOKUP_CHUNK):
+        chunk = usernames[i:i + BATCH_LOOKUP_CHUNK]
+        rows = db.query(User.username, User.id).join(Wallet, Wallet.user_id == User.id).filter(User.username.in_(chunk)).all()
+        recipients.update({username: uid for username, uid in rows})
 
     results = []
-    for tx in txs:
-        results.append({
-            "type": tx.type,
-            "amount": tx.amount,
-            "from": tx.from_user_id,
-            "to": tx.to_user_id,
-            "timestamp": tx.timestamp.isoformat()
-        })
+    credits = []
+    for item in items:
+        result = {"to_username": item.to_username, "amount": item.amount, "status": "failed"}
+        if item.amount <= 0:
+            result["detail"] = "Amount must be positive"
+        elif item.to_username not in recipients:
+            result["detail"] = "Recipient not found"
+        else:
+            result["status"] = "ok"
+            credits.append((recipients[item.to_username], item.amount))
+        results.append(result)
+
+    if credits:
+        # 與單筆轉帳共用付款方的 velocity 上限：有效項目的筆數與總額一次計入
+        with velocity.limit("transfer", (user_id, kyc_status), amount=sum(amount for _, amount in credits), count=len(credits)):
+            tx_ids, new_balance = ledger.post_batch(db, user_id, credits)
+    else:
+        tx_ids, new_balance = [], ledger.balance_of(db, user_id)
+
+    ok_results = iter(tx_ids)
+    for result in results:
+        if result["status"] == "ok":
+            result["transaction_id"] = next(ok_results)
 
-    return results
+    return {
+        "total_amount": sum(amount for _, amount in credits),
+        "succeeded": len(credits),
+        "failed": len(results) - len(credits),
+        "new_balance": new_balance or 0.0,
+        "results": results
+    }
+
+# /transactions 只需要這幾欄（id 供分頁游標使用）
+TRANSACTION_COLUMNS = (Transaction.type, Transaction.amount, Transaction.from_user_id, Transaction.to_user_id, Transaction.timestamp, Transaction.id)
+
+
+@router.get("/transactions")
+def get_transactions(
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX, description="每頁筆數"),
+    after: str = Query(None, description="上一頁回傳的 X-Next-Cursor"),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
+):
+    txs, next_cursor = history_page(db, current_user.id, limit, after, columns=TRANSACTION_COLUMNS)
+    return page_response(serialize_transactions(txs, usernames.counterparties(db, txs)), next_cursor)
+
+
+def serialize_transactions(rows, names: dict):
+    return [
+        {
+            "type": tx_type, "amount": amount, "from": from_user_id, "to": to_user_id, "timestamp": timestamp,
+            "from_username": names.get(from_user_id), "to_username": names.get(to_user_id),
+        }
+        for tx_type, amount, from_user_id, to_user_id, timestamp, _ in rows
+    ]
 
 
 @router.get("/records", response_model=list[TransactionRecord])
@@ -121,53 +200,35 @@ def get_my_transaction_records(
     start_date: str = Query(None, description="開始日期，格式 YYYY-MM-DD"),
     end_date: str = Query(None, description="結束日期，格式 YYYY-MM-DD"),
     keyword: str = Query(None, description="對方帳號關鍵字"),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX, description="每頁筆數"),
+    after: str = Query(None, description="上一頁回傳的 X-Next-Cursor"),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
 ):
-    query = db.query(Transaction)
+    filters = record_filters(current_user.id, type, start_date, end_date, keyword)
 
-    # 僅限相關交易
-    query = query.filter(or_(
-        Transaction.from_user_id == current_user.id,
-        Transaction.to_user_id == current_user.id
-    ))
-
-    # 交易類型過濾
-    if type:
-        query = query.filter(Transaction.type == type)
-
-    # 時間過濾
-    if start_date:
-        try:
-            start = datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.filter(Transaction.timestamp >= start)
-        except:
-            raise HTTPException(400, detail="start_date 格式錯誤")
+    # 僅限相關交易，依 (timestamp, id) 倒序分頁；start_date 早於封存邊界時接著讀封存檔
+    rows, next_cursor = archive.history_page(db, current_user.id, limit, after, filters, RECORD_COLUMNS, start_date)
+    return page_response(transaction_records(rows, usernames.counterparties(db, rows)), next_cursor)
 
-    if end_date:
-        try:
-            end = datetime.strptime(end_date, "%Y-%m-%d")
-            query = query.filter(Transaction.timestamp <= end)
-        except:
-            raise HTTPException(400, detail="end_date 格式錯誤")
-
-    # 關鍵字搜尋 username
-    if keyword:
-        matched_users = db.query(User.id).filter(User.username.contains(keyword)).all()
-        matched_ids = [u.id for u in matched_users]
-        query = query.filter(or_(
-            Transaction.from_user_id.in_(matched_ids),
-            Transaction.to_user_id.in_(matched_ids)
-        ))
-
-    results = query.order_by(Transaction.timestamp.desc()).all()
-    return results
+@router.get("/records/export")
+def export_my_transaction_records(
+    format: str = Query("csv", pattern="^(csv|ndjson)$", description="匯出格式：csv / ndjson"),
+    type: str = Query(None, description="交易類型：transfer / charge / refund"),
+    start_date: str = Query(None, description="開始日期，格式 YYYY-MM-DD"),
+    end_date: str = Query(None, description="結束日期，格式 YYYY-MM-DD"),
+    keyword: str = Query(None, description="對方帳號關鍵字"),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
+):
+    filters = record_filters(current_user.id, type, start_date, end_date, keyword)
+    return export_response(current_user.id, filters, format, "wallet_records", start_date)
 
 @router.get("/transaction/{tx_id}", response_model=TransactionRecord)
 def get_transaction_detail(
     tx_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
 ):
     tx = db.query(Transaction).filter(Transaction.id == tx_id).first()
     if not tx:
@@ -176,5 +237,11 @@ def get_transaction_detail(
     if tx.from_user_id != current_user.id and tx.to_user_id != current_user.id:
         raise HTTPException(403, detail="Unauthorized access to this transaction")
 
-    return tx
+    return with_usernames(tx, usernames.counterparties(db, [tx]))
+
+
+def with_usernames(tx: Transaction, names: dict) -> TransactionRecord:
+    return TransactionRecord.model_validate(tx).model_copy(
+        update={"from_username": names.get(tx.from_user_id), "to_username": names.get(tx.to_user_id)}
+    )
 
@@ -1,4 +1,4 @@
-from .user import UserCreate, Token, UserLogin, UserInfoExtended, KYCUpdateRequest, KYCStatus, MerchantStatusUpdateRequest, PinInput
-from .wallet import BalanceResponse, DepositRequest, TransferRequest
+from .user import UserCreate, Token, RefreshRequest, UserLogin, UserInfoExtended, KYCUpdateRequest, KYCStatus, MerchantStatusUpdateRequest, PinInput
+from .wallet import BalanceResponse, DepositRequest, TransferRequest, BatchTransferItem, BatchTransferRequest, BatchTransferResult, BatchTransferResponse
 from .merchant import MerchantChargeRequest, ManualRefundRequest, RefundByTransactionRequest
 from .transaction import TransactionRecord
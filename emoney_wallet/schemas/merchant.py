@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 class MerchantChargeRequest(BaseModel):
@@ -14,3 +15,8 @@ class ManualRefundRequest(BaseModel):
 
 class RefundByTransactionRequest(BaseModel):
     transaction_id: int
+    amount: Optional[float] = None  # 未指定時退還剩餘可退金額
+
+class WebhookRequest(BaseModel):
+    url: str
+    rotate_secret: bool = False  # True 時重新產生簽章用的 secret
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -8,6 +9,9 @@ class TransactionRecord(BaseModel):
     amount: float
     timestamp: datetime
     type: str
+    original_transaction_id: Optional[int] = None
+    from_username: Optional[str] = None
+    to_username: Optional[str] = None
 
     class Config:
         from_attributes = True
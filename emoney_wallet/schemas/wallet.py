@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 class BalanceResponse(BaseModel):
@@ -13,4 +14,26 @@ class TransferRequest(BaseModel):
 class TransferRequest(BaseModel):
     to_username: str
     amount: float
-    pin: str  
\ No newline at end of file
+    pin: str  
+
+class BatchTransferItem(BaseModel):
+    to_username: str
+    amount: float
+
+class BatchTransferRequest(BaseModel):
+    items: list[BatchTransferItem]
+    pin: str
+
+class BatchTransferResult(BaseModel):
+    to_username: str
+    amount: float
+    status: str  # ok / failed
+    detail: Optional[str] = None
+    transaction_id: Optional[int] = None
+
+class BatchTransferResponse(BaseModel):
+    total_amount: float
+    succeeded: int
+    failed: int
+    new_balance: float
+    results: list[BatchTransferResult]
@@ -0,0 +1,42 @@
+import orjson
+from fastapi.responses import JSONResponse
+from models import Transaction
+from pagination import NEXT_CURSOR_HEADER
+
+# 大量列表回應的快速路徑：只查需要的欄位（Row tuple，不建 ORM 物件），
+# 以預先決定好欄位順序的 comprehension 組 dict，再由 orjson 直接編碼（datetime 原生支援，
+# 輸出與 isoformat() 相同），回傳 Response 讓 FastAPI 略過 response_model 的逐筆驗證。
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+# TransactionRecord 的欄位，順序即輸出順序
+RECORD_COLUMNS = (
+    Transaction.id,
+    Transaction.from_user_id,
+    Transaction.to_user_id,
+    Transaction.amount,
+    Transaction.timestamp,
+    Transaction.type,
+    Transaction.original_transaction_id,
+)
+_RECORD_FIELDS = tuple(column.key for column in RECORD_COLUMNS)
+
+
+# names 為 usernames.counterparties 的結果，補上雙方帳號
+def transaction_records(rows, names: dict) -> list:
+    fields = _RECORD_FIELDS
+    records = [dict(zip(fields, row)) for row in rows]
+    for record in records:
+        record["from_username"] = names.get(record["from_user_id"])
+        record["to_username"] = names.get(record["to_user_id"])
+    return records
+
+
+# 分頁列表回應，下一頁游標放在 X-Next-Cursor
+def page_response(content, next_cursor: str = None) -> ORJSONResponse:
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    return ORJSONResponse(content, headers=headers)
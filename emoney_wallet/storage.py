@@ -0,0 +1,126 @@
+import threading
+import time
+from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from config import SQLITE_PRAGMAS, READ_POOL_SIZE, READ_POOL_MAX_OVERFLOW
+import metrics
+
+# SQLite 正式環境設定：每條連線套用 WAL、synchronous=NORMAL、busy_timeout、mmap、cache，
+# 讀取專用的連線池另外加上 query_only。WAL 下讀取不會擋住唯一的寫入者，反之亦然。
+
+_pool_stats = {}
+_lock = threading.Lock()
+
+
+def _apply_pragmas(dbapi_connection, pragmas: dict):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+# 記錄取得連線的等待時間（含連線池用完時排隊、建立新連線）
+class TimedQueuePool(QueuePool):
+    name = "default"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.record_pool_wait(self.name, time.perf_counter() - started)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.name = self.name
+        return pool
+
+
+def _track_pool(engine, name: str):
+    stats = {"connects": 0, "checkouts": 0}
+    with _lock:
+        _pool_stats[name] = (engine, stats)
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.name = name
+    metrics.instrument_engine(engine)
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        with _lock:
+            stats["connects"] += 1
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        with _lock:
+            stats["checkouts"] += 1
+
+
+# 寫入（預設）engine 的 pragma；journal_mode=WAL 會寫進資料庫檔，之後所有連線都生效
+def configure_sqlite(engine, name: str = "write", read_only: bool = False, overrides: dict = None):
+    if engine.dialect.name == "sqlite":
+        pragmas = {**SQLITE_PRAGMAS, **(overrides or {})}
+        if read_only:
+            pragmas.pop("journal_mode", None)
+            pragmas["query_only"] = "ON"
+
+        @event.listens_for(engine, "connect")
+        def _on_connect(dbapi_connection, connection_record):
+            _apply_pragmas(dbapi_connection, pragmas)
+
+    _track_pool(engine, name)
+    return engine
+
+
+# 背景 writer 專用連線：由 driver 不自動開 transaction，改在 begin 時送出 BEGIN IMMEDIATE，
+# SAVEPOINT 才會落在外層 transaction 內（pysqlite 預設行為下 RELEASE 最外層 savepoint 會直接 commit），
+# 多個 writer 也會在 transaction 開始時就排隊，不會讀完才升級成寫入而失敗。非 SQLite 沿用原 engine。
+def create_writer_engine(engine, name: str, pool_size: int = 1, overrides: dict = None):
+    if engine.dialect.name != "sqlite":
+        return engine
+    writer = create_engine(
+        engine.url,
+        connect_args={"check_same_thread": False, "isolation_level": None},
+        pool_size=pool_size,
+        max_overflow=0,
+        poolclass=TimedQueuePool,
+    )
+
+    @event.listens_for(writer, "begin")
+    def _on_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return configure_sqlite(writer, name=name, overrides=overrides)
+
+
+def create_read_engine(url: str):
+    kwargs = {"pool_size": READ_POOL_SIZE, "max_overflow": READ_POOL_MAX_OVERFLOW, "poolclass": TimedQueuePool}
+    if url.startswith("sqlite"):
+        kwargs["connect_args"] = {"check_same_thread": False}
+    return configure_sqlite(create_engine(url, **kwargs), name="read", read_only=True)
+
+
+def pool_stats() -> dict:
+    result = {}
+    with _lock:
+        items = list(_pool_stats.items())
+    for name, (engine, stats) in items:
+        pool = engine.pool
+        with _lock:
+            info = {"pool": type(pool).__name__, **stats}
+        for attr in ("size", "checkedout", "checkedin", "overflow"):
+            if hasattr(pool, attr):
+                info[attr] = getattr(pool, attr)()
+        result[name] = info
+    return result
+
+
+# 依資料庫方言取得支援 on_conflict_do_update 的 insert（upsert 用）
+def dialect_insert(db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
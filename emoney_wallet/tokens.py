@@ -0,0 +1,199 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from models import RefreshToken, User
+from config import (
+    SECRET_KEY, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS,
+    REVOCATION_BLOOM_BITS, REVOCATION_BLOOM_HASHES, REVOCATION_PURGE_INTERVAL,
+)
+
+# Refresh token 與撤銷清單。
+# refresh token 格式為 "<token_id>.<secret>"：以 token_id 走索引查一筆，secret 只存 HMAC-SHA256，
+# 換發一次就失效（rotation），同一次登入換發出的 token 共用 family_id，也就是 access token 的 "sid"。
+# 已換發的 token 再被使用視為外洩，整個 family 一起撤銷。
+# 撤銷的 sid / jti 放在記憶體 denylist，前面擋一個 Bloom filter：絕大多數請求的 token 沒被撤銷，
+# 只做 k 次 bit 檢查就放行。denylist 只需保留到 access token 過期為止；多 worker 之間不同步，
+# 其他 process 上的 access token 最多再有效 ACCESS_TOKEN_EXPIRE_MINUTES（refresh token 則在 DB 上立即失效）。
+
+_HMAC_KEY = hashlib.sha256(b"emoney-refresh-token:" + SECRET_KEY.encode()).digest()
+
+
+class BloomFilter:
+    def __init__(self, bits: int, hashes: int):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    # double hashing：由一次 blake2b 的兩個 64-bit 值推出 k 個位置
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        array = self._array
+        return all(array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class Denylist:
+    def __init__(self, bits: int, hashes: int, purge_interval: float):
+        self._bits = bits
+        self._hashes = hashes
+        self._purge_interval = purge_interval
+        self._bloom = BloomFilter(bits, hashes)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._next_purge = time.time() + purge_interval
+        self.checks = 0
+        self.bloom_hits = 0
+        self.denied = 0
+
+    def add(self, key: str, expires_at: float):
+        with self._lock:
+            if expires_at > self._entries.get(key, 0):
+                self._entries[key] = expires_at
+            self._bloom.add(key)
+            if time.time() >= self._next_purge:
+                self._purge()
+
+    # 過期項目移除後重建 Bloom filter（Bloom filter 無法刪除）
+    def _purge(self):
+        now = time.time()
+        self._entries = {key: expires_at for key, expires_at in self._entries.items() if expires_at > now}
+        bloom = BloomFilter(self._bits, self._hashes)
+        for key in self._entries:
+            bloom.add(key)
+        self._bloom = bloom
+        self._next_purge = now + self._purge_interval
+
+    def __contains__(self, key: str) -> bool:
+        self.checks += 1
+        if key not in self._bloom:
+            return False
+        self.bloom_hits += 1
+        expires_at = self._entries.get(key)
+        if expires_at is None or expires_at <= time.time():
+            return False
+        self.denied += 1
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bloom_bits": self._bits,
+                "bloom_hashes": self._hashes,
+                "checks": self.checks,
+                "bloom_hits": self.bloom_hits,
+                "denied": self.denied,
+            }
+
+
+denylist = Denylist(REVOCATION_BLOOM_BITS, REVOCATION_BLOOM_HASHES, REVOCATION_PURGE_INTERVAL)
+
+
+def is_revoked(payload: dict) -> bool:
+    return any(payload.get(claim) in denylist for claim in ("sid", "jti") if payload.get(claim))
+
+
+def _hash_secret(secret: str) -> str:
+    return hmac.new(_HMAC_KEY, secret.encode(), hashlib.sha256).hexdigest()
+
+
+def _new_refresh_token(db: Session, user_id: int, family_id: str) -> str:
+    token_id = secrets.token_urlsafe(12)
+    secret = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        token_id=token_id,
+        family_id=family_id,
+        user_id=user_id,
+        token_hash=_hash_secret(secret),
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    return f"{token_id}.{secret}"
+
+
+# 登入時開一個新的 family；回傳 (refresh token, family_id)，由呼叫端 commit
+def issue(db: Session, user_id: int):
+    family_id = secrets.token_urlsafe(12)
+    return _new_refresh_token(db, user_id, family_id), family_id
+
+
+def _revoke_family(db: Session, family_id: str, now: datetime):
+    db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.family_id == family_id, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=now)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _deny_session(family_id: str):
+    denylist.add(family_id, time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+
+# 換發：舊 token 以條件式 UPDATE 標記為已換發，同時送來的兩個請求只有一個成功。
+# 回傳 (username, 新 refresh token, family_id)，已 commit
+def rotate(db: Session, raw_token: str):
+    token_id, _, secret = raw_token.partition(".")
+    row = db.execute(
+        select(RefreshToken, User.username)
+        .join(User, User.id == RefreshToken.user_id)
+        .where(RefreshToken.token_id == token_id)
+    ).first()
+    if row is None or not secret or not hmac.compare_digest(row[0].token_hash, _hash_secret(secret)):
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    token, username = row
+    now = datetime.utcnow()
+    if token.revoked_at is not None or token.expires_at <= now:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+    claimed = db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.id == token.id, RefreshToken.rotated_at.is_(None), RefreshToken.revoked_at.is_(None))
+        .values(rotated_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        # 已換發過的 token 又被拿來用：撤銷整個 family
+        _revoke_family(db, token.family_id, now)
+        db.commit()
+        _deny_session(token.family_id)
+        raise HTTPException(status_code=401, detail="Refresh token reuse detected; session revoked")
+
+    new_token = _new_refresh_token(db, token.user_id, token.family_id)
+    db.commit()
+    return username, new_token, token.family_id
+
+
+# 登出：撤銷該 session 的 refresh token，並讓已發出的 access token 立即失效
+def revoke_session(db: Session, payload: dict):
+    family_id = payload.get("sid")
+    if family_id:
+        _revoke_family(db, family_id, datetime.utcnow())
+        db.commit()
+        _deny_session(family_id)
+    elif payload.get("jti"):
+        denylist.add(payload["jti"], payload.get("exp", time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60))
+
+
+# 啟動時由 DB 補回最近撤銷、access token 可能仍有效的 session
+def load_denylist(db: Session) -> int:
+    since = datetime.utcnow() - timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    rows = db.execute(
+        select(RefreshToken.family_id).where(RefreshToken.revoked_at >= since).distinct()
+    ).scalars().all()
+    for family_id in rows:
+        _deny_session(family_id)
+    return len(rows)
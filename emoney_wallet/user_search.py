@@ -0,0 +1,61 @@
+from sqlalchemy import text, select, case, exists, literal_column, table
+from sqlalchemy.exc import OperationalError
+from models import User, Transaction
+
+# 帳號關鍵字搜尋：SQLite 上以 FTS5 trigram 索引 users.username（external content 表，
+# 由 trigger 與 users 同步，註冊時自動寫入）。不支援 FTS5 的環境或少於 3 個字的關鍵字，
+# 改以「對方帳號」逐筆主鍵查詢比對，成本只和自己的交易筆數有關。
+
+FTS_TABLE = "users_fts"
+TRIGRAM_MIN_LENGTH = 3
+
+_fts_available = False
+
+_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"username, content='users', content_rowid='id', tokenize='trigram')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON users BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, username) VALUES (new.id, new.username); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON users BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username) VALUES ('delete', old.id, old.username); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF username ON users BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username) VALUES ('delete', old.id, old.username); "
+    f"INSERT INTO {FTS_TABLE}(rowid, username) VALUES (new.id, new.username); END",
+]
+
+
+def ensure_index(engine):
+    global _fts_available
+    if engine.dialect.name != "sqlite":
+        return
+    try:
+        with engine.begin() as conn:
+            created = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": FTS_TABLE}
+            ).first() is None
+            for ddl in _DDL:
+                conn.execute(text(ddl))
+            # 第一次建立時，把既有使用者寫進索引
+            if created:
+                conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        _fts_available = True
+    except OperationalError:
+        # SQLite 未編入 FTS5 或不支援 trigram tokenizer（3.34 以前）
+        _fts_available = False
+
+
+# 交易的對方帳號符合關鍵字（同時適用付款方與收款方分支）
+def counterparty_matches(user_id: int, keyword: str):
+    counterparty = case(
+        (Transaction.from_user_id == user_id, Transaction.to_user_id),
+        else_=Transaction.from_user_id,
+    )
+    if _fts_available and len(keyword) >= TRIGRAM_MIN_LENGTH:
+        phrase = '"' + keyword.replace('"', '""') + '"'
+        matched = (
+            select(literal_column("rowid"))
+            .select_from(table(FTS_TABLE))
+            .where(literal_column(FTS_TABLE).op("MATCH")(phrase))
+        )
+        return counterparty.in_(matched)
+    return exists().where(User.id == counterparty, User.username.contains(keyword))
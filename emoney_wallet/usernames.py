@@ -0,0 +1,32 @@
+from sqlalchemy import select
+from models import User
+from cache import TTLCache
+from config import USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL
+
+# 交易列表的對方帳號：user id → username。
+# 先查行程內快取，未命中的 id 以一次 IN 查詢補齊（每頁最多一次，不會逐筆查詢）。
+# username 註冊後不會變更，快取不需失效，大小與 TTL 只用來限制記憶體。
+
+cache = TTLCache(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL)
+
+
+def resolve(db, user_ids) -> dict:
+    names = {}
+    missing = []
+    for user_id in set(user_ids):
+        name = cache.get(user_id)
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+
+    if missing:
+        for user_id, name in db.execute(select(User.id, User.username).where(User.id.in_(missing))):
+            cache.set(user_id, name)
+            names[user_id] = name
+    return names
+
+
+# 一頁交易（需有 from_user_id / to_user_id 欄位）雙方的 username
+def counterparties(db, rows) -> dict:
+    return resolve(db, [user_id for row in rows for user_id in (row.from_user_id, row.to_user_id)])
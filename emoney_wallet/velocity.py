@@ -0,0 +1,292 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import Transaction
+from config import VELOCITY_WINDOWS, VELOCITY_LIMITS, VELOCITY_PURGE_INTERVAL, VELOCITY_WARM_CHUNK
+
+# 轉帳與商戶收款的頻率 / 金額上限（velocity limits）。
+# 每個 (scope, user_id) 在每個時間窗各有一個環狀 bucket 陣列與總計，檢查加計數都是 O(1)（過期 bucket 逐格清掉，攤提 O(1)），
+# 不需要在每筆付款時對 transactions 做 COUNT / SUM。時間窗以 bucket 為單位滑動，精確度為一個 bucket 寬。
+#   scope "user"：付款方（轉帳的轉出方、被商戶收款的付款者）
+#   scope "merchant"：收款商戶
+# 上限依當下的 kyc_status 套用（VELOCITY_LIMITS），計數本身與 kyc_status 無關，升級後立即改用新上限。
+# 啟動時由最近一個最長時間窗內的交易補回計數。計數只在各 process 內，多 worker 時每個 process 各自計算。
+# 記帳失敗（餘額不足等）會退回計數；付款佇列模式下請求一進佇列即計入，佇列 worker 記帳失敗時依 payment id 退回
+# （只有處理該筆的 worker 與收件的請求在同一個 process 時才退得回）。批次轉帳以有效項目的筆數與總額計入付款方。
+
+
+class LimitExceeded(Exception):
+    def __init__(self, scope: str, window: str, kind: str, retry_after: float):
+        super().__init__(f"{scope} {kind} limit per {window} exceeded")
+        self.scope = scope
+        self.window = window
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+class SlidingWindow:
+    __slots__ = ("width", "size", "counts", "amounts", "head", "count", "amount")
+
+    def __init__(self, seconds: float, buckets: int):
+        self.width = seconds / buckets
+        self.size = buckets
+        self.counts = [0] * buckets
+        self.amounts = [0.0] * buckets
+        self.head = 0  # 最新 bucket 的絕對編號
+        self.count = 0
+        self.amount = 0.0
+
+    def index(self, now: float) -> int:
+        return int(now // self.width)
+
+    # 移到 bucket index，中間經過的 bucket 歸零
+    def advance(self, index: int):
+        if index <= self.head:
+            return
+        if index - self.head >= self.size:
+            self.counts = [0] * self.size
+            self.amounts = [0.0] * self.size
+            self.count = 0
+            self.amount = 0.0
+        else:
+            for i in range(self.head + 1, index + 1):
+                slot = i % self.size
+                self.count -= self.counts[slot]
+                self.amount -= self.amounts[slot]
+                self.counts[slot] = 0
+                self.amounts[slot] = 0.0
+        self.head = index
+
+    # 加到 index 所在的 bucket；已滑出時間窗的忽略，回傳是否有計入
+    def add(self, index: int, count: int, amount: float) -> bool:
+        self.advance(index)
+        if index <= self.head - self.size:
+            return False
+        slot = index % self.size
+        self.counts[slot] += count
+        self.amounts[slot] += amount
+        self.count += count
+        self.amount += amount
+        return True
+
+    # 最舊一個非空 bucket 滑出時間窗的剩餘秒數
+    def retry_after(self, now: float) -> float:
+        for i in range(self.head - self.size + 1, self.head + 1):
+            if self.counts[i % self.size]:
+                return max(0.0, (i + self.size) * self.width - now)
+        return 0.0
+
+
+class VelocityLimiter:
+    def __init__(self, windows: dict, limits: dict, purge_interval: float):
+        self._windows = windows
+        self._limits = limits
+        self._purge_interval = purge_interval
+        self._counters = {}
+        self._held = {}  # payment id → (reservation, 過期時間)
+        self._lock = threading.Lock()
+        self._next_purge = time.time() + purge_interval
+        self.checks = 0
+        self.rejected = 0
+
+    def _windows_for(self, key):
+        counters = self._counters.get(key)
+        if counters is None:
+            counters = self._counters[key] = {
+                name: SlidingWindow(seconds, buckets) for name, (seconds, buckets) in self._windows.items()
+            }
+        return counters
+
+    def limits_for(self, scope: str, kyc_status: str) -> dict:
+        by_status = self._limits.get(scope, {})
+        return by_status.get(kyc_status) or by_status.get("not_verified") or {}
+
+    # entries: [(scope, user_id, kyc_status)]；count 筆、合計 amount 全部通過才一起計入，否則丟出 LimitExceeded。
+    # 回傳給 release 用的 reservation
+    def check_and_add(self, entries, amount: float, now: float = None, count: int = 1):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.checks += 1
+            if now >= self._next_purge:
+                self._purge(now)
+            targets = []
+            for scope, user_id, kyc_status in entries:
+                limits = self.limits_for(scope, kyc_status)
+                for name, window in self._windows_for((scope, user_id)).items():
+                    window.advance(window.index(now))
+                    limit = limits.get(name) or {}
+                    if limit.get("count") is not None and window.count + count > limit["count"]:
+                        self.rejected += 1
+                        raise LimitExceeded(scope, name, "count", window.retry_after(now))
+                    if limit.get("amount") is not None and window.amount + amount > limit["amount"] + 1e-9:
+                        self.rejected += 1
+                        raise LimitExceeded(scope, name, "amount", window.retry_after(now))
+                    targets.append((window, window.head))
+            for window, index in targets:
+                window.add(index, count, amount)
+        return targets, amount, count
+
+    # 記帳失敗時退回；bucket 已滑出時間窗則不需處理
+    def release(self, reservation):
+        targets, amount, count = reservation
+        with self._lock:
+            for window, index in targets:
+                if index > window.head - window.size:
+                    slot = index % window.size
+                    window.counts[slot] -= count
+                    window.amounts[slot] -= amount
+                    window.count -= count
+                    window.amount -= amount
+
+    # 付款佇列：請求端保留 reservation，等 worker 處理完再決定退回（release_held）或丟棄（drop_held）
+    def hold(self, key, reservation, now: float = None):
+        now = time.time() if now is None else now
+        expires = now + max(window.width * window.size for window, _ in reservation[0]) if reservation[0] else now
+        with self._lock:
+            self._held[key] = (reservation, expires)
+
+    def release_held(self, key):
+        with self._lock:
+            held = self._held.pop(key, None)
+        if held is not None:
+            self.release(held[0])
+
+    def drop_held(self, key):
+        with self._lock:
+            self._held.pop(key, None)
+
+    # 啟動補回：直接計入，不檢查上限
+    def record(self, entries, amount: float, at: float):
+        with self._lock:
+            for scope, user_id in entries:
+                for window in self._windows_for((scope, user_id)).values():
+                    window.add(window.index(at), 1, amount)
+
+    # 移除所有時間窗都已清空的計數
+    def _purge(self, now: float):
+        empty = []
+        for key, windows in self._counters.items():
+            for window in windows.values():
+                window.advance(window.index(now))
+            if all(window.count == 0 for window in windows.values()):
+                empty.append(key)
+        for key in empty:
+            del self._counters[key]
+        # 其他 process 處理掉的付款不會通知這裡，計數滑出時間窗後就不必再保留
+        for key in [key for key, (_, expires) in self._held.items() if expires <= now]:
+            del self._held[key]
+        self._next_purge = now + self._purge_interval
+
+    def inspect(self, scope: str, user_id: int, kyc_status: str, now: float = None) -> dict:
+        now = time.time() if now is None else now
+        limits = self.limits_for(scope, kyc_status)
+        with self._lock:
+            windows = self._counters.get((scope, user_id), {})
+            result = {}
+            for name in self._windows:
+                window = windows.get(name)
+                if window is not None:
+                    window.advance(window.index(now))
+                result[name] = {
+                    "count": window.count if window else 0,
+                    "amount": round(window.amount, 6) if window else 0.0,
+                    "limit": limits.get(name),
+                    "resets_in": round(window.retry_after(now), 3) if window else 0.0,
+                }
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tracked": len(self._counters), "held": len(self._held), "checks": self.checks, "rejected": self.rejected}
+
+
+limiter = VelocityLimiter(VELOCITY_WINDOWS, VELOCITY_LIMITS or {}, VELOCITY_PURGE_INTERVAL)
+
+
+def _entries(tx_type: str, from_user_id: int, to_user_id: int):
+    if tx_type == "charge":
+        return [("user", from_user_id), ("merchant", to_user_id)]
+    return [("user", from_user_id)]
+
+
+# 端點用：檢查並計入（批次轉帳一次計入 count 筆），超過上限回 429；區塊內發生例外（記帳失敗）時退回計數。
+# as 取得 reservation，付款佇列模式交給 payment_queue.enqueue 保留（停用時為 None）
+@contextmanager
+def limit(tx_type: str, payer: tuple, merchant: tuple = None, amount: float = 0.0, count: int = 1):
+    if VELOCITY_LIMITS is None:
+        yield None
+        return
+    entries = [("user", *payer)]
+    if merchant is not None:
+        entries.append(("merchant", *merchant))
+    try:
+        reservation = limiter.check_and_add(entries, amount, count=count)
+    except LimitExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"{tx_type.capitalize()} {e}",
+            headers={"Retry-After": str(max(1, int(e.retry_after + 0.999)))},
+        )
+    try:
+        yield reservation
+    except BaseException:
+        limiter.release(reservation)
+        raise
+
+
+# 付款佇列：請求端在付款寫入佇列時保留 reservation，worker 記帳失敗時退回，成功時丟棄
+def hold(payment_id: int, reservation):
+    if reservation is not None:
+        limiter.hold(payment_id, reservation)
+
+
+def settle(failed_ids, succeeded_ids):
+    for payment_id in failed_ids:
+        limiter.release_held(payment_id)
+    for payment_id in succeeded_ids:
+        limiter.drop_held(payment_id)
+
+
+# 啟動時由最近的轉帳 / 收款補回計數：依 id 由新到舊分批讀（走主鍵），整批都早於最長時間窗時停止；回傳筆數
+def warm_start(db: Session, now: datetime = None) -> int:
+    if VELOCITY_LIMITS is None:
+        return 0
+    now = now or datetime.utcnow()
+    since = now - timedelta(seconds=max(seconds for seconds, _ in VELOCITY_WINDOWS.values()))
+    loaded = 0
+    before = None
+    while True:
+        query = (
+            select(Transaction.id, Transaction.type, Transaction.from_user_id, Transaction.to_user_id, Transaction.amount, Transaction.timestamp)
+            .order_by(Transaction.id.desc())
+            .limit(VELOCITY_WARM_CHUNK)
+        )
+        if before is not None:
+            query = query.where(Transaction.id < before)
+        rows = db.execute(query).all()
+        if not rows:
+            return loaded
+        recent = False
+        for tx_id, tx_type, from_user_id, to_user_id, amount, timestamp in rows:
+            if timestamp is None or timestamp < since:
+                continue
+            recent = True
+            if tx_type in ("transfer", "charge"):
+                at = timestamp.replace(tzinfo=timezone.utc).timestamp()
+                limiter.record(_entries(tx_type, from_user_id, to_user_id), amount or 0.0, at)
+                loaded += 1
+        if not recent:
+            return loaded
+        before = rows[-1].id
+
+
+def inspect(user_id: int, kyc_status: str) -> dict:
+    return {scope: limiter.inspect(scope, user_id, kyc_status) for scope in ("user", "merchant")}
+
+
+def stats() -> dict:
+    return {"enabled": VELOCITY_LIMITS is not None, **limiter.stats()}
@@ -0,0 +1,37 @@
+import asyncio
+import logging
+from fastapi.concurrency import run_in_threadpool
+from db import SessionLocal
+import ledger
+
+# 商戶錢包分片的 sweeper：定期把 wallet_slots 併回 wallets，讓主錢包餘額不會長期落後。
+# 單次失敗（例如與收款交易互相等待被資料庫中止）只記錄下來，下一輪再試。
+
+logger = logging.getLogger(__name__)
+
+_stats = {"runs": 0, "wallets_folded": 0, "errors": 0}
+
+
+def _sweep_once() -> int:
+    db = SessionLocal()
+    try:
+        return ledger.sweep_slots(db)
+    finally:
+        db.close()
+
+
+async def run(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            folded = await run_in_threadpool(_sweep_once)
+        except Exception:
+            _stats["errors"] += 1
+            logger.exception("wallet slot sweep failed")
+            continue
+        _stats["runs"] += 1
+        _stats["wallets_folded"] += folded
+
+
+def stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,420 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import random
+import secrets
+import socket
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import NamedTuple
+from urllib.parse import urlsplit
+import httpcore
+import httpx
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import DateTime, Integer, String, Text, func, insert, literal, or_, select, update
+from sqlalchemy.orm import Session
+import db
+import usernames
+from models import MerchantWebhook, OutboxEvent
+from config import (
+    WEBHOOK_BATCH_SIZE, WEBHOOK_CONCURRENCY, WEBHOOK_TIMEOUT,
+    WEBHOOK_BACKOFF_BASE, WEBHOOK_BACKOFF_MAX, WEBHOOK_MAX_ATTEMPTS, WEBHOOK_ALLOW_LOCAL_HTTP,
+)
+
+# 商戶 webhook（transactional outbox）：charge / refund 記帳時由 ledger 在同一個 transaction 內寫入 outbox_events，
+# 記帳 rollback 時事件也不存在，commit 後一定會送出。只有設定了 webhook 的商戶才會寫入（INSERT ... SELECT，不多一次查詢）。
+# dispatcher 是 event loop 上的背景工作：每輪取出有待送事件、且未在退避中的端點，
+# 每個端點一個 POST 帶最多 WEBHOOK_BATCH_SIZE 筆事件（依 id 順序），以共用連線池的 httpx.AsyncClient 並行送出。
+# 失敗時整個端點指數退避，事件超過 WEBHOOK_MAX_ATTEMPTS 次標為 failed，可由商戶要求重送。
+# 送達語意為 at-least-once：接收端應以事件 id 去重。
+# URL 必須是 https，主機解析出的位址都要是公開位址（擋 loopback、私有網段、link-local 的 SSRF）；
+# 設定時檢查一次；送出時由連線池的 network backend 在建立連線時解析、檢查，並直接連到檢查過的位址
+# （Host 與 TLS SNI 仍是原本的主機名稱），避免 DNS rebinding 在檢查後改指向內部位址。不跟隨 redirect、不走環境變數的 proxy。
+#
+# 簽章：X-Emoney-Signature: t=<unix 秒>,v1=<HMAC-SHA256(secret, "<t>.<body>") hex>
+#
+#   python webhooks.py receive --secret <secret>    # 本機測試用接收端（需 WEBHOOK_ALLOW_LOCAL_HTTP），驗證簽章並印出事件
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = "X-Emoney-Signature"
+
+_EVENT_TYPES = {"charge": "charge.succeeded", "refund": "refund.succeeded"}
+
+_stats = {"runs": 0, "requests": 0, "delivered": 0, "failed_requests": 0, "dead": 0, "errors": 0}
+
+
+# 由 ledger 在同一個 DB transaction 內呼叫：charge 通知收款商戶，refund 通知退款商戶
+def record(db: Session, tx_type: str, from_user_id: int, to_user_id: int, amount: float,
+           transaction_id: int, timestamp: datetime, original_transaction_id: int = None):
+    event_type = _EVENT_TYPES.get(tx_type)
+    if event_type is None:
+        return
+    merchant_id, customer_id = (to_user_id, from_user_id) if tx_type == "charge" else (from_user_id, to_user_id)
+    payload = {
+        "transaction_id": transaction_id,
+        "amount": amount,
+        "customer_id": customer_id,
+        "timestamp": timestamp.isoformat(),
+    }
+    if original_transaction_id is not None:
+        payload["original_transaction_id"] = original_transaction_id
+
+    db.execute(
+        insert(OutboxEvent).from_select(
+            ["merchant_id", "type", "transaction_id", "payload", "status", "attempts", "created_at"],
+            select(
+                MerchantWebhook.user_id,
+                literal(event_type, String),
+                literal(transaction_id, Integer),
+                literal(json.dumps(payload), Text),
+                literal("pending", String),
+                literal(0, Integer),
+                literal(timestamp, DateTime),
+            ).where(MerchantWebhook.user_id == merchant_id)
+        )
+    )
+
+
+class UnsafeURL(ValueError):
+    pass
+
+
+def _host_port(url: str):
+    parts = urlsplit(url)
+    if parts.scheme != "https" and not (WEBHOOK_ALLOW_LOCAL_HTTP and parts.scheme == "http"):
+        raise UnsafeURL("Webhook URL must use https")
+    try:
+        port = parts.port
+    except ValueError:
+        raise UnsafeURL("Webhook URL has an invalid port")
+    if not parts.hostname:
+        raise UnsafeURL("Webhook URL has no host")
+    return parts.hostname, port or (443 if parts.scheme == "https" else 80)
+
+
+def _check_addresses(infos):
+    if not infos:
+        raise UnsafeURL("Webhook host cannot be resolved")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if address.is_global or (WEBHOOK_ALLOW_LOCAL_HTTP and address.is_loopback):
+            continue
+        raise UnsafeURL(f"Webhook host resolves to a non-public address ({address})")
+
+
+# 設定 webhook 時檢查；不通過丟出 UnsafeURL
+def check_url(url: str):
+    host, port = _host_port(url)
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise UnsafeURL("Webhook host cannot be resolved")
+    _check_addresses(infos)
+
+
+# 連線時解析並檢查，連到檢查過的第一個位址，不再另外解析一次
+class _PinnedBackend(httpcore.AsyncNetworkBackend):
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError):
+            raise UnsafeURL("Webhook host cannot be resolved")
+        _check_addresses(infos)
+        return await self._backend.connect_tcp(
+            infos[0][4][0], port, timeout=timeout, local_address=local_address, socket_options=socket_options
+        )
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise UnsafeURL("Webhook URL must be a TCP host")
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class _PinnedTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, limits: httpx.Limits):
+        super().__init__(limits=limits, trust_env=False)
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(trust_env=False),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=_PinnedBackend(),
+        )
+
+
+def new_secret() -> str:
+    return secrets.token_urlsafe(32)
+
+
+def sign(secret: str, timestamp: int, body: bytes) -> str:
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+# 接收端驗證：簽章正確且時間戳在 tolerance 秒內
+def verify(secret: str, header: str, body: bytes, tolerance: float = 300) -> bool:
+    try:
+        parts = dict(part.split("=", 1) for part in header.split(","))
+        timestamp = int(parts["t"])
+    except (KeyError, ValueError):
+        return False
+    if abs(time.time() - timestamp) > tolerance:
+        return False
+    return hmac.compare_digest(sign(secret, timestamp, body), f"t={timestamp},v1={parts.get('v1', '')}")
+
+
+class _Delivery(NamedTuple):
+    merchant_id: int
+    url: str
+    secret: str
+    failures: int
+    event_ids: list
+    body: bytes
+
+
+def _backoff(failures: int) -> float:
+    delay = min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2 ** (failures - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+# 取件：以條件式 UPDATE 把端點的 next_attempt_at 設為租約到期時間，其他 dispatcher 在租約內不會再取到
+def _claim() -> list:
+    session = db.SessionLocal()
+    try:
+        now = datetime.utcnow()
+        due = or_(MerchantWebhook.next_attempt_at.is_(None), MerchantWebhook.next_attempt_at <= now)
+        merchant_ids = session.execute(
+            select(OutboxEvent.merchant_id)
+            .join(MerchantWebhook, MerchantWebhook.user_id == OutboxEvent.merchant_id)
+            .where(OutboxEvent.status == "pending", due)
+            .distinct()
+            .limit(WEBHOOK_CONCURRENCY)
+        ).scalars().all()
+
+        claimed = []
+        lease = now + timedelta(seconds=WEBHOOK_TIMEOUT * 2)
+        for merchant_id in merchant_ids:
+            endpoint = session.execute(
+                update(MerchantWebhook)
+                .where(MerchantWebhook.user_id == merchant_id, due)
+                .values(next_attempt_at=lease)
+                .returning(MerchantWebhook.url, MerchantWebhook.secret, MerchantWebhook.failures)
+                .execution_options(synchronize_session=False)
+            ).first()
+            if endpoint is None:
+                continue
+            events = session.execute(
+                select(OutboxEvent.id, OutboxEvent.type, OutboxEvent.payload, OutboxEvent.created_at)
+                .where(OutboxEvent.status == "pending", OutboxEvent.merchant_id == merchant_id)
+                .order_by(OutboxEvent.id)
+                .limit(WEBHOOK_BATCH_SIZE)
+            ).all()
+            claimed.append((merchant_id, endpoint, events))
+        session.commit()
+
+        payloads = {event.id: json.loads(event.payload) for _, _, events in claimed for event in events}
+        names = usernames.resolve(session, {payload["customer_id"] for payload in payloads.values()})
+    finally:
+        session.close()
+
+    deliveries = []
+    for merchant_id, (url, secret, failures), events in claimed:
+        body = json.dumps({"events": [
+            {
+                "id": event.id,
+                "type": event.type,
+                "created_at": event.created_at.isoformat(),
+                "data": {**payloads[event.id], "customer_username": names.get(payloads[event.id]["customer_id"])},
+            }
+            for event in events
+        ]}, separators=(",", ":")).encode()
+        deliveries.append(_Delivery(merchant_id, url, secret, failures, [event.id for event in events], body))
+    return deliveries
+
+
+# 送出一個端點的批次，成功回傳 None，失敗回傳錯誤訊息
+async def _send(client: httpx.AsyncClient, delivery: _Delivery):
+    headers = {
+        "Content-Type": "application/json",
+        SIGNATURE_HEADER: sign(delivery.secret, int(time.time()), delivery.body),
+        "X-Emoney-Delivery": f"{delivery.merchant_id}-{delivery.event_ids[0]}-{delivery.event_ids[-1]}",
+    }
+    try:
+        _host_port(delivery.url)
+        response = await client.post(delivery.url, content=delivery.body, headers=headers)
+    except UnsafeURL as e:
+        return str(e)
+    except httpx.HTTPError as e:
+        return f"{type(e).__name__}: {e}"[:500]
+    if 200 <= response.status_code < 300:
+        return None
+    return f"HTTP {response.status_code}"
+
+
+def _finish(results) -> tuple:
+    session = db.SessionLocal()
+    delivered = dead = 0
+    try:
+        now = datetime.utcnow()
+        for delivery, error in results:
+            events = OutboxEvent.id.in_(delivery.event_ids)
+            if error is None:
+                session.execute(
+                    update(OutboxEvent).where(events)
+                    .values(status="delivered", attempts=OutboxEvent.attempts + 1, delivered_at=now)
+                    .execution_options(synchronize_session=False)
+                )
+                session.execute(
+                    update(MerchantWebhook).where(MerchantWebhook.user_id == delivery.merchant_id)
+                    .values(failures=0, next_attempt_at=None, last_error=None)
+                    .execution_options(synchronize_session=False)
+                )
+                delivered += len(delivery.event_ids)
+                continue
+
+            session.execute(
+                update(OutboxEvent).where(events)
+                .values(attempts=OutboxEvent.attempts + 1)
+                .execution_options(synchronize_session=False)
+            )
+            dead += session.execute(
+                update(OutboxEvent).where(events, OutboxEvent.attempts >= WEBHOOK_MAX_ATTEMPTS)
+                .values(status="failed")
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            failures = delivery.failures + 1
+            session.execute(
+                update(MerchantWebhook).where(MerchantWebhook.user_id == delivery.merchant_id)
+                .values(failures=failures, next_attempt_at=now + timedelta(seconds=_backoff(failures)), last_error=error)
+                .execution_options(synchronize_session=False)
+            )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return delivered, dead
+
+
+# 一輪：取件、並行送出、寫回結果；回傳送出的請求數
+async def dispatch_once(client: httpx.AsyncClient) -> int:
+    deliveries = await run_in_threadpool(_claim)
+    if not deliveries:
+        return 0
+    errors = await asyncio.gather(*(_send(client, delivery) for delivery in deliveries))
+    results = list(zip(deliveries, errors))
+    delivered, dead = await run_in_threadpool(_finish, results)
+
+    failed = sum(1 for error in errors if error is not None)
+    _stats["requests"] += len(deliveries)
+    _stats["failed_requests"] += failed
+    _stats["delivered"] += delivered
+    _stats["dead"] += dead
+    return len(deliveries)
+
+
+def create_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=WEBHOOK_CONCURRENCY, max_keepalive_connections=WEBHOOK_CONCURRENCY)
+    return httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT, transport=_PinnedTransport(limits), follow_redirects=False, trust_env=False)
+
+
+# 背景工作：有送出請求時立即進下一輪，沒有待送事件時等待 interval 秒
+async def run(interval: float):
+    async with create_client() as client:
+        while True:
+            try:
+                sent = await dispatch_once(client)
+            except Exception:
+                _stats["errors"] += 1
+                logger.exception("webhook dispatch failed")
+                sent = 0
+            _stats["runs"] += 1
+            if not sent:
+                await asyncio.sleep(interval)
+
+
+# 商戶要求重送：failed 事件改回 pending，並解除端點退避；回傳筆數
+def redeliver(session: Session, merchant_id: int) -> int:
+    count = session.execute(
+        update(OutboxEvent)
+        .where(OutboxEvent.merchant_id == merchant_id, OutboxEvent.status == "failed")
+        .values(status="pending", attempts=0)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    session.execute(
+        update(MerchantWebhook)
+        .where(MerchantWebhook.user_id == merchant_id)
+        .values(failures=0, next_attempt_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    return count
+
+
+def event_counts(session: Session, merchant_id: int = None) -> dict:
+    query = select(OutboxEvent.status, func.count()).group_by(OutboxEvent.status)
+    if merchant_id is not None:
+        query = query.where(OutboxEvent.merchant_id == merchant_id)
+    return {status: count for status, count in session.execute(query)}
+
+
+def stats() -> dict:
+    session = db.ReadSessionLocal()
+    try:
+        counts = event_counts(session)
+    finally:
+        session.close()
+    return {"pending": counts.get("pending", 0), "failed": counts.get("failed", 0), **_stats}
+
+
+# 本機測試用接收端：驗證簽章後印出事件；--fail-rate 隨機回 500，用來觀察重試與退避
+def receive(argv=None):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    parser = argparse.ArgumentParser(prog="python webhooks.py receive", description="webhook 測試接收端")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not verify(args.secret, self.headers.get(SIGNATURE_HEADER, ""), body):
+                status = 401
+            elif random.random() < args.fail_rate:
+                status = 500
+            else:
+                status = 200
+                for event in json.loads(body)["events"]:
+                    print(json.dumps(event), flush=True)
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"listening on http://{args.host}:{args.port}", file=sys.stderr)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["receive"]:
+        sys.exit("usage: python webhooks.py receive --secret <secret> [--port 8081] [--fail-rate 0.0]")
+    receive(sys.argv[2:])